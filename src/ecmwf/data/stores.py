@@ -5,7 +5,9 @@ Definitions of the Archive stores at ECMWF.
 import logging
 
 import footprints
+from vortex import sessions
 from vortex.data.stores import Finder
+from vortex.tools.delayedactions import d_action_status
 
 LOG = logging.getLogger(__name__)
 
@@ -19,12 +21,40 @@ class FinderECMWF(Finder):
         priority=dict(level=footprints.priorities.top.TOOLBOX),
     )
 
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self._ectrans_endpoints = dict()
+
+    def _ectrans_endpoint(self, options):
+        """The ECtrans gateway and remote (resolved once per store object).
+
+        See :meth:`ecmwf.tools.ectrans.ECtransTools.ectrans_endpoint`.
+        """
+        key = (options.get("gateway", None), options.get("remote", None))
+        endpoint = self._ectrans_endpoints.get(key)
+        if endpoint is None:
+            endpoint = self.system.ectrans_endpoint(
+                storage=self.hostname(), gateway=key[0], remote=key[1]
+            )
+            self._ectrans_endpoints[key] = endpoint
+        return endpoint
+
     @staticmethod
     def ectransfullpath(remote):
         return remote["path"]
 
     def ectranscheck(self, remote, options):
-        raise NotImplementedError()
+        endpoint = self._ectrans_endpoint(options)
+        rpath = self.ectransfullpath(remote)
+        rc = self.system.ectranstest(
+            rpath, gateway=endpoint.gateway, remote=endpoint.remote
+        )
+        if rc is None:
+            # No remote listing is available
+            rc = self.system.ectransprobe(
+                rpath, gateway=endpoint.gateway, remote=endpoint.remote
+            )
+        return rc
 
     def ectranslocate(self, remote, options):
         return self.ectransfullpath(remote)
@@ -33,19 +63,14 @@ class FinderECMWF(Finder):
         # Initializations
         rpath = self.ectransfullpath(remote)
         LOG.info("ectransget on %s (to: %s)", rpath, local)
-        ectrans_remote = self.system.ectrans_remote_init(
-            remote=options.get("remote", None), storage=self.hostname()
-        )
-        ectrans_gateway = self.system.ectrans_gateway_init(
-            gateway=options.get("gateway", None)
-        )
+        endpoint = self._ectrans_endpoint(options)
         rc = self.system.ectransget(
             source=rpath,
             target=local,
             fmt=options.get("fmt", "foo"),
             cpipeline=options.get("compressionpipeline", None),
-            gateway=ectrans_gateway,
-            remote=ectrans_remote,
+            gateway=endpoint.gateway,
+            remote=endpoint.remote,
         )
         if rc:
             self._localtarfix(local)
@@ -55,19 +80,14 @@ class FinderECMWF(Finder):
         # Initializations
         rpath = self.ectransfullpath(remote)
         LOG.info("ectransput on %s (from: %s)", rpath, local)
-        ectrans_remote = self.system.ectrans_remote_init(
-            remote=options.get("remote", None), storage=self.hostname()
-        )
-        ectrans_gateway = self.system.ectrans_gateway_init(
-            gateway=options.get("gateway", None)
-        )
+        endpoint = self._ectrans_endpoint(options)
         return self.system.ectransput(
             source=local,
             target=rpath,
             fmt=options.get("fmt", "foo"),
             cpipeline=options.get("compressionpipeline", None),
-            gateway=ectrans_gateway,
-            remote=ectrans_remote,
+            gateway=endpoint.gateway,
+            remote=endpoint.remote,
             sync=options.get("enforcesync", False),
         )
 
@@ -101,6 +121,43 @@ class FinderECMWF(Finder):
             self._localtarfix(local)
         return rc
 
+    def ecfsearlyget(self, remote, local, options):
+        fmt = options.get("fmt", "foo")
+        if (
+            isinstance(local, str)
+            and options.get("compressionpipeline") is None
+            and not options.get("options")
+            and not self.system.fmtspecific_mtd("ecfsget", fmt)
+        ):
+            return sessions.current().context.delayedactions_hub.register(
+                (self.ecfsfullpath(remote), fmt),
+                kind="archive",
+                storage=self.hostname(),
+                goal="get",
+                tube="ecfs",
+            )
+        return None
+
+    def ecfsfinaliseget(self, result_id, remote, local, options):
+        d_action = sessions.current().context.delayedactions_hub.retrieve(
+            result_id, bareobject=True
+        )
+        if d_action.status == d_action_status.done:
+            if self.system.filecocoon(local):
+                rc = self.system.mv(
+                    d_action.result, local, fmt=options.get("fmt", "foo")
+                )
+            else:
+                raise OSError("Could not cocoon: {!s}".format(local))
+        elif d_action.status == d_action_status.failed:
+            LOG.info("The earlyget failed (result_id=%s)", result_id)
+            rc = False
+        else:
+            rc = None
+        if rc:
+            self._localtarfix(local)
+        return rc
+
     def ecfsput(self, local, remote, options):
         rpath = self.ecfsfullpath(remote)
         list_options = options.get("options", list())
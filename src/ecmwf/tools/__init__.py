@@ -3,6 +3,8 @@ Specific ECMWF tools.
 """
 
 from . import addons as addons
+from . import delayedactions as delayedactions
+from . import prestaging as prestaging
 from . import storage as storage
 
 #: No automatic export
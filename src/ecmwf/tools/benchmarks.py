@@ -0,0 +1,496 @@
+"""
+Benchmarks of the ECfs and ECtrans addons against stand-in commands.
+
+The actual ``ecp``/``els``/``etest``/.../``ectrans`` commands are replaced by
+the local emulators of :mod:`ecmwf.tools.ecfsemulator` and
+:mod:`ecmwf.tools.ectransemulator` (see :class:`StandInCommands`) that store
+the "remote" files in a local directory and simulate a configurable latency
+(a fixed delay for each command) and bandwidth (data are copied at a
+limited rate).
+
+The throughput and latency of ``ecfsget``, ``ecfsput``, ``ecfstest``,
+``ectransput`` and of asynchronous ECtrans transfers (``ectransqueue``) are
+measured for various numbers of files, file sizes and compression pipelines
+(see :class:`BenchmarkCase`). The results can be saved as a baseline and
+later runs can be compared against it (see :func:`compare_with_baseline`).
+From the command line::
+
+    python -m vortex_ecmwf.tools.benchmarks --latency 0.05 --save mybaseline.json
+    python -m vortex_ecmwf.tools.benchmarks --latency 0.05 --baseline mybaseline.json
+
+The second command exits with a non-zero return code if a regression is
+detected.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import os
+import shlex
+import shutil
+import sys
+import tempfile
+import time
+
+import footprints
+from vortex import config, ticket
+from vortex.config import get_from_config_w_default
+from vortex.tools.compression import CompressionPipeline
+
+from . import ecfsemulator, ectransemulator
+from .ecfs import ecfs_known_directories
+from .ectrans import ectrans_status
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+
+class StandInCommands:
+    """Stand-in ``ecfs``/``ectrans`` commands (to be used as a context manager).
+
+    Within the context, the ECfs and ECtrans commands are run through the
+    :mod:`~ecmwf.tools.ecfsemulator` and :mod:`~ecmwf.tools.ectransemulator`
+    emulators (using the ``ecfs_command_wrapper`` and
+    ``ectrans_command_wrapper`` keys of the ``ecmwf`` configuration
+    section), the ECfs metadata cache lives in a temporary directory and the
+    ECfs directories memo is cleared.
+
+    The ``ec:/path/to/file`` ECfs files (and the ``path/to/file`` ECtrans
+    files of the ``remote`` association of the ``gateway`` gateway) are
+    stored in the ``<root>/ec/path/to/file`` (and
+    ``<root>/gateway/remote/path/to/file``) local file.
+    """
+
+    #: The configuration keys set within the context
+    _CONFIG_KEYS = (
+        "ecfs_command_wrapper",
+        "ecfs_metacache_path",
+        "ectrans_command_wrapper",
+    )
+
+    def __init__(self, latency=0.0, bandwidth=0.0):
+        """
+        :param float latency: The delay (in seconds) for any command
+        :param float bandwidth: The transfer rate (in bytes per second,
+                                unlimited if zero)
+        """
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.tmpdir = None
+        self._config = None
+
+    @property
+    def root(self):
+        """The directory where "remote" files are stored."""
+        return os.path.join(self.tmpdir, "root")
+
+    def remote_path(self, path):
+        """The local path of the **path** ECfs file."""
+        return ecfsemulator.ECfsEmulator(self.root).remote_path(path)
+
+    def _wrapper(self, module):
+        """The command line that runs the **module** emulator."""
+        return " ".join(
+            shlex.quote(arg)
+            for arg in (
+                sys.executable,
+                module.__file__,
+                "--root",
+                self.root,
+                "--latency",
+                str(self.latency),
+                "--bandwidth",
+                str(self.bandwidth),
+            )
+        )
+
+    def __enter__(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="ecmwf_standin_")
+        os.makedirs(self.root)
+        self._config = {
+            key: get_from_config_w_default(
+                section="ecmwf", key=key, default=None
+            )
+            for key in self._CONFIG_KEYS
+        }
+        config.set_config(
+            "ecmwf", "ecfs_command_wrapper", self._wrapper(ecfsemulator)
+        )
+        config.set_config(
+            "ecmwf", "ectrans_command_wrapper", self._wrapper(ectransemulator)
+        )
+        config.set_config(
+            "ecmwf",
+            "ecfs_metacache_path",
+            os.path.join(self.tmpdir, "metacache.db"),
+        )
+        ecfs_known_directories.clear()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        for key, value in self._config.items():
+            config.set_config("ecmwf", key, value)
+        ecfs_known_directories.clear()
+        shutil.rmtree(self.tmpdir)
+        self.tmpdir = None
+
+
+class BenchmarkCase:
+    """Measure one operation on **nfiles** files of **size** bytes."""
+
+    #: The available operations
+    OPERATIONS = (
+        "ecfsget",
+        "ecfsput",
+        "ecfstest",
+        "ectransput",
+        "ectransqueue",
+    )
+
+    #: The polling period of the ``ectransqueue`` operation (in seconds)
+    QUEUE_POLLFREQ = 0.05
+
+    def __init__(self, operation, nfiles, size, compression=None):
+        """
+        :param str operation: One of :attr:`OPERATIONS`
+        :param int nfiles: The number of files
+        :param int size: The size of each file (in bytes)
+        :param str compression: The compression pipeline description
+                                (e.g. ``gzip``) or ``None``
+        """
+        if operation not in self.OPERATIONS:
+            raise ValueError("Unknown operation: {!r}".format(operation))
+        self.operation = operation
+        self.nfiles = nfiles
+        self.size = size
+        self.compression = compression
+
+    @property
+    def name(self):
+        """The case's name (used as a key in the results)."""
+        return "{:s}-n{:d}-s{:d}-{:s}".format(
+            self.operation,
+            self.nfiles,
+            self.size,
+            self.compression or "raw",
+        )
+
+    def _content(self, i):
+        """Half random, half compressible data."""
+        half = self.size // 2
+        return os.urandom(half) + bytes([i % 256]) * (self.size - half)
+
+    def _prepare(self, sh, standin, cpipeline, workdir):
+        """Create the local or remote files and return the operations."""
+        remote = "ec:/{:s}".format(self.name)
+        os.makedirs(standin.remote_path(remote))
+        suffix = "" if cpipeline is None else cpipeline.suffix
+        todo = list()
+        for i in range(self.nfiles):
+            local = os.path.join(workdir, "f{:d}".format(i))
+            with open(local, "wb") as fhl:
+                fhl.write(self._content(i))
+            target = "{:s}/f{:d}{:s}".format(remote, i, suffix)
+            if self.operation == "ecfsput":
+                todo.append((sh.ecfsput, (local, target)))
+            elif self.operation == "ectransput":
+                todo.append(
+                    (
+                        sh.ectransput,
+                        (local, target[3:]),
+                        dict(gateway="standin", remote="standin", sync=True),
+                    )
+                )
+            elif self.operation == "ectransqueue":
+                todo.append((local, target[3:]))
+            else:
+                if cpipeline is None:
+                    shutil.copyfile(local, standin.remote_path(target))
+                else:
+                    cpipeline.compress2file(
+                        local=local, destination=standin.remote_path(target)
+                    )
+                os.remove(local)
+                if self.operation == "ecfsget":
+                    todo.append((sh.ecfsget, (target, local)))
+                else:
+                    todo.append((sh.ecfstest, (target,)))
+        if self.operation == "ectransqueue":
+            # One action: submit all the transfers and wait for them
+            return [(self._disseminate, (sh, todo))]
+        return todo
+
+    def _disseminate(self, sh, todo):
+        """Submit the **todo** asynchronous transfers and wait for them."""
+
+        async def disseminate():
+            queue = sh.ectransqueue(pollfreq=self.QUEUE_POLLFREQ)
+            for source, target in todo:
+                queue.submit(
+                    source, target, gateway="standin", remote="standin"
+                )
+            return await queue.join()
+
+        transfers = asyncio.run(disseminate())
+        return all(t.status == ectrans_status.done for t in transfers)
+
+    def run(self, sh, standin):
+        """Run the benchmark case.
+
+        :param sh: The System object (with the ``ecfs`` and ``ectrans``
+                   addons loaded within the **standin** context)
+        :param StandInCommands standin: The active stand-in commands
+        :return: A dictionary with the ``walltime`` (in seconds), the
+                 ``latency`` (mean wall time of one operation, in seconds)
+                 and ``throughput`` (in bytes per second) results
+        """
+        cpipeline = (
+            None
+            if self.compression is None
+            else CompressionPipeline(sh, self.compression)
+        )
+        workdir = tempfile.mkdtemp(prefix="local_", dir=standin.tmpdir)
+        todo = self._prepare(sh, standin, cpipeline, workdir)
+        latencies = list()
+        t0 = time.monotonic()
+        for action in todo:
+            method, kargs = action[:2]
+            kwargs = dict(action[2]) if len(action) > 2 else dict()
+            if cpipeline is not None and self.operation in (
+                "ecfsget",
+                "ecfsput",
+                "ectransput",
+            ):
+                kwargs["cpipeline"] = cpipeline
+            t1 = time.monotonic()
+            if not method(*kargs, **kwargs):
+                raise RuntimeError(
+                    "{:s} failed: {!s}".format(self.name, kargs)
+                )
+            latencies.append(time.monotonic() - t1)
+        walltime = time.monotonic() - t0
+        return dict(
+            walltime=walltime,
+            latency=sum(latencies) / len(latencies),
+            throughput=(self.nfiles * self.size / walltime) if walltime else 0,
+        )
+
+
+def default_cases(
+    operations=BenchmarkCase.OPERATIONS,
+    nfiles=(1, 10),
+    sizes=(1024, 1024 * 1024),
+    compressions=(None, "gzip"),
+):
+    """The list of :class:`BenchmarkCase` objects for all the combinations.
+
+    Compression pipelines and file sizes are irrelevant for ``ecfstest``.
+    Compression pipelines are irrelevant for ``ectransqueue`` (for which
+    the latency is the time needed to disseminate all the files).
+    """
+    cases = list()
+    for operation in operations:
+        for n in nfiles:
+            if operation == "ecfstest":
+                cases.append(BenchmarkCase(operation, n, 0))
+                continue
+            for size in sizes:
+                if operation == "ectransqueue":
+                    cases.append(BenchmarkCase(operation, n, size))
+                    continue
+                for compression in compressions:
+                    cases.append(
+                        BenchmarkCase(operation, n, size, compression)
+                    )
+    return cases
+
+
+def run_benchmarks(cases, latency=0.0, bandwidth=0.0, repeat=3, sh=None):
+    """Run the **cases** against stand-in commands.
+
+    :param list cases: The :class:`BenchmarkCase` objects
+    :param float latency: The stand-in commands latency (in seconds)
+    :param float bandwidth: The stand-in commands bandwidth (in bytes per
+                            second, unlimited if zero)
+    :param int repeat: Each case is run **repeat** times (the best run is kept)
+    :param sh: The System object (default: the current session's one)
+    :return: A dictionary that associates cases names and their results
+             (see :meth:`BenchmarkCase.run`)
+    """
+    if sh is None:
+        sh = ticket().sh
+    results = dict()
+    for case in cases:
+        for _ in range(repeat):
+            with StandInCommands(latency=latency, bandwidth=bandwidth) as si:
+                # Fresh addons (they use the stand-in's metadata cache)
+                footprints.proxy.addon(kind="ecfs", shell=sh)
+                footprints.proxy.addon(kind="ectrans", shell=sh)
+                result = case.run(sh, si)
+            LOG.info("%s: %s", case.name, result)
+            best = results.get(case.name)
+            if best is None or result["walltime"] < best["walltime"]:
+                results[case.name] = result
+    return results
+
+
+def save_baseline(path, results, **conditions):
+    """Save **results** (and the benchmark **conditions**) into **path**."""
+    with open(path, "w") as fhjson:
+        json.dump(
+            dict(conditions=conditions, results=results),
+            fhjson,
+            indent=2,
+            sort_keys=True,
+        )
+
+
+def load_baseline(path):
+    """Load a baseline saved by :func:`save_baseline`.
+
+    :return: A tuple: the results and the benchmark conditions
+    """
+    with open(path) as fhjson:
+        baseline = json.load(fhjson)
+    return baseline["results"], baseline.get("conditions", dict())
+
+
+def compare_with_baseline(results, baseline, tolerance=0.25):
+    """Look for regressions.
+
+    A case regresses if its latency is more than **tolerance** (relative)
+    above the baseline's one or if its throughput is more than **tolerance**
+    below the baseline's one. Cases missing in the **baseline** are ignored.
+
+    :return: The list of the regressions descriptions
+    """
+    regressions = list()
+    for name, result in sorted(results.items()):
+        ref = baseline.get(name)
+        if ref is None:
+            continue
+        if result["latency"] > ref["latency"] * (1 + tolerance):
+            regressions.append(
+                "{:s}: latency {:.4f}s > {:.4f}s".format(
+                    name, result["latency"], ref["latency"]
+                )
+            )
+        if ref["throughput"] and result["throughput"] < ref["throughput"] * (
+            1 - tolerance
+        ):
+            regressions.append(
+                "{:s}: throughput {:.0f}B/s < {:.0f}B/s".format(
+                    name, result["throughput"], ref["throughput"]
+                )
+            )
+    return regressions
+
+
+def _size(text):
+    """Convert a size like ``4k`` or ``10M`` into a number of bytes."""
+    units = dict(k=1024, m=1024**2, g=1024**3)
+    text = text.strip().lower()
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def main(argv=None):
+    """The command line interface (see the module's documentation)."""
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ECfs/ECtrans addons against stand-in "
+        + "commands."
+    )
+    parser.add_argument(
+        "--operations",
+        default=",".join(BenchmarkCase.OPERATIONS),
+        help="Comma separated list of operations (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--nfiles",
+        default="1,10",
+        help="Comma separated list of file counts (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sizes",
+        default="1k,1M",
+        help="Comma separated list of file sizes (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--compressions",
+        default="raw,gzip",
+        help="Comma separated list of compression pipelines "
+        + "(raw means none, default: %(default)s)",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="Stand-in commands latency in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=_size,
+        default=0,
+        help="Stand-in commands bandwidth in bytes per second "
+        + "(0 means unlimited, default: %(default)s)",
+    )
+    parser.add_argument(
+        "--repeat",
+        type=int,
+        default=3,
+        help="Runs for each case (default: %(default)s)",
+    )
+    parser.add_argument("--save", help="Save the results as a baseline")
+    parser.add_argument("--baseline", help="Compare with this baseline")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=0.25,
+        help="Relative tolerance for regressions (default: %(default)s)",
+    )
+    args = parser.parse_args(argv)
+
+    cases = default_cases(
+        operations=args.operations.split(","),
+        nfiles=[int(n) for n in args.nfiles.split(",")],
+        sizes=[_size(s) for s in args.sizes.split(",")],
+        compressions=[
+            None if c == "raw" else c for c in args.compressions.split(",")
+        ],
+    )
+    results = run_benchmarks(
+        cases,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        repeat=args.repeat,
+    )
+    for case in cases:
+        result = results[case.name]
+        print(
+            "{:40s} latency={:8.4f}s throughput={:12.0f}B/s".format(
+                case.name, result["latency"], result["throughput"]
+            )
+        )
+    if args.save:
+        save_baseline(
+            args.save, results, latency=args.latency, bandwidth=args.bandwidth
+        )
+    if args.baseline:
+        baseline, conditions = load_baseline(args.baseline)
+        if conditions != dict(latency=args.latency, bandwidth=args.bandwidth):
+            LOG.warning("The baseline conditions differ: %s", conditions)
+        regressions = compare_with_baseline(
+            results, baseline, tolerance=args.tolerance
+        )
+        for regression in regressions:
+            print("REGRESSION " + regression)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
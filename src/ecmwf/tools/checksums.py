@@ -0,0 +1,104 @@
+"""
+Checksums computed while the data flow through the ECfs and ECtrans
+transfers (see :mod:`ecmwf.tools.streams`).
+
+If the ``ecfs_checksum`` (resp. ``ectrans_checksum``) key of the ``ecmwf``
+configuration section is set to a :mod:`hashlib` algorithm name (e.g.
+``sha256``), the checksum of the data actually stored (i.e. after
+compression) is computed by ``ecfsput`` (resp. ``ectransput``) and stored
+next to the file in a ``<file>.<algorithm>`` sidecar file (in the
+``sha256sum`` format). ``ecfsget`` (resp. ``ectransget``) computes the
+checksum of the data it receives and compares it with the sidecar file.
+
+The checksum is computed on the fly when the data are streamed, compressed
+or uncompressed. Otherwise (uncompressed files copied by the ECfs or ECtrans
+command itself), the file is read once more.
+"""
+
+import hashlib
+import logging
+
+from vortex.config import get_from_config_w_default
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+
+def checksum_algorithm(tube):
+    """The checksum algorithm used by **tube** (``None`` if disabled).
+
+    :param str tube: The tool used (``ecfs`` or ``ectrans``)
+    """
+    algorithm = get_from_config_w_default(
+        section="ecmwf", key="{:s}_checksum".format(tube), default=None
+    )
+    return algorithm or None
+
+
+def new_hasher(tube):
+    """A new :mod:`hashlib` object for **tube** (``None`` if disabled).
+
+    :param str tube: The tool used (``ecfs`` or ``ectrans``)
+    """
+    algorithm = checksum_algorithm(tube)
+    return None if algorithm is None else hashlib.new(algorithm)
+
+
+def update_from_file(hasher, path, blocksize=1024**2):
+    """Feed **hasher** with the content of the **path** local file.
+
+    This is only used when the data are neither streamed nor compressed
+    (the file is read once more).
+    """
+    with open(path, "rb") as fhin:
+        for block in iter(lambda: fhin.read(blocksize), b""):
+            hasher.update(block)
+    return hasher
+
+
+def sidecar_path(path, hasher):
+    """The path to the sidecar file of **path**."""
+    return "{:s}.{:s}".format(path, hasher.name)
+
+
+def sidecar_content(path, hasher):
+    """The content of the sidecar file of **path** (as bytes)."""
+    return "{:s}  {:s}\n".format(
+        hasher.hexdigest(), path.rstrip("/").split("/")[-1]
+    ).encode()
+
+
+def sidecar_checksum(content):
+    """Extract the checksum from the **content** of a sidecar file.
+
+    :return: The hexadecimal checksum (``None`` if the content is garbage)
+    """
+    words = content.decode(errors="replace").split()
+    return words[0].lower() if words else None
+
+
+def verify(path, hasher, content):
+    """Compare the checksum computed by **hasher** with the sidecar **content**.
+
+    :param str path: The file being checked (for the log)
+    :param hasher: The :mod:`hashlib` object fed with the received data
+    :param bytes content: The sidecar file content (``None`` if missing)
+    :return: ``False`` if the checksums differ
+    """
+    if content is None:
+        LOG.warning("No %s checksum is available for %s", hasher.name, path)
+        return True
+    expected = sidecar_checksum(content)
+    if expected != hasher.hexdigest():
+        LOG.error(
+            "%s checksum mismatch for %s (expected: %s, received: %s)",
+            hasher.name,
+            path,
+            expected,
+            hasher.hexdigest(),
+        )
+        return False
+    LOG.debug("%s checksum verified for %s", hasher.name, path)
+    return True
@@ -0,0 +1,405 @@
+"""
+Long-lived helper processes that run ECfs/ECtrans commands on our behalf.
+
+Starting a new ``ecp``/``els``/``etest``/... process for each operation
+means paying for the authentication and connection setup every time. When
+the ``<command>_session_command`` key of the ``ecmwf`` configuration section
+is set (e.g. ``ecfs_session_command``), the
+:class:`~ecmwf.tools.interfaces.ECMWFInterface` objects of this family send the command lines to a pool of persistent helper
+processes instead (``<command>_session_size`` helpers at most, default: 1).
+
+The helper reads one JSON-encoded request per line on its standard input::
+
+    {"argv": ["els", "-1", "ec:/user/dir"], "cwd": "/current/dir", "env": {...}}
+
+and answers with one JSON-encoded line on its standard output::
+
+    {"rc": 0, "stdout": "file1\\nfile2\\n", "stderr": ""}
+
+Lines that do not start with ``{`` are ignored (e.g. banners printed when
+the helper starts). An answer must be received within
+``<command>_session_timeout`` seconds (default: 3600).
+
+The command must be run in the ``cwd`` directory with the ``env``
+environment variables (the caller's, at the time of the request): the
+command line may refer to relative local paths.
+
+If the helper process can not be reached before the request is sent, the
+command is run in a new process instead. Once the request is sent, the
+command is never run a second time (it may not be idempotent): a helper
+that dies, hangs or answers garbage makes the command fail.
+
+Helper processes are never shared with forked child processes (the pools
+are specific to each process ID).
+
+A reference implementation is provided by this module
+(``python -m vortex_ecmwf.tools.cmdsessions``). By default, it runs each
+command in a new process (only the start of the Python interpreter is
+saved). With ``--backend package.module:factory``, the factory is called
+once when the helper starts and the object it returns is called in-process
+for each request (with the command line and the ``cwd`` and ``env``
+keyword arguments, it returns a tuple: the return code, the standard output
+and the standard error text): this is where a
+site-specific backend keeps an authenticated connection to the server.
+"""
+
+import argparse
+import atexit
+import collections
+import importlib
+import json
+import logging
+import os
+import select
+import shlex
+import subprocess
+import sys
+import threading
+import time
+
+from vortex.config import get_from_config_w_default
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+
+class CommandSessionError(Exception):
+    """The helper process died, hung or returned garbage."""
+
+    def __init__(self, message, sent=False):
+        """
+        :param str message: The error message
+        :param bool sent: Was the request sent to the helper process (if so,
+                          the command may have been run) ?
+        """
+        super().__init__(message)
+        self.sent = sent
+
+
+class CommandSession:
+    """A persistent helper process that runs commands."""
+
+    def __init__(self, helper):
+        """
+        :param list helper: The helper process command line
+        """
+        self._helper = helper
+        self._p = subprocess.Popen(
+            helper,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            bufsize=0,
+        )
+        self._buffer = b""
+
+    @property
+    def pid(self):
+        """The helper process ID."""
+        return self._p.pid
+
+    @property
+    def alive(self):
+        """Is the helper process still running ?"""
+        return self._p.poll() is None
+
+    def _readline(self, deadline):
+        """Read one line of the helper's output (before **deadline**)."""
+        fd = self._p.stdout.fileno()
+        while b"\n" not in self._buffer:
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if (
+                    remaining <= 0
+                    or not select.select([fd], [], [], remaining)[0]
+                ):
+                    raise CommandSessionError(
+                        "Helper {:d} did not answer in time".format(self.pid),
+                        sent=True,
+                    )
+            chunk = os.read(fd, 65536)
+            if not chunk:
+                line, self._buffer = self._buffer, b""
+                return line.decode(errors="replace")
+            self._buffer += chunk
+        line, self._buffer = self._buffer.split(b"\n", 1)
+        return line.decode(errors="replace") + "\n"
+
+    def run(self, argv, timeout=None, cwd=None, env=None):
+        """Run the **argv** command in the helper process.
+
+        :param str cwd: The directory where the command runs
+        :param dict env: The command's environment variables
+        :param float timeout: The maximum time to wait for the answer (in
+                              seconds, unlimited if ``None``)
+        :return: a tuple: the return code, the standard output and the
+                 standard error text.
+        :raises CommandSessionError: if anything goes wrong (see its
+                                     **sent** attribute)
+        """
+        if not self.alive:
+            raise CommandSessionError("Helper {:d} is dead".format(self.pid))
+        request = memoryview(
+            (
+                json.dumps(dict(argv=list(argv), cwd=cwd, env=env)) + "\n"
+            ).encode()
+        )
+        try:
+            while request:
+                request = request[self._p.stdin.write(request) :]
+        except OSError as e:
+            raise CommandSessionError(
+                "Helper {:d} is unreachable: {!s}".format(self.pid, e)
+            )
+        deadline = None if timeout is None else time.monotonic() + timeout
+        try:
+            answer = self._readline(deadline)
+            while answer and not answer.startswith("{"):
+                LOG.debug("Helper %d said: %s", self.pid, answer.rstrip())
+                answer = self._readline(deadline)
+        except OSError as e:
+            raise CommandSessionError(
+                "Helper {:d} is unreachable: {!s}".format(self.pid, e),
+                sent=True,
+            )
+        try:
+            answer = json.loads(answer)
+            return answer["rc"], answer["stdout"], answer["stderr"]
+        except (ValueError, KeyError, TypeError):
+            raise CommandSessionError(
+                "Helper {:d} answered: {!r}".format(self.pid, answer),
+                sent=True,
+            )
+
+    def close(self, force=False):
+        """Stop the helper process.
+
+        :param bool force: Kill the helper process right away
+        """
+        try:
+            self._p.stdin.close()
+        except OSError:
+            pass
+        if force:
+            self._p.kill()
+        try:
+            self._p.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            self._p.kill()
+            self._p.wait()
+        self._p.stdout.close()
+
+
+class CommandSessionsPool:
+    """A bounded pool of :class:`CommandSession` objects.
+
+    Helper processes are started on demand (up to **maxsize**) and reused.
+    When all of them are busy, callers wait for one to become available.
+    """
+
+    def __init__(self, helper, maxsize=1, timeout=None):
+        """
+        :param list helper: The helper process command line
+        :param int maxsize: The maximum number of helper processes
+        :param float timeout: The maximum time to wait for an answer (in
+                              seconds, unlimited if ``None``)
+        """
+        self._helper = helper
+        self._maxsize = maxsize
+        self._timeout = timeout
+        self._idle = collections.deque()
+        self._nsessions = 0
+        self._cond = threading.Condition()
+
+    @property
+    def helper(self):
+        """The helper process command line."""
+        return list(self._helper)
+
+    @property
+    def maxsize(self):
+        """The maximum number of helper processes."""
+        return self._maxsize
+
+    @property
+    def pids(self):
+        """The process IDs of the idle helper processes."""
+        with self._cond:
+            return [s.pid for s in self._idle]
+
+    def _acquire(self):
+        with self._cond:
+            while not self._idle and self._nsessions >= self._maxsize:
+                self._cond.wait()
+            if self._idle:
+                return self._idle.pop()
+            self._nsessions += 1
+        try:
+            return CommandSession(self._helper)
+        except OSError as e:
+            self._release(None)
+            raise CommandSessionError(
+                "Could not start {!s}: {!s}".format(self._helper, e)
+            )
+
+    def _release(self, session):
+        with self._cond:
+            if session is None:
+                self._nsessions -= 1
+            else:
+                self._idle.append(session)
+            self._cond.notify()
+
+    def run(self, argv, cwd=None, env=None):
+        """Run the **argv** command in one of the helper processes.
+
+        :param str cwd: The directory where the command runs
+        :param dict env: The command's environment variables
+
+        A helper process that fails is discarded (and
+        :class:`CommandSessionError` is raised).
+
+        :return: a tuple: the return code, the standard output and the
+                 standard error text.
+        """
+        session = self._acquire()
+        try:
+            result = session.run(argv, timeout=self._timeout, cwd=cwd, env=env)
+        except CommandSessionError:
+            session.close(force=True)
+            self._release(None)
+            raise
+        self._release(session)
+        return result
+
+    def close(self):
+        """Stop all the idle helper processes."""
+        with self._cond:
+            while self._idle:
+                self._idle.pop().close()
+                self._nsessions -= 1
+
+
+_POOLS = dict()
+_POOLS_LOCK = threading.Lock()
+_GENERATION = 0
+
+
+def sessions_generation():
+    """A counter that changes whenever the pools are discarded (see :func:`close_all`).
+
+    Objects that keep a reference to a pool may check it to find out if
+    their reference is obsolete.
+    """
+    return _GENERATION
+
+
+def sessions_pool(command):
+    """Return the pool of helper processes for the **command** family.
+
+    :param str command: The command family (e.g. ``ecfs``)
+    :return: A :class:`CommandSessionsPool` object (or ``None`` if no helper
+             process is configured for this family)
+    """
+    helper = get_from_config_w_default(
+        section="ecmwf",
+        key="{:s}_session_command".format(command),
+        default=None,
+    )
+    if not helper:
+        return None
+    maxsize = int(
+        get_from_config_w_default(
+            section="ecmwf",
+            key="{:s}_session_size".format(command),
+            default=1,
+        )
+    )
+    timeout = float(
+        get_from_config_w_default(
+            section="ecmwf",
+            key="{:s}_session_timeout".format(command),
+            default=3600,
+        )
+    )
+    if isinstance(helper, str):
+        helper = shlex.split(helper)
+    # Helper processes must not be shared with forked child processes
+    key = (os.getpid(), command, tuple(helper), maxsize, timeout)
+    with _POOLS_LOCK:
+        if key not in _POOLS:
+            _POOLS[key] = CommandSessionsPool(
+                list(helper), maxsize=maxsize, timeout=timeout
+            )
+        return _POOLS[key]
+
+
+@atexit.register
+def close_all():
+    """Stop all the helper processes (started by the current process)."""
+    global _GENERATION
+    with _POOLS_LOCK:
+        for key, pool in _POOLS.items():
+            if key[0] == os.getpid():
+                pool.close()
+        _POOLS.clear()
+        _GENERATION += 1
+
+
+def _subprocess_backend():
+    """The default backend of :func:`main`: run each command in a new process."""
+
+    def _run(argv, cwd=None, env=None):
+        p = subprocess.run(
+            argv,
+            cwd=cwd,
+            env=env,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        return p.returncode, p.stdout, p.stderr
+
+    return _run
+
+
+def _load_backend(spec):
+    """Call the ``package.module:factory`` **spec** factory."""
+    modname, _, factory = spec.partition(":")
+    return getattr(importlib.import_module(modname), factory)()
+
+
+def main(argv=None):
+    """Reference helper: run the requested commands one after the other."""
+    parser = argparse.ArgumentParser(
+        description="Run ECfs/ECtrans commands on behalf of Vortex"
+    )
+    parser.add_argument(
+        "--backend",
+        help="The package.module:factory that creates the in-process "
+        + "backend (default: run each command in a new process)",
+    )
+    args = parser.parse_args(argv)
+    backend = (
+        _subprocess_backend()
+        if args.backend is None
+        else _load_backend(args.backend)
+    )
+    for line in sys.stdin:
+        try:
+            request = json.loads(line)
+            rc, stdout, stderr = backend(
+                request["argv"],
+                cwd=request.get("cwd"),
+                env=request.get("env"),
+            )
+            answer = dict(rc=rc, stdout=stdout, stderr=stderr)
+        except (ValueError, KeyError, TypeError, OSError) as e:
+            answer = dict(rc=127, stdout="", stderr=str(e) + "\n")
+        sys.stdout.write(json.dumps(answer) + "\n")
+        sys.stdout.flush()
+
+
+if __name__ == "__main__":
+    main()
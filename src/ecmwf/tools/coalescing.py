@@ -0,0 +1,223 @@
+"""
+Coalescing of the concurrent identical ECfs/ECtrans get requests.
+
+When several tasks of the same node (threads or processes) ask for the same
+remote file at the same moment, only the first request actually transfers
+the file. The others wait for it to complete and get a copy (or a
+copy-on-write clone) of the file it retrieved.
+
+Each request is associated with a lock file (in the directory given by the
+``coalescing_path`` key of the ``ecmwf`` configuration section, default:
+a ``vortex_ecmwf_coalescing_<uid>`` directory in the system's temporary
+directory). A request that finds the lock free is the leader: it transfers
+the file. A request that has to wait for the lock registers itself as a
+waiter. If there are waiters, the leader makes a private snapshot of its
+result (next to the lock file) and publishes it. The waiters reuse the
+snapshot published while they were waiting (provided that it is still there
+and unchanged). If there is no such snapshot (e.g. the leader failed), a
+waiter transfers the file itself. The lock file, the snapshot and its
+description are removed when the last request is done.
+
+Coalescing is disabled unless the ``ecfs_coalescing`` (resp.
+``ectrans_coalescing``) key is true.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from vortex.config import get_from_config_w_default
+
+from .ecfscache import link_or_copy
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+#: The ways the snapshot of the leader's file is made and the ways a waiting
+#: request gets its file (hard links are not used since the files may be
+#: modified in place)
+COALESCING_LINKS = ("reflink", "copy")
+
+
+def _coalescing_path():
+    path = get_from_config_w_default(
+        section="ecmwf", key="coalescing_path", default=None
+    )
+    if not path:
+        path = os.path.join(
+            tempfile.gettempdir(),
+            "vortex_ecmwf_coalescing_{:d}".format(os.getuid()),
+        )
+    return path
+
+
+def coalescing_key(tube, source, **kwargs):
+    """The key that identifies a get request.
+
+    :param str tube: The tool used (``ecfs`` or ``ectrans``)
+    :param str source: The remote file
+    :param kwargs: Anything that alters the result (e.g. the compression
+                   pipeline description or the ECtrans remote)
+    """
+    return hashlib.sha256(
+        json.dumps(
+            [tube, source, kwargs], sort_keys=True, default=str
+        ).encode()
+    ).hexdigest()
+
+
+def _reuse(recordfile, since, target):
+    """Create **target** from the snapshot published after **since** (if any)."""
+    try:
+        with open(recordfile) as fhrecord:
+            record = json.load(fhrecord)
+        if record["stamp"] < since:
+            return False
+        st = os.stat(record["path"])
+        if (st.st_size, st.st_mtime_ns) != (record["size"], record["mtime"]):
+            LOG.debug("%s was modified in the meantime", record["path"])
+            return False
+        link_or_copy(record["path"], target, COALESCING_LINKS)
+    except FileNotFoundError:
+        return False
+    except (OSError, ValueError, KeyError) as e:
+        LOG.debug("Could not reuse the result of %s: %s", recordfile, e)
+        return False
+    LOG.info("Coalesced request: %s copied from %s", target, record["path"])
+    return True
+
+
+def _publish(recordfile, snapshot, target):
+    """Publish a snapshot of **target** as the result of the request."""
+    link_or_copy(target, snapshot, COALESCING_LINKS)
+    st = os.stat(snapshot)
+    with open(recordfile + ".tmp", "w") as fhrecord:
+        json.dump(
+            dict(
+                path=snapshot,
+                size=st.st_size,
+                mtime=st.st_mtime_ns,
+                stamp=time.time(),
+            ),
+            fhrecord,
+        )
+    os.replace(recordfile + ".tmp", recordfile)
+
+
+def _lockpaths(key):
+    lockdir = _coalescing_path()
+    os.makedirs(lockdir, exist_ok=True)
+    return {
+        kind: os.path.join(lockdir, key + suffix)
+        for kind, suffix in (
+            ("lock", ".lock"),
+            ("record", ".json"),
+            ("snapshot", ".data"),
+            ("waiters", ".waiters"),
+        )
+    }
+
+
+def _waiters(paths):
+    """Is any request waiting for the lock ?"""
+    try:
+        return bool(os.listdir(paths["waiters"]))
+    except FileNotFoundError:
+        return False
+
+
+def _cleanup(paths):
+    """Remove all the files associated with a request (the lock is held)."""
+    for kind in ("record", "snapshot", "lock"):
+        with contextlib.suppress(FileNotFoundError):
+            os.remove(paths[kind])
+    shutil.rmtree(paths["waiters"], ignore_errors=True)
+
+
+def _acquire(paths, marker):
+    """Acquire the lock of a request.
+
+    If the lock is already held, the **marker** file is created in the
+    waiters directory before waiting.
+
+    :return: The lock file object and the time at which the waiting started
+             (``None`` if the lock was free)
+    """
+    since = None
+    while True:
+        fhlock = open(paths["lock"], "a")
+        try:
+            fcntl.flock(fhlock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            if since is None:
+                since = time.time()
+                os.makedirs(paths["waiters"], exist_ok=True)
+                open(marker, "w").close()
+            LOG.debug("Waiting for an identical request (%s)", paths["lock"])
+            fcntl.flock(fhlock, fcntl.LOCK_EX)
+        try:
+            current = os.stat(paths["lock"]).st_ino
+        except FileNotFoundError:
+            current = None
+        if current == os.fstat(fhlock.fileno()).st_ino:
+            return fhlock, since
+        # The lock file was removed in the meantime
+        fcntl.flock(fhlock, fcntl.LOCK_UN)
+        fhlock.close()
+
+
+def coalesced(tube, key, target, fetch):
+    """Run **fetch** unless an identical request is in progress.
+
+    :param str tube: The tool used (``ecfs`` or ``ectrans``)
+    :param str key: The request key (see :func:`coalescing_key`)
+    :param target: The local file to be created (requests whose target is
+                   not a filename are not coalesced)
+    :param fetch: A callable that creates **target** and returns a return
+                  code
+    :return: return code
+    """
+    if not isinstance(target, str) or not get_from_config_w_default(
+        section="ecmwf", key="{:s}_coalescing".format(tube), default=False
+    ):
+        return fetch()
+    try:
+        paths = _lockpaths(key)
+        marker = os.path.join(
+            paths["waiters"],
+            "{:d}.{:d}".format(os.getpid(), threading.get_ident()),
+        )
+        fhlock, since = _acquire(paths, marker)
+    except OSError as e:
+        LOG.warning("Request coalescing failure: %s", e)
+        return fetch()
+    with fhlock:
+        try:
+            if since is not None:
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(marker)
+                if _reuse(paths["record"], since, target):
+                    return True
+            rc = fetch()
+            if rc and os.path.isfile(target) and _waiters(paths):
+                try:
+                    _publish(paths["record"], paths["snapshot"], target)
+                except OSError as e:
+                    LOG.warning("Request coalescing failure: %s", e)
+            return rc
+        finally:
+            if not _waiters(paths):
+                try:
+                    _cleanup(paths)
+                except OSError as e:
+                    LOG.warning("Request coalescing failure: %s", e)
+            fcntl.flock(fhlock, fcntl.LOCK_UN)
@@ -0,0 +1,101 @@
+"""
+Delayed actions handlers dedicated to ECMWF' storage systems.
+
+See :mod:`vortex.tools.delayedactions` for a description of the delayed
+actions mechanism.
+"""
+
+import logging
+
+from vortex.tools.delayedactions import (
+    AbstractFileBasedDelayedActionsHandler,
+    d_action_status,
+)
+from vortex.tools.systems import ExecutionError
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+
+class EcfsDelayedGetHandler(AbstractFileBasedDelayedActionsHandler):
+    """
+    Accumulate "GET" requests for several ECfs files and fetch them using as
+    few ``ecp`` commands as possible
+    (see :meth:`ecmwf.tools.ecfs.ECfsTools.ecfsbatchcp`).
+
+    :note: The *request* needs to be a two-elements tuple where the first element
+           is the ECfs path to the file that should be fetched and the second
+           element the file format.
+    :note: The **result** returned by the :meth:`retrieve` method will be the
+           path to the temporary file where the resource has been fetched.
+    """
+
+    _footprint = dict(
+        info="Fetch multiple files using ECfs.",
+        attr=dict(
+            kind=dict(
+                values=[
+                    "archive",
+                ],
+            ),
+            storage=dict(),
+            goal=dict(
+                values=[
+                    "get",
+                ]
+            ),
+            tube=dict(
+                values=[
+                    "ecfs",
+                ],
+            ),
+        ),
+    )
+
+    @property
+    def resultid_stamp(self):
+        return "ecfsget_{:s}".format(self.storage)
+
+    def register(self, request):
+        """Create a new :class:`DelayedAction` object from a user's **request**."""
+        assert isinstance(request, (tuple, list)) and len(request) == 2, (
+            "Request needs to be a two element tuple or list (location, format)"
+        )
+        # Check for duplicated entries...
+        target = request[0]
+        for v in self._resultsmap.values():
+            if target == v.request[0]:
+                return None
+        # Ok, let's proceed...
+        return super().register(request)
+
+    def finalise(self, *r_ids):  # @UnusedVariable
+        """Given a **r_ids** list of delayed action IDs, wait upon actions completion."""
+        todo = [
+            k
+            for k, v in self._resultsmap.items()
+            if v.status == d_action_status.void
+        ]
+        rc = list()
+        if todo:
+            sources = [self._resultsmap[k].request[0] for k in todo]
+            destinations = [self._resultsmap[k].result for k in todo]
+            try:
+                LOG.info(
+                    "Running the ECfs batch command (%d files).", len(todo)
+                )
+                rc = self.system.ecfsbatchcp(sources, destinations)
+            except (OSError, ExecutionError):
+                rc = [
+                    None,
+                ] * len(sources)
+            for i, k in enumerate(todo):
+                if rc[i] is True:
+                    self._resultsmap[k].mark_as_done()
+                elif rc[i] is False:
+                    self._resultsmap[k].mark_as_failed()
+                else:
+                    self._resultsmap[k].mark_as_unclear()
+        return rc
@@ -2,16 +2,40 @@
 System Addons to support ECMWF' ECFS archiving system.
 """
 
+import collections
+import concurrent.futures
 import contextlib
+import functools
+import io
+import json
 import logging
+import os
+import posixpath
 import re
-import tempfile
+import stat
+import threading
+import time
 
 import footprints
+from vortex.config import get_from_config_w_default
 from vortex.tools import addons
-from vortex.tools.systems import fmtshcmd
+from vortex.tools.systems import ExecutionError, fmtshcmd
 
+from . import checksums, metrics
+from .coalescing import coalesced, coalescing_key
+from .ecfsmeta import ecfsmeta_from_config
 from .interfaces import ECfs
+from .streams import (
+    FileRangeReader,
+    FileRangeWriter,
+    compress2fifo,
+    compress2file,
+    fifo2fileobj,
+    fifo2uncompress,
+    file2uncompress,
+    fileobj2fifo,
+    fileobj_path,
+)
 
 #: No automatic export
 __all__ = []
@@ -37,6 +61,190 @@ class ECfsConfigurationError(ECfsError):
     pass
 
 
+class ECfsDirectoriesMemo:
+    """Remember the ECfs directories that are known to exist.
+
+    The memo is bounded: when it holds more than **maxsize** directories
+    (if omitted, the ``ecfs_dirmemo_size`` key of the ``ecmwf``
+    configuration section is used, defaults to 1000), the least recently
+    used ones are forgotten.
+
+    A process-wide instance is available as :data:`ecfs_known_directories`.
+    """
+
+    def __init__(self, maxsize=None):
+        """
+        :param int maxsize: The maximum number of directories remembered
+        """
+        self._maxsize = maxsize
+        self._lock = threading.Lock()
+        self._directories = collections.OrderedDict()
+
+    @property
+    def maxsize(self):
+        """The maximum number of directories remembered."""
+        if self._maxsize is None:
+            return int(
+                get_from_config_w_default(
+                    section="ecmwf", key="ecfs_dirmemo_size", default=1000
+                )
+            )
+        return self._maxsize
+
+    def __contains__(self, path):
+        path = path.rstrip("/")
+        with self._lock:
+            if path in self._directories:
+                self._directories.move_to_end(path)
+                return True
+        return False
+
+    def __len__(self):
+        return len(self._directories)
+
+    def add(self, path):
+        """Record that the **path** directory exists (and its ancestors)."""
+        path = path.rstrip("/")
+        if not path:
+            return
+        lineage = [path]
+        while True:
+            parent = posixpath.dirname(lineage[-1])
+            if not parent or parent == lineage[-1] or parent.endswith(":"):
+                break
+            lineage.append(parent)
+        maxsize = self.maxsize
+        with self._lock:
+            # The leaf ends up being the most recently used directory
+            for directory in reversed(lineage):
+                self._directories[directory] = True
+                self._directories.move_to_end(directory)
+            while len(self._directories) > maxsize:
+                self._directories.popitem(last=False)
+
+    def discard(self, path):
+        """Forget about the **path** directory and its subdirectories."""
+        path = path.rstrip("/")
+        prefix = path + "/"
+        with self._lock:
+            for known in [
+                d
+                for d in self._directories
+                if d == path or d.startswith(prefix)
+            ]:
+                del self._directories[known]
+
+    def clear(self):
+        """Forget about all directories."""
+        with self._lock:
+            self._directories.clear()
+
+
+#: The ECfs directories known to exist (shared by all :class:`ECfsTools` objects)
+ecfs_known_directories = ECfsDirectoriesMemo()
+
+
+class ECfsChmodBatch:
+    """The outcome of a :meth:`ECfsTools.ecfschmod_batch` block."""
+
+    def __init__(self):
+        #: The return code of the permission changes applied at the end of
+        #: the block (``None`` until then, always ``True`` for nested blocks)
+        self.rc = None
+
+
+class ECfsWorkersPool:
+    """Run ECfs operations concurrently in a pool of threads.
+
+    Operations are started in the order they were submitted and the number
+    of operations running at the same time is bounded by **maxworkers**
+    (if omitted, the ``ecfs_maxworkers`` key of the ``ecmwf`` configuration
+    section is used, defaults to 4). Example::
+
+        with sh.ecfsworkers() as pool:
+            for source, target in todo:
+                pool.ecfsget(source, target)
+        rcs = pool.results()
+
+    :note: Since the threads share the current working directory, it must not
+           be changed while operations are pending.
+    """
+
+    def __init__(self, sh, maxworkers=None):
+        """
+        :param sh: The System object that will run the ECfs operations
+        :param int maxworkers: The maximum number of concurrent operations
+        """
+        if maxworkers is None:
+            maxworkers = get_from_config_w_default(
+                section="ecmwf", key="ecfs_maxworkers", default=4
+            )
+        self._sh = sh
+        self._maxworkers = int(maxworkers)
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=self._maxworkers, thread_name_prefix="ecfs_worker"
+        )
+        self._futures = list()
+
+    @property
+    def maxworkers(self):
+        """The maximum number of concurrent operations."""
+        return self._maxworkers
+
+    @property
+    def futures(self):
+        """The list of futures created so far (in submission order)."""
+        return list(self._futures)
+
+    def submit(self, method, *kargs, **kwargs):
+        """Submit a call to the **method** System method.
+
+        :return: A :class:`concurrent.futures.Future` object
+        """
+        future = self._executor.submit(
+            getattr(self._sh, method), *kargs, **kwargs
+        )
+        self._futures.append(future)
+        return future
+
+    def ecfsget(self, source, target, **kwargs):
+        """Submit an :meth:`ECfsTools.ecfsget` operation."""
+        return self.submit("ecfsget", source, target, **kwargs)
+
+    def ecfsput(self, source, target, **kwargs):
+        """Submit an :meth:`ECfsTools.ecfsput` operation."""
+        return self.submit("ecfsput", source, target, **kwargs)
+
+    def ecfstest(self, item, **kwargs):
+        """Submit an :meth:`ECfsTools.ecfstest` operation."""
+        return self.submit("ecfstest", item, **kwargs)
+
+    def results(self):
+        """Wait for all the submitted operations and return their results.
+
+        The results are returned in submission order. If an operation raised
+        an exception, the exception object is returned in place of its result.
+        """
+        results = list()
+        for future in self._futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                LOG.error("An ECfs operation failed: %s", str(e))
+                results.append(e)
+        return results
+
+    def shutdown(self, wait=True):
+        """Release the pool's threads."""
+        self._executor.shutdown(wait=wait)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown(wait=True)
+
+
 class ECfsTools(addons.Addon):
     """
     Handle ECfs use properly within Vortex.
@@ -51,14 +259,110 @@ class ECfsTools(addons.Addon):
         ),
     )
 
+    def __init__(self, *kargs, **kwargs):
+        super().__init__(*kargs, **kwargs)
+        self._ecfsmetacache = ecfsmeta_from_config()
+        self._ecfschmod_lock = threading.Lock()
+        self._ecfschmod_pending = dict()
+        self._ecfschmod_depth = 0
+        self._ecfsinterface = ECfs(system=self.sh)
+
+    @property
+    def ecfsmetacache(self):
+        """The ECfs metadata cache (``None`` if it is disabled).
+
+        See :func:`ecmwf.tools.ecfsmeta.ecfsmeta_from_config`.
+        """
+        return self._ecfsmetacache
+
+    def _ecfsdirmemo_update(self, target, rc):
+        """Update the known directories given the outcome of a copy."""
+        if isinstance(target, str) and self._ecfspath_isremote(target):
+            if rc:
+                ecfs_known_directories.add(self.sh.path.dirname(target))
+            else:
+                # Maybe the directory was removed by someone else
+                ecfs_known_directories.discard(self.sh.path.dirname(target))
+
+    def _ecfsmeta_invalidate(self, *items):
+        """Forget the cached metadata about ECfs **items**."""
+        if self._ecfsmetacache is not None:
+            for item in items:
+                if isinstance(item, str) and self._ecfspath_isremote(item):
+                    self._ecfsmetacache.invalidate(item)
+
+    def ecfsworkers(self, maxworkers=None):
+        """Return a pool that runs ECfs operations concurrently.
+
+        :param int maxworkers: The maximum number of concurrent operations
+        :return: An :class:`ECfsWorkersPool` object
+        """
+        return ECfsWorkersPool(self.sh, maxworkers=maxworkers)
+
+    def _ecfsdir_names(self, dirname):
+        """The names contained in the **dirname** ECfs directory.
+
+        The directory content is recorded in the metadata cache (if it is
+        enabled). ``None`` is returned if the listing fails.
+        """
+        ecfs = self._ecfsinterface
+        output = ecfs(
+            command="els",
+            list_args=[
+                dirname,
+            ],
+            dict_args=dict(),
+            list_options=[
+                "1",
+            ],
+            fatal=False,
+            capture=True,
+            silent=True,
+        )
+        if output is False:
+            return None
+        names = [
+            self.sh.path.basename(line.strip().rstrip("/"))
+            for line in output
+            if line.strip()
+        ]
+        if self._ecfsmetacache is not None:
+            self._ecfsmetacache.store_directory(dirname, names)
+        return names
+
+    def _ecfstest_fromdir(self, item):
+        """Test the existence of **item** by listing its parent directory.
+
+        ``None`` is returned if the listing fails.
+        """
+        names = self._ecfsdir_names(self.sh.path.dirname(item))
+        if names is None:
+            return None
+        return self.sh.path.basename(item) in names
+
+    @metrics.measured("ecfs", "test", answers=True)
     def ecfstest(self, item, options=None):
         """Test a state of the file provided using ECfs.
 
+        If the metadata cache is enabled, existence tests are answered by the
+        cache whenever possible (only positive answers are cached). On a
+        cache miss, the parent directory is listed (so that the later tests
+        on files of the same directory are answered by the cache).
+
         :param item: file to be tested
         :param options: list of options to be used by the test (default "r": test existence)
         :return: return code
         """
-        ecfs = ECfs(system=self.sh)
+        cacheable = self._ecfsmetacache is not None and (
+            not options or list(options) == ["r"]
+        )
+        if cacheable:
+            rc = self._ecfsmetacache.test(item)
+            if rc is None:
+                rc = self._ecfstest_fromdir(item)
+            if rc is not None:
+                return rc
+        ecfs = self._ecfsinterface
         command = "etest"
         list_args = [
             item,
@@ -77,19 +381,25 @@ class ECfsTools(addons.Addon):
             fatal=False,
             silent=True,
         )
+        if cacheable:
+            self._ecfsmetacache.store_test(item, rc)
         return rc
 
+    @metrics.measured("ecfs", "chmod")
     def ecfschmod(self, mode, location, options=None):
         """Change permissions on the location using Ecfs.
 
         :param mode: The new permissions (UNIX style e.g. 644)
-        :param location: target file
+        :param location: target file (or a list of target files)
         :param options: list of options to be used (default none)
         :return: return code
         """
-        ecfs = ECfs(system=self.sh)
+        ecfs = self._ecfsinterface
         command = "echmod"
-        list_args = [mode, location]
+        if isinstance(location, str):
+            list_args = [mode, location]
+        else:
+            list_args = [mode] + list(location)
         if options is None:
             list_options = list()
         else:
@@ -101,14 +411,120 @@ class ECfsTools(addons.Addon):
             list_options=list_options,
         )
 
+    def _ecfschmod_bulk(self, mode, locations):
+        """Change permissions on many **locations** (one by one on failure)."""
+        try:
+            return self.ecfschmod(mode, locations)
+        except ExecutionError:
+            rc = True
+            for location in locations:
+                try:
+                    rc = self.ecfschmod(mode, location) and rc
+                except ExecutionError:
+                    LOG.error("ECfs chmod failed: %s", location)
+                    rc = False
+            return rc
+
+    @contextlib.contextmanager
+    def ecfschmod_batch(self):
+        """Defer the permission changes within a block (see :meth:`ecfschmod_deferred`).
+
+        The pending changes are applied when the outermost block ends. Example::
+
+            with sh.ecfschmod_batch() as batch:
+                for source, target in todo:
+                    sh.ecfsinsert(source, target)
+            if not batch.rc:
+                ...
+
+        :return: An :class:`ECfsChmodBatch` object
+        """
+        batch = ECfsChmodBatch()
+        with self._ecfschmod_lock:
+            self._ecfschmod_depth += 1
+        try:
+            yield batch
+        finally:
+            with self._ecfschmod_lock:
+                self._ecfschmod_depth -= 1
+                outermost = self._ecfschmod_depth == 0
+            batch.rc = self.ecfschmod_flush() if outermost else True
+
+    def ecfschmod_deferred(self, mode, location):
+        """Change permissions on the location later on (in bulk).
+
+        Within a :meth:`ecfschmod_batch` block, changes are accumulated and
+        applied by :meth:`ecfschmod_flush` (one ``echmod`` command for as many
+        as ``ecfs_batchsize`` files). The flush occurs when enough changes
+        are pending and at the end of the block. Outside of such a block, the
+        change is applied right away.
+
+        If the ``ecfs_chmod_deferred`` key of the ``ecmwf`` configuration
+        section is false, the change is always applied right away.
+
+        :param mode: The new permissions (UNIX style e.g. 644)
+        :param location: target file
+        :return: return code (always True if the change is deferred)
+        """
+        if not get_from_config_w_default(
+            section="ecmwf", key="ecfs_chmod_deferred", default=True
+        ):
+            return self.ecfschmod(mode, location)
+        batchsize = get_from_config_w_default(
+            section="ecmwf", key="ecfs_batchsize", default=200
+        )
+        with self._ecfschmod_lock:
+            deferred = self._ecfschmod_depth > 0
+            if deferred:
+                self._ecfschmod_pending[location] = mode
+                flush = len(self._ecfschmod_pending) >= batchsize
+        if not deferred:
+            return self.ecfschmod(mode, location)
+        if flush:
+            return self.ecfschmod_flush()
+        return True
+
+    def ecfschmod_flush(self):
+        """Apply the permission changes left pending by :meth:`ecfschmod_deferred`.
+
+        :return: return code (``False`` if any of the changes failed)
+        """
+        with self._ecfschmod_lock:
+            pending = self._ecfschmod_pending
+            self._ecfschmod_pending = dict()
+        if not pending:
+            return True
+        batchsize = get_from_config_w_default(
+            section="ecmwf", key="ecfs_batchsize", default=200
+        )
+        todo = collections.defaultdict(list)
+        for location, mode in pending.items():
+            todo[mode].append(location)
+        rc = True
+        for mode, locations in todo.items():
+            for i in range(0, len(locations), batchsize):
+                LOG.info(
+                    "ECfs bulk chmod %s of %d files",
+                    mode,
+                    len(locations[i : i + batchsize]),
+                )
+                rc = (
+                    self._ecfschmod_bulk(mode, locations[i : i + batchsize])
+                    and rc
+                )
+        return rc
+
+    @metrics.measured("ecfs", "ls")
     def ecfsls(self, location, options):
         """List the files at a location using ECfs.
 
         :param location: location the contents of which should be listed
         :param options: list of options to be used (default: "1").
         :return: return code
+
+        :note: The listing is kept in the metadata cache.
         """
-        ecfs = ECfs(system=self.sh)
+        ecfs = self._ecfsinterface
         command = "els"
         list_args = [
             location,
@@ -119,6 +535,10 @@ class ECfsTools(addons.Addon):
             ]
         else:
             list_options = options
+        if self._ecfsmetacache is not None:
+            rc = self._ecfsmetacache.listing(location, list_options)
+            if rc is not None:
+                return rc
         rc = ecfs(
             command=command,
             list_args=list_args,
@@ -127,16 +547,22 @@ class ECfsTools(addons.Addon):
             capture=True,
             silent=True,
         )
+        if self._ecfsmetacache is not None and rc is not False:
+            self._ecfsmetacache.store_listing(location, list_options, rc)
         return rc
 
+    @metrics.measured("ecfs", "mkdir")
     def ecfsmkdir(self, target, options=None):
         """Recursively creates sub-directories.
 
+        Directories that are known to exist (see
+        :data:`ecfs_known_directories`) are not created again.
+
         :param target: target subdirectory
         :param options: list of options to be used (default none)
         :return: return code
         """
-        ecfs = ECfs(system=self.sh)
+        ecfs = self._ecfsinterface
         command = " emkdir"
         list_args = [
             target,
@@ -146,18 +572,32 @@ class ECfsTools(addons.Addon):
             list_options = options
         if not list_options:
             list_options.append("p")
-        return ecfs(
-            command=command,
-            list_args=list_args,
-            dict_args=dict(),
-            list_options=list_options,
-        )
+        if list_options == ["p"] and target in ecfs_known_directories:
+            LOG.debug("ECfs directory %s is known to exist.", target)
+            return True
+        try:
+            rc = ecfs(
+                command=command,
+                list_args=list_args,
+                dict_args=dict(),
+                list_options=list_options,
+            )
+        finally:
+            self._ecfsmeta_invalidate(target)
+        if rc:
+            ecfs_known_directories.add(target)
+        return rc
+
+    @staticmethod
+    def _ecfspath_isremote(path):
+        """Return True if **path** is an ECfs path (e.g. ``ec:/user/file``)."""
+        return bool(re.match(r"^ec\w*:", path))
 
     @contextlib.contextmanager
     def _ecfspath_normalize(self, path, intent="in"):
         if intent not in {"in", "out"}:
             raise ValueError("Improper value for intent.")
-        if not re.match(r"^ec\w*:", path) and ":" in path:
+        if not self._ecfspath_isremote(path) and ":" in path:
             tmp_base_dir = None
             if intent == "out":
                 tmp_base_dir = self.sh.path.dirname(self.sh.path.abspath(path))
@@ -186,106 +626,843 @@ class ECfsTools(addons.Addon):
 
     @contextlib.contextmanager
     def _ecfscp_xsource(self, source):
+        """Make a path out of **source**.
+
+        File objects associated with a regular file are read directly (see
+        :func:`ecmwf.tools.streams.fileobj_path`), other file objects are
+        streamed through a named pipe.
+        """
         if isinstance(source, str):
             with self._ecfspath_normalize(source) as source:
                 yield source
         else:
-            with tempfile.NamedTemporaryFile("w+b") as fhtmp:
-                source.seek(0)
-                self.sh.copyfileobj(source, fhtmp)
-                fhtmp.flush()
-                yield fhtmp.name
+            path = fileobj_path(source)
+            if path is not None:
+                yield path
+            else:
+                rcs = list()
+                with fileobj2fifo(self.sh, source, rcs) as fifo:
+                    yield fifo
+                if not all(rcs):
+                    raise OSError("Could not stream {!r}".format(source))
 
     @contextlib.contextmanager
     def _ecfscp_xtarget(self, target):
+        """Make a path out of **target**.
+
+        File objects are fed through a named pipe.
+        """
         if isinstance(target, str):
             with self._ecfspath_normalize(target, intent="out") as target:
                 yield target
         else:
-            with tempfile.NamedTemporaryFile("w+b") as fhtmp:
-                yield fhtmp.name
-                with open(fhtmp.name, "rb") as fhtmp2:
-                    self.sh.copyfileobj(fhtmp2, target)
+            rcs = list()
+            with fifo2fileobj(self.sh, target, rcs) as fifo:
+                yield fifo
+            if not all(rcs):
+                raise OSError("Could not stream into {!r}".format(target))
+
+    @staticmethod
+    def _ecfscp_options(options):
+        """Return the list of options used by ``ecp`` given user's **options**."""
+        list_options = [
+            "p",
+        ]
+        if isinstance(options, list):
+            list_options = list(options)
+        if {"e", "n", "u", "t"}.isdisjoint(set(list_options)):
+            list_options.append("o")
+        return list_options
+
+    def _ecfsretry(self, action, description):
+        """Call **action** until it succeeds.
+
+        The number of retries is given by the ``ecfs_retries`` key of the
+        ``ecmwf`` configuration section (default: 0). The first retry occurs
+        after ``ecfs_retry_delay`` seconds (default: 10), the delay is then
+        multiplied by ``ecfs_retry_backoff`` (default: 2) after each attempt.
+
+        :param action: A callable that returns a return code (or raises
+                       :class:`ExecutionError` or :class:`OSError`)
+        :param str description: What the action does (for the log)
+        :return: The last return code (the last exception is re-raised)
+        """
+        retries = int(
+            get_from_config_w_default(
+                section="ecmwf", key="ecfs_retries", default=0
+            )
+        )
+        delay = float(
+            get_from_config_w_default(
+                section="ecmwf", key="ecfs_retry_delay", default=10
+            )
+        )
+        backoff = float(
+            get_from_config_w_default(
+                section="ecmwf", key="ecfs_retry_backoff", default=2
+            )
+        )
+        for attempt in range(retries + 1):
+            last = attempt == retries
+            try:
+                rc = action()
+            except (ExecutionError, OSError) as e:
+                if last:
+                    raise
+                LOG.warning("%s: %s", description, e)
+                rc = False
+            if rc or last:
+                return rc
+            LOG.warning(
+                "%s failed (attempt %d/%d). Retrying in %.1f s.",
+                description,
+                attempt + 1,
+                retries + 1,
+                delay,
+            )
+            metrics.add_retries()
+            time.sleep(delay)
+            delay *= backoff
+
+    def _ecfscp_retriable(self, source, target):
+        """Can a failed copy be retried (i.e. no named pipe is involved) ?"""
+        for path in (source, target):
+            if not self._ecfspath_isremote(path):
+                try:
+                    if stat.S_ISFIFO(os.stat(path).st_mode):
+                        return False
+                except OSError:
+                    pass
+        return True
 
     @fmtshcmd
     def ecfscp(self, source, target, options=None):
         """Copy the source file to the target using Ecfs.
 
+        Unless named pipes are involved, failed copies are retried (see
+        :meth:`_ecfsretry`).
+
         :param source: source file to be copied
         :param target: target file
         :param options: list of options to be used (default none)
         :return: return code
         """
-        ecfs = ECfs(system=self.sh)
+        ecfs = self._ecfsinterface
         command = "ecp"
         with self._ecfscp_xsource(source) as source:
             with self._ecfscp_xtarget(target) as target:
                 list_args = [source, target]
-                list_options = [
-                    "p",
-                ]
-                if isinstance(options, list):
-                    list_options = options
-                if {"e", "n", "u", "t"}.isdisjoint(set(list_options)):
-                    list_options.append("o")
-                rc = ecfs(
+                copy = functools.partial(
+                    ecfs,
                     command=command,
                     list_args=list_args,
                     dict_args=dict(),
-                    list_options=list_options,
+                    list_options=self._ecfscp_options(options),
+                )
+                rc = False
+                try:
+                    if self._ecfscp_retriable(source, target):
+                        rc = self._ecfsretry(
+                            copy,
+                            "ECfs copy {:s} -> {:s}".format(source, target),
+                        )
+                    else:
+                        rc = copy()
+                finally:
+                    self._ecfsmeta_invalidate(target)
+                    self._ecfsdirmemo_update(target, rc)
+        return rc
+
+    def _ecfsbatch_worthy(self, source, target):
+        """Can the **source** to **target** copy be part of a batch ?
+
+        Only plain filenames are considered and exactly one of **source** and
+        **target** must be an ECfs path. Local paths containing a colon are
+        left aside since they need to be normalised
+        (see :meth:`_ecfspath_normalize`).
+        """
+        if not (isinstance(source, str) and isinstance(target, str)):
+            return False
+        s_remote = self._ecfspath_isremote(source)
+        t_remote = self._ecfspath_isremote(target)
+        local = target if s_remote else source
+        return s_remote != t_remote and ":" not in local
+
+    def _ecfsbatch_chunks(self, todo, keyfunc, batchsize):
+        """Split the **todo** list of items into batches.
+
+        In each batch, ``keyfunc(item)`` (the basename of the file once copied
+        into the target directory) is unique and there are at most
+        **batchsize** items.
+        """
+        chunks = list()
+        for item in todo:
+            key = keyfunc(item)
+            for chunk in chunks:
+                if len(chunk) < batchsize and key not in chunk:
+                    chunk[key] = item
+                    break
+            else:
+                chunks.append({key: item})
+        return [list(chunk.values()) for chunk in chunks]
+
+    def _ecfsbatch_fallback(self, source, target, options):
+        """Copy a single item after a batch failure (the return code is returned)."""
+        metrics.add_retries()
+        try:
+            return self.ecfscp(source=source, target=target, options=options)
+        except ExecutionError:
+            LOG.error("ECfs copy failed: %s -> %s", source, target)
+            return False
+
+    def _ecfsbatch_get(self, sources, targets, targetdir, options):
+        """Fetch a batch of ECfs files into the local **targetdir** directory."""
+        ecfs = self._ecfsinterface
+        self.sh.filecocoon(targets[0])
+        rcs = list()
+        with self.sh.temporary_dir_context(
+            prefix="ecfs_batch_", dir=self.sh.path.abspath(targetdir)
+        ) as tmpdir:
+            rc = ecfs(
+                command="ecp",
+                list_args=list(sources) + [tmpdir],
+                dict_args=dict(),
+                list_options=self._ecfscp_options(options),
+                fatal=False,
+            )
+            for source, target in zip(sources, targets):
+                staged = self.sh.path.join(
+                    tmpdir, self.sh.path.basename(source)
                 )
+                if rc and self.sh.path.exists(staged):
+                    rcs.append(self.sh.mv(staged, target))
+                else:
+                    rcs.append(
+                        self._ecfsbatch_fallback(source, target, options)
+                    )
+        return rcs
+
+    def _ecfsbatch_put(self, sources, targets, targetdir, options):
+        """Send a batch of local files into the **targetdir** ECfs directory."""
+        ecfs = self._ecfsinterface
+        self._ecfsmeta_invalidate(*targets)
+        with self.sh.temporary_dir_context(prefix="ecfs_batch_") as tmpdir:
+            links = list()
+            for source, target in zip(sources, targets):
+                link = self.sh.path.join(tmpdir, self.sh.path.basename(target))
+                self.sh.softlink(self.sh.path.abspath(source), link)
+                links.append(link)
+            rc = ecfs(
+                command="ecp",
+                list_args=links + [targetdir],
+                dict_args=dict(),
+                list_options=self._ecfscp_options(options),
+                fatal=False,
+            )
+        self._ecfsdirmemo_update(targets[0], rc)
+        if rc:
+            return [True] * len(sources)
+        return [
+            self._ecfsbatch_fallback(source, target, options)
+            for source, target in zip(sources, targets)
+        ]
+
+    @metrics.measured("ecfs", "batchcp", many=True)
+    def ecfsbatchcp(self, sources, targets, options=None, mode=None):
+        """Copy several files using as few ``ecp`` commands as possible.
+
+        Copies are grouped by target directory and each group is processed by
+        a unique ``ecp`` command (with many sources). Since ``ecp`` keeps the
+        sources basenames when copying into a directory, the local side of
+        the transfer is staged in a temporary directory (symbolic links for
+        puts, actual files for gets).
+
+        If a batch fails, its items are copied one by one so that an accurate
+        return code is known for each of them.
+
+        The maximum number of files per ``ecp`` command can be specified by
+        the ``ecfs_batchsize`` key of the ``ecmwf`` configuration section.
+
+        :param sources: list of source files
+        :param targets: list of target files (same length as **sources**)
+        :param options: list of options to be used (default "p")
+        :param mode: if provided, the permissions of the files sent to ECfs
+                     are changed (one ``echmod`` command for each batch)
+        :return: the list of return codes (one for each source/target pair)
+        """
+        if len(sources) != len(targets):
+            raise ValueError("sources and targets must have the same length.")
+        batchsize = get_from_config_w_default(
+            section="ecmwf", key="ecfs_batchsize", default=200
+        )
+        rcs = [None] * len(sources)
+        todo = collections.defaultdict(list)
+        for i, (source, target) in enumerate(zip(sources, targets)):
+            if self._ecfsbatch_worthy(source, target):
+                todo[self.sh.path.dirname(target)].append(i)
+            else:
+                rcs[i] = self._ecfsbatch_fallback(source, target, options)
+        for targetdir, indices in todo.items():
+            if self._ecfspath_isremote(targetdir):
+                batchfunc = self._ecfsbatch_put
+                keyfunc = targets.__getitem__
+            else:
+                batchfunc = self._ecfsbatch_get
+                keyfunc = sources.__getitem__
+            for chunk in self._ecfsbatch_chunks(
+                indices,
+                lambda i: self.sh.path.basename(keyfunc(i)),
+                batchsize,
+            ):
+                LOG.info(
+                    "ECfs batch copy of %d files (target directory: %s)",
+                    len(chunk),
+                    targetdir,
+                )
+                chunk_rcs = batchfunc(
+                    [sources[i] for i in chunk],
+                    [targets[i] for i in chunk],
+                    targetdir,
+                    options,
+                )
+                for i, rc in zip(chunk, chunk_rcs):
+                    rcs[i] = rc
+                done = [i for i in chunk if rcs[i]]
+                if mode is not None and self._ecfspath_isremote(targetdir):
+                    if done and not self._ecfschmod_bulk(
+                        mode, [targets[i] for i in done]
+                    ):
+                        for i in done:
+                            rcs[i] = False
+        return rcs
+
+    @contextlib.contextmanager
+    def _ecfsopen(self, local, mode):
+        """Open **local** if it is a filename (file objects are left as is)."""
+        if isinstance(local, str):
+            with open(local, mode) as fh:
+                yield fh
+        else:
+            yield local
+
+    def _ecfschecksum_put(self, target, hasher):
+        """Store the checksum computed by **hasher** next to **target**."""
+        with metrics.unmeasured():
+            return self.ecfscp(
+                source=io.BytesIO(checksums.sidecar_content(target, hasher)),
+                target=checksums.sidecar_path(target, hasher),
+            )
+
+    def _ecfschecksum_verify(self, source, target, hasher):
+        """Compare the checksum computed by **hasher** with the stored one.
+
+        If the checksums differ, **target** is removed (if it is a filename).
+        """
+        sidecar = checksums.sidecar_path(source, hasher)
+        content = None
+        if self.ecfstest(sidecar):
+            buffer = io.BytesIO()
+            try:
+                with metrics.unmeasured():
+                    self.ecfscp(source=sidecar, target=buffer)
+                content = buffer.getvalue()
+            except (ExecutionError, OSError) as e:
+                LOG.warning("Could not read %s: %s", sidecar, e)
+        rc = checksums.verify(source, hasher, content)
+        if not rc and isinstance(target, str):
+            self.sh.rm(target)
         return rc
 
     @fmtshcmd
+    @metrics.measured("ecfs", "get", nbytes="target")
     def ecfsget(self, source, target, cpipeline=None, options=None):
         """Get a resource using ECfs (default class).
 
+        When a compression pipeline is provided, a temporary compressed file
+        is created and uncompressed afterwards. Streaming is opt-in: if the
+        ``ecfs_streaming`` key of the ``ecmwf`` configuration section is
+        true (default: false), ``ecp`` writes into a named pipe and the data
+        are uncompressed on the fly (such transfers are not retried, see
+        :meth:`ecfscp`).
+
+        If the ``ecfs_checksum`` key is set, the checksum of the data
+        received is compared with the one stored by :meth:`ecfsput` (see
+        :mod:`ecmwf.tools.checksums`). It is computed on the fly when the
+        data are streamed or uncompressed (or when **target** is a file
+        object). Otherwise, the file received is read once more.
+
+        Files stored by chunks are retrieved by :meth:`ecfsget_resumable`
+        (provided that the ``ecfs_resumable_threshold`` key is set).
+
+        If the ``ecfs_coalescing`` key is true, concurrent identical requests
+        (from any thread or process of the node) are coalesced (see
+        :mod:`ecmwf.tools.coalescing`).
+
         :param source: file to be copied
         :param target: target file
         :param cpipeline: compression pipeline used, if provided
         :param options: options to be used
         :return: return code
         """
+        return coalesced(
+            "ecfs",
+            coalescing_key(
+                "ecfs",
+                source,
+                options=options,
+                cpipeline=getattr(cpipeline, "description_string", None),
+            ),
+            target,
+            functools.partial(
+                self._ecfsget, source, target, cpipeline, options
+            ),
+        )
+
+    def _ecfsget(self, source, target, cpipeline, options):
+        """See :meth:`ecfsget` (without coalescing)."""
+        hasher = checksums.new_hasher("ecfs")
+        streaming = get_from_config_w_default(
+            section="ecmwf", key="ecfs_streaming", default=False
+        )
         if cpipeline is None:
-            return self.ecfscp(source=source, target=target, options=options)
+            if self._ecfsresumable_get_worthy(source, target):
+                return self.ecfsget_resumable(source, target)
+            if hasher is None:
+                return self.ecfscp(
+                    source=source, target=target, options=options
+                )
+            if not streaming and isinstance(target, str):
+                rc = self.ecfscp(source=source, target=target, options=options)
+                if rc:
+                    checksums.update_from_file(hasher, target)
+            else:
+                rcs = list()
+                try:
+                    with self._ecfsopen(target, "wb") as fhout:
+                        with fifo2fileobj(
+                            self.sh, fhout, rcs, hasher=hasher
+                        ) as fifo:
+                            rcs.append(
+                                self.ecfscp(
+                                    source=source, target=fifo, options=options
+                                )
+                            )
+                finally:
+                    if not (rcs and all(rcs)) and isinstance(target, str):
+                        self.sh.rm(target)
+                rc = all(rcs)
+        elif streaming:
+            rcs = list()
+            with fifo2uncompress(
+                self.sh, cpipeline, target, rcs, hasher=hasher
+            ) as fifo:
+                rcs.append(
+                    self.ecfscp(source=source, target=fifo, options=options)
+                )
+            rc = all(rcs)
         else:
             ctarget = self.sh.safe_fileaddsuffix(target)
             try:
-                rc, dict_args = self.ecfscp(
+                rc = self.ecfscp(
                     source=source, target=ctarget, options=options
                 )
-                rc = rc and cpipeline.file2uncompress(
-                    source=ctarget, destination=target
-                )
+                if rc:
+                    metrics.add_nbytes(os.path.getsize(ctarget))
+                with metrics.compression_timer():
+                    rc = rc and file2uncompress(
+                        self.sh, cpipeline, ctarget, target, hasher=hasher
+                    )
             finally:
                 self.sh.rm(ctarget)
-            return rc
+        if rc and hasher is not None:
+            rc = self._ecfschecksum_verify(source, target, hasher)
+        return rc
 
     @fmtshcmd
+    @metrics.measured("ecfs", "put", nbytes="source")
     def ecfsput(self, source, target, cpipeline=None, options=None):
         """Put a resource using ECfs (default class).
 
+        When a compression pipeline is provided, a temporary compressed file
+        is created. Streaming is opt-in: if the ``ecfs_streaming`` key of the
+        ``ecmwf`` configuration section is true (default: false), the
+        compressed data are streamed to ``ecp`` through a named pipe (such
+        transfers are not retried, see :meth:`ecfscp`).
+
+        If the ``ecfs_checksum`` key is set, the checksum of the data sent
+        is stored next to **target** (see :mod:`ecmwf.tools.checksums`). It
+        is computed on the fly when the data are streamed or compressed (or
+        when **source** is a file object). Otherwise, the file is read once
+        more.
+
+        Uncompressed files larger than the ``ecfs_resumable_threshold`` key
+        (in bytes, unset by default) are stored by chunks (see
+        :meth:`ecfsput_resumable`).
+
         :param source: file to be copied
         :param target: target file
         :param cpipeline: compression pipeline used, if provided
         :param options: options to be used
         :return: return code
         """
+        hasher = checksums.new_hasher("ecfs")
+        streaming = get_from_config_w_default(
+            section="ecmwf", key="ecfs_streaming", default=False
+        )
         if cpipeline is None:
-            return self.ecfscp(source=source, target=target, options=options)
+            if self._ecfsresumable_put_worthy(source):
+                return self.ecfsput_resumable(source, target)
+            if hasher is None:
+                return self.ecfscp(
+                    source=source, target=target, options=options
+                )
+            if not streaming and isinstance(source, str):
+                checksums.update_from_file(hasher, source)
+                rc = self.ecfscp(source=source, target=target, options=options)
+            else:
+                rcs = list()
+                with self._ecfsopen(source, "rb") as fhin:
+                    with fileobj2fifo(
+                        self.sh, fhin, rcs, hasher=hasher
+                    ) as fifo:
+                        rcs.append(
+                            self.ecfscp(
+                                source=fifo, target=target, options=options
+                            )
+                        )
+                rc = all(rcs)
+        elif streaming:
+            rcs = list()
+            with compress2fifo(
+                self.sh, cpipeline, source, rcs, hasher=hasher
+            ) as fifo:
+                rcs.append(
+                    self.ecfscp(source=fifo, target=target, options=options)
+                )
+            rc = all(rcs)
         else:
             csource = self.sh.safe_fileaddsuffix(source)
             try:
-                rc1 = cpipeline.compress2file(source=source, target=csource)
+                with metrics.compression_timer():
+                    rc1 = compress2file(
+                        self.sh, cpipeline, source, csource, hasher=hasher
+                    )
                 rc = self.ecfscp(
                     source=csource, target=target, options=options
                 )
+                if rc:
+                    metrics.add_nbytes(os.path.getsize(csource))
             finally:
                 self.sh.rm(csource)
             rc = rc and rc1
-            return rc
+        if rc and hasher is not None:
+            rc = self._ecfschecksum_put(target, hasher)
+        return rc
+
+    def ecfsinsert(self, source, target, mode="644", options=None, **kwargs):
+        """Insert a file into ECfs and set its final permissions.
+
+        The target directory is created (unless it is known to exist, see
+        :data:`ecfs_known_directories`), the file is copied (using
+        :meth:`ecfsput`) and the permissions are changed. Within a
+        :meth:`ecfschmod_batch` block, the permissions change is deferred
+        (see :meth:`ecfschmod_deferred`): most of the time, a unique ``ecp``
+        command is run and the return code of the permissions changes is
+        reported by the block.
+
+        :param source: file to be copied
+        :param target: target file
+        :param mode: The final permissions (``None`` to leave them unchanged)
+        :param options: options to be used by the copy
+        :param kwargs: any other argument accepted by :meth:`ecfsput`
+                       (**cpipeline**, **fmt**)
+        :return: return code
+        """
+        rc = self.ecfsmkdir(target=self.sh.path.dirname(target))
+        rc = rc and self.sh.ecfsput(
+            source=source, target=target, options=options, **kwargs
+        )
+        if mode is not None:
+            rc = rc and self.ecfschmod_deferred(mode, target)
+        return rc
+
+    @staticmethod
+    def _ecfsresumable_threshold():
+        threshold = get_from_config_w_default(
+            section="ecmwf", key="ecfs_resumable_threshold", default=None
+        )
+        return None if threshold is None else int(threshold)
+
+    def _ecfsresumable_put_worthy(self, source):
+        """Should the **source** local file be stored by chunks ?"""
+        threshold = self._ecfsresumable_threshold()
+        return (
+            threshold is not None
+            and isinstance(source, str)
+            and not self._ecfspath_isremote(source)
+            and os.path.isfile(source)
+            and os.path.getsize(source) >= threshold
+        )
+
+    def _ecfsresumable_get_worthy(self, source, target):
+        """Is the **source** ECfs file stored by chunks ?
+
+        A unique listing of the parent directory tells (it is recorded in the
+        metadata cache, if enabled). The manifest is only looked for by
+        :meth:`ecfsget_resumable`, if a ``.chunks`` directory exists.
+        """
+        if not (
+            self._ecfsresumable_threshold() is not None
+            and isinstance(source, str)
+            and isinstance(target, str)
+            and self._ecfspath_isremote(source)
+        ):
+            return False
+        if self._ecfsmetacache is not None and self._ecfsmetacache.test(
+            source
+        ):
+            return False
+        names = self._ecfsdir_names(posixpath.dirname(source))
+        basename = posixpath.basename(source)
+        return (
+            names is not None
+            and basename not in names
+            and basename + ".chunks" in names
+        )
+
+    @staticmethod
+    def _ecfschunk_algorithm():
+        return get_from_config_w_default(
+            section="ecmwf", key="ecfs_chunk_checksum", default="sha256"
+        )
+
+    def _ecfschunks_listing(self, chunkdir):
+        """Return a dictionary of the complete chunks found in **chunkdir**.
+
+        It associates chunk indexes with the list of chunk names.
+        """
+        self._ecfsmeta_invalidate(chunkdir)
+        chunks = collections.defaultdict(list)
+        for line in self.ecfsls(chunkdir, None):
+            name = posixpath.basename(line.strip().rstrip("/"))
+            match = re.match(r"^(\d+)\.(\w+)$", name)
+            if match and match.group(2) != "part":
+                chunks[int(match.group(1))].append(name)
+        return chunks
+
+    def _ecfschunk_put(self, fhin, offset, length, chunkdir, index):
+        """Copy one chunk of **fhin** into **chunkdir**.
+
+        The chunk is copied into a ``<index>.part`` file which is then renamed
+        ``<index>.<checksum>``.
+
+        :return: the chunk name (or ``False``)
+        """
+        reader = FileRangeReader(
+            fhin, offset, length, algorithm=self._ecfschunk_algorithm()
+        )
+        part = posixpath.join(chunkdir, "{:06d}.part".format(index))
+        if not self.ecfscp(source=reader, target=part):
+            return False
+        name = "{:06d}.{:s}".format(index, reader.hexdigest())
+        if not self.ecfsmv(part, posixpath.join(chunkdir, name)):
+            return False
+        return name
 
     @fmtshcmd
+    @metrics.measured("ecfs", "put_resumable", nbytes="source")
+    def ecfsput_resumable(self, source, target, chunksize=None):
+        """Copy a (large) local file into ECfs by chunks.
+
+        ``ecp`` can not write from a given offset, so the file is stored as a
+        set of chunks in the ``<target>.chunks`` ECfs directory. Each chunk is
+        copied into a temporary ``.part`` file and renamed
+        ``<index>.<checksum>`` once complete: when the transfer is resumed,
+        the chunks that are already there (with the right checksum) are not
+        sent again. Each chunk copy is retried (see :meth:`_ecfsretry`).
+
+        Once all the chunks are there, a ``manifest.json`` file that
+        describes the whole file is created (see :meth:`ecfsget_resumable`).
+
+        :param source: local file to be copied
+        :param target: target ECfs file
+        :param int chunksize: The chunk size in bytes (default: the
+                              ``ecfs_chunksize`` key of the ``ecmwf``
+                              configuration section or 1 GiB)
+        :return: return code
+        """
+        if chunksize is None:
+            chunksize = get_from_config_w_default(
+                section="ecmwf", key="ecfs_chunksize", default=1024**3
+            )
+        chunksize = int(chunksize)
+        algorithm = self._ecfschunk_algorithm()
+        chunkdir = target + ".chunks"
+        size = os.path.getsize(source)
+        if not self.ecfsmkdir(chunkdir):
+            return False
+        present = self._ecfschunks_listing(chunkdir)
+        manifest = dict(size=size, algorithm=algorithm, chunks=list())
+        with open(source, "rb") as fhin:
+            for index, offset in enumerate(range(0, max(size, 1), chunksize)):
+                length = min(chunksize, size - offset)
+                name = None
+                if present[index]:
+                    reader = FileRangeReader(fhin, offset, length, algorithm)
+                    while reader.read(1024**2):
+                        pass
+                    expected = "{:06d}.{:s}".format(index, reader.hexdigest())
+                    if expected in present[index]:
+                        LOG.debug("ECfs chunk %s is already there", expected)
+                        name = expected
+                for stale in present[index]:
+                    if stale != name:
+                        self.ecfsrm(posixpath.join(chunkdir, stale), None)
+                if name is None:
+                    name = self._ecfsretry(
+                        functools.partial(
+                            self._ecfschunk_put,
+                            fhin,
+                            offset,
+                            length,
+                            chunkdir,
+                            index,
+                        ),
+                        "ECfs chunk {:d} of {:s}".format(index, target),
+                    )
+                    if not name:
+                        return False
+                manifest["chunks"].append(
+                    dict(name=name, offset=offset, length=length)
+                )
+        rc = self.ecfscp(
+            source=io.BytesIO(json.dumps(manifest).encode()),
+            target=posixpath.join(chunkdir, "manifest.json"),
+        )
+        if rc and self.ecfstest(target):
+            # The plain file would hide the chunks
+            rc = self.ecfsrm(target, None)
+        return rc
+
+    def _ecfschunks_manifest(self, chunkdir):
+        """Read the manifest of a file stored by chunks (``None`` if missing)."""
+        buffer = io.BytesIO()
+        try:
+            self.ecfscp(
+                source=posixpath.join(chunkdir, "manifest.json"),
+                target=buffer,
+            )
+            return json.loads(buffer.getvalue().decode())
+        except (ExecutionError, OSError, ValueError) as e:
+            LOG.error("Could not read the manifest of %s: %s", chunkdir, e)
+            return None
+
+    def _ecfschunk_get(self, chunkdir, chunk, fhout, algorithm):
+        """Copy one chunk into **fhout** and check it.
+
+        :return: return code
+        """
+        writer = FileRangeWriter(fhout, chunk["offset"], algorithm=algorithm)
+        if not self.ecfscp(
+            source=posixpath.join(chunkdir, chunk["name"]), target=writer
+        ):
+            return False
+        name = "{:06d}.{:s}".format(
+            int(chunk["name"].split(".")[0]), writer.hexdigest()
+        )
+        if writer.length != chunk["length"] or name != chunk["name"]:
+            LOG.error(
+                "ECfs chunk %s is corrupted (%d bytes, checksum %s)",
+                chunk["name"],
+                writer.length,
+                writer.hexdigest(),
+            )
+            return False
+        return True
+
+    @fmtshcmd
+    @metrics.measured("ecfs", "get_resumable", nbytes="target")
+    def ecfsget_resumable(self, source, target):
+        """Get a file stored by chunks (see :meth:`ecfsput_resumable`).
+
+        Each chunk is written at its own place in **target** and its checksum
+        is verified. The chunks retrieved so far are recorded in a
+        ``<target>.resume`` file, so that an interrupted transfer is resumed
+        where it stopped. Each chunk copy is retried (see :meth:`_ecfsretry`).
+
+        :param source: ECfs file to be copied
+        :param target: target local file
+        :return: return code
+        """
+        chunkdir = source + ".chunks"
+        manifest = self._ecfschunks_manifest(chunkdir)
+        if manifest is None:
+            return False
+        statefile = target + ".resume"
+        done = list()
+        if os.path.exists(statefile) and os.path.exists(target):
+            try:
+                with open(statefile) as fhstate:
+                    state = json.load(fhstate)
+                if state["manifest"] == manifest:
+                    done = state["done"]
+            except (OSError, ValueError, KeyError) as e:
+                LOG.warning("Ignoring %s: %s", statefile, e)
+        with open(target, "r+b" if done else "wb") as fhout:
+            for chunk in manifest["chunks"]:
+                if chunk["name"] in done:
+                    LOG.debug("ECfs chunk %s is already there", chunk["name"])
+                    continue
+                rc = self._ecfsretry(
+                    functools.partial(
+                        self._ecfschunk_get,
+                        chunkdir,
+                        chunk,
+                        fhout,
+                        manifest["algorithm"],
+                    ),
+                    "ECfs chunk {:s} of {:s}".format(chunk["name"], source),
+                )
+                if not rc:
+                    return False
+                fhout.flush()
+                done.append(chunk["name"])
+                with open(statefile, "w") as fhstate:
+                    json.dump(dict(manifest=manifest, done=done), fhstate)
+            fhout.truncate(manifest["size"])
+        if os.path.exists(statefile):
+            os.remove(statefile)
+        return True
+
+    @metrics.measured("ecfs", "mv")
+    def ecfsmv(self, source, target, options=None):
+        """Rename an ECfs file.
+
+        :param source: file to be renamed
+        :param target: new name
+        :param options: list of options to be used (default none)
+        :return: return code
+        """
+        ecfs = self._ecfsinterface
+        command = "emove"
+        list_args = [source, target]
+        if options is None:
+            list_options = list()
+        else:
+            list_options = options
+        try:
+            rc = ecfs(
+                command=command,
+                list_args=list_args,
+                dict_args=dict(),
+                list_options=list_options,
+            )
+        finally:
+            self._ecfsmeta_invalidate(source, target)
+        return rc
+
+    @fmtshcmd
+    @metrics.measured("ecfs", "rm")
     def ecfsrm(self, item, options):
         """Delete a file or directory using ECfs.
 
@@ -293,7 +1470,7 @@ class ECfsTools(addons.Addon):
         :param options: list of options to be used (default none)
         :return: return code
         """
-        ecfs = ECfs(system=self.sh)
+        ecfs = self._ecfsinterface
         command = "erm"
         list_args = [
             item,
@@ -302,11 +1479,129 @@ class ECfsTools(addons.Addon):
             list_options = list()
         else:
             list_options = options
-        if ecfs:
+        try:
             rc = ecfs(
                 command=command,
                 list_args=list_args,
                 dict_args=dict(),
                 list_options=list_options,
             )
+        finally:
+            self._ecfsmeta_invalidate(item)
+            ecfs_known_directories.discard(item)
+            with self._ecfschmod_lock:
+                for location in [
+                    loc
+                    for loc in self._ecfschmod_pending
+                    if loc == item or loc.startswith(item.rstrip("/") + "/")
+                ]:
+                    del self._ecfschmod_pending[location]
         return rc
+
+    def _ecfsstage(self, items, query):
+        """Run the ECfs staging command on **items** (by batches).
+
+        :return: a tuple: the return code and the output lines (if **query**)
+        """
+        command = get_from_config_w_default(
+            section="ecmwf", key="ecfs_stage_command", default="estage"
+        )
+        batchsize = int(
+            get_from_config_w_default(
+                section="ecmwf", key="ecfs_batchsize", default=200
+            )
+        )
+        rc = True
+        lines = list()
+        for i in range(0, len(items), batchsize):
+            output = self._ecfsinterface(
+                command=command,
+                list_args=list(items[i : i + batchsize]),
+                dict_args=dict(),
+                list_options=["q"] if query else list(),
+                fatal=False,
+                capture=query,
+                silent=query,
+            )
+            if output is False:
+                rc = False
+            elif query:
+                lines.extend(output)
+        return rc, lines
+
+    @metrics.measured("ecfs", "stageinfo")
+    def ecfsstageinfo(self, items):
+        """Find out where the ECfs **items** are stored.
+
+        The command given by the ``ecfs_stage_command`` key of the ``ecmwf``
+        configuration section (default: ``estage``) is called with the
+        ``-q`` option and a list of items. For each item, it prints
+        ``<item> <tape> <status>`` where ``status`` is ``online`` if the
+        item is on disk (or being retrieved from tape).
+
+        :param list items: ECfs paths
+        :return: a dictionary that associates each item with a tuple: the
+                 tape (``None`` if unknown) and whether it is online
+        """
+        infos = {item: (None, False) for item in items}
+        _, lines = self._ecfsstage(list(infos), query=True)
+        for line in lines:
+            words = line.strip().rsplit(None, 2)
+            if len(words) == 3 and words[0] in infos:
+                infos[words[0]] = (words[1], words[2].lower() == "online")
+        return infos
+
+    @metrics.measured("ecfs", "prestage")
+    def ecfsprestage(self, items, wait=False, timeout=None, pollfreq=None):
+        """Recall many tape resident ECfs **items** at once.
+
+        Offline items (see :meth:`ecfsstageinfo`) are sorted by tape and
+        recalled by a unique staging command (or one per ``ecfs_batchsize``
+        items) so that each tape is mounted once.
+
+        :param list items: ECfs paths
+        :param bool wait: Wait until all the items are online
+        :param float timeout: Stop waiting after **timeout** seconds (default:
+                              the ``ecfs_prestage_timeout`` key of the
+                              ``ecmwf`` configuration section or 3600)
+        :param float pollfreq: The polling period when waiting (default: the
+                               ``ecfs_prestage_pollfreq`` key or 60)
+        :return: a dictionary that associates each item with its readiness
+        :raises ExecutionError: if the recall request fails
+        """
+        items = list(dict.fromkeys(items))
+        infos = self.ecfsstageinfo(items)
+        ready = {item: infos[item][1] for item in items}
+        offline = sorted(
+            [item for item in items if not ready[item]],
+            key=lambda item: (infos[item][0] or "", item),
+        )
+        if not offline:
+            return ready
+        LOG.info(
+            "Recalling %d ECfs files from %d tapes",
+            len(offline),
+            len({infos[item][0] for item in offline}),
+        )
+        rc, _ = self._ecfsstage(offline, query=False)
+        if not rc:
+            raise ExecutionError("The ECfs recall request failed")
+        if wait:
+            if timeout is None:
+                timeout = get_from_config_w_default(
+                    section="ecmwf", key="ecfs_prestage_timeout", default=3600
+                )
+            if pollfreq is None:
+                pollfreq = get_from_config_w_default(
+                    section="ecmwf", key="ecfs_prestage_pollfreq", default=60
+                )
+            deadline = time.monotonic() + float(timeout)
+            while offline and time.monotonic() < deadline:
+                time.sleep(
+                    max(0, min(float(pollfreq), deadline - time.monotonic()))
+                )
+                infos = self.ecfsstageinfo(offline)
+                for item in offline:
+                    ready[item] = infos[item][1]
+                offline = [item for item in offline if not ready[item]]
+        return ready
@@ -0,0 +1,377 @@
+"""
+A node-local, content-addressed cache of the files retrieved from ECfs.
+
+Several tasks running on the same node often fetch the same files (e.g.
+climatologies or constant files). When the cache is enabled (see
+:func:`ecfscache_from_config`), the files retrieved by
+:class:`~ecmwf.tools.storage.EcfsArchive` are stored once (by content) in a
+local directory and the next requests are served by a reflink, a hard link
+or a copy of the cached file (hard links are only used for read-only
+requests). A lock file per ECfs location ensures that concurrent requests
+(from any thread or process of the node) share a single download.
+
+The cache directory contains:
+
+    * ``objects/``: the cached files (named after their SHA-256 checksum);
+    * ``index/``: one directory per ECfs location that contains one JSON
+      file per variant of the request (e.g. per compression pipeline). The
+      JSON file gives the checksum of the file retrieved (and when it was
+      retrieved);
+    * ``locks/``: the lock files;
+    * ``tmp/``: the files being downloaded;
+    * ``usage``: the total size of the cached files.
+"""
+
+import contextlib
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+from vortex.config import get_from_config_w_default
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+#: The Linux ``FICLONE`` ioctl request (reflinks)
+_FICLONE = 0x40049409
+
+#: The ways the cached files are served (in order of preference)
+ECFSCACHE_LINKS = ("reflink", "hardlink", "copy")
+
+
+def ecfscache_from_config():
+    """Create an :class:`ECfsLocalCache` object given Vortex' configuration.
+
+    The following keys of the ``ecmwf`` configuration section are used:
+
+        * ``ecfs_localcache_path``: The cache directory. If it is not set,
+          the cache is disabled (``None`` is returned);
+        * ``ecfs_localcache_size``: The maximum size of the cached files in
+          bytes (default: 20 GiB);
+        * ``ecfs_localcache_ttl``: The time (in seconds) during which a
+          cached file is deemed up to date (default: 86400);
+        * ``ecfs_localcache_links``: The ways the cached files are served
+          (default: ``["reflink", "hardlink", "copy"]``).
+
+    :return: An :class:`ECfsLocalCache` object or ``None``
+    """
+    rootdir = get_from_config_w_default(
+        section="ecmwf", key="ecfs_localcache_path", default=None
+    )
+    if not rootdir:
+        return None
+    maxsize = get_from_config_w_default(
+        section="ecmwf", key="ecfs_localcache_size", default=20 * 1024**3
+    )
+    ttl = get_from_config_w_default(
+        section="ecmwf", key="ecfs_localcache_ttl", default=86400
+    )
+    links = get_from_config_w_default(
+        section="ecmwf", key="ecfs_localcache_links", default=ECFSCACHE_LINKS
+    )
+    return ECfsLocalCache(
+        rootdir, maxsize=int(maxsize), ttl=float(ttl), links=links
+    )
+
+
+def _reflink(source, target):
+    """Create **target** as a copy-on-write clone of **source**."""
+    with open(source, "rb") as fhin, open(target, "wb") as fhout:
+        fcntl.ioctl(fhout.fileno(), _FICLONE, fhin.fileno())
+
+
+def link_or_copy(source, target, methods=ECFSCACHE_LINKS):
+    """Create **target** as a reflink, a hard link or a copy of **source**.
+
+    :param methods: The methods to try, in order of preference (see
+                    :data:`ECFSCACHE_LINKS`)
+    :return: The method used
+    """
+    if os.path.lexists(target):
+        os.remove(target)
+    for method in methods:
+        try:
+            if method == "reflink":
+                _reflink(source, target)
+            elif method == "hardlink":
+                os.link(source, target)
+            else:
+                shutil.copyfile(source, target)
+            return method
+        except OSError as e:
+            LOG.debug("No %s of %s to %s (%s)", method, source, target, e)
+            if os.path.lexists(target):
+                os.remove(target)
+    raise OSError("Could not create {:s} from {:s}".format(target, source))
+
+
+class ECfsLocalCache:
+    """A node-local, content-addressed cache of ECfs files.
+
+    Cached files are read-only. Their total size is recorded when they are
+    stored: when it exceeds **maxsize**, the least recently used ones are
+    removed. An index entry older than **ttl** seconds is ignored (the file
+    is retrieved again).
+
+    Any cache failure is logged and the file is retrieved as usual: the
+    cache never prevents the actual ECfs command to be run.
+    """
+
+    def __init__(self, rootdir, maxsize=20 * 1024**3, ttl=86400, links=None):
+        """
+        :param str rootdir: The cache directory
+        :param int maxsize: The maximum size of the cached files (in bytes)
+        :param float ttl: The index entries lifetime (in seconds)
+        :param links: The ways the cached files are served, in order of
+                      preference (see :data:`ECFSCACHE_LINKS`)
+        """
+        self._rootdir = rootdir
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._links = tuple(ECFSCACHE_LINKS if links is None else links)
+        unknown = set(self._links) - set(ECFSCACHE_LINKS)
+        if unknown:
+            raise ValueError("Unknown link methods: {!s}".format(unknown))
+
+    @property
+    def rootdir(self):
+        """The cache directory."""
+        return self._rootdir
+
+    @property
+    def maxsize(self):
+        """The maximum size of the cached files (in bytes)."""
+        return self._maxsize
+
+    @property
+    def ttl(self):
+        """The index entries lifetime (in seconds)."""
+        return self._ttl
+
+    @staticmethod
+    def _key(location, variant=""):
+        return hashlib.sha256(
+            "\0".join([location, variant]).encode()
+        ).hexdigest()
+
+    def _path(self, kind, name, suffix=""):
+        path = os.path.join(self._rootdir, kind, name[:2], name + suffix)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return path
+
+    def _indexdir(self, location):
+        return os.path.join(
+            self._rootdir,
+            "index",
+            self._key(location)[:2],
+            self._key(location),
+        )
+
+    def _index(self, location, variant):
+        indexdir = self._indexdir(location)
+        os.makedirs(indexdir, exist_ok=True)
+        return os.path.join(indexdir, self._key(location, variant) + ".json")
+
+    @contextlib.contextmanager
+    def _locked(self, name):
+        """Hold an exclusive lock (shared by all the processes of the node)."""
+        with open(self._path("locks", name, ".lock"), "a") as fhlock:
+            fcntl.flock(fhlock, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(fhlock, fcntl.LOCK_UN)
+
+    def lookup(self, location, variant=""):
+        """Return the path to the cached copy of **location** (or ``None``).
+
+        The cached file is marked as recently used.
+
+        :param str location: The ECfs location
+        :param str variant: Anything that alters the retrieved file (e.g. the
+                            compression pipeline description)
+        """
+        index = self._index(location, variant)
+        try:
+            with open(index) as fhindex:
+                entry = json.load(fhindex)
+            if (entry["location"], entry.get("variant", "")) != (
+                location,
+                variant,
+            ):
+                return None
+            if self._ttl > 0 and time.time() - entry["stamp"] > self._ttl:
+                LOG.debug("ECfs local cache entry expired: %s", location)
+                return None
+            blob = self._path("objects", entry["digest"])
+            os.utime(blob)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError, KeyError) as e:
+            LOG.warning("ECfs local cache: bad index %s (%s)", index, e)
+            return None
+        return blob
+
+    def _objects(self):
+        """List the cached files as (mtime, size, path) tuples."""
+        blobs = list()
+        objects = os.path.join(self._rootdir, "objects")
+        for dirpath, _, filenames in os.walk(objects):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                blobs.append((st.st_mtime, st.st_size, path))
+        return blobs
+
+    def _usage_write(self, total):
+        """Record the total size of the cached files.
+
+        The caller must hold the ``usage`` lock.
+        """
+        usage = os.path.join(self._rootdir, "usage")
+        with open(usage + ".tmp", "w") as fhusage:
+            fhusage.write(str(total))
+        os.replace(usage + ".tmp", usage)
+
+    def _usage_update(self, nbytes):
+        """Add **nbytes** to the recorded size of the cached files.
+
+        The caller must hold the ``usage`` lock.
+
+        :return: The new total size
+        """
+        try:
+            with open(os.path.join(self._rootdir, "usage")) as fhusage:
+                total = int(fhusage.read()) + nbytes
+        except (FileNotFoundError, ValueError):
+            # Unknown (yet): the cached files are looked for
+            total = sum(b[1] for b in self._objects())
+        self._usage_write(max(0, total))
+        return total
+
+    def _store(self, location, variant, path):
+        """Move the **path** file into the cache and index it as **location**.
+
+        :return: The path to the cached file and the new total size of the
+                 cached files
+        """
+        hasher = hashlib.sha256()
+        with open(path, "rb") as fhin:
+            for block in iter(lambda: fhin.read(1024**2), b""):
+                hasher.update(block)
+        digest = hasher.hexdigest()
+        blob = self._path("objects", digest)
+        os.chmod(path, 0o444)
+        with self._locked("usage"):
+            nbytes = 0 if os.path.exists(blob) else os.path.getsize(path)
+            # If the same content is already there, it is replaced
+            os.replace(path, blob)
+            total = self._usage_update(nbytes)
+        index = self._index(location, variant)
+        with open(index + ".tmp", "w") as fhindex:
+            json.dump(
+                dict(
+                    location=location,
+                    variant=variant,
+                    digest=digest,
+                    stamp=time.time(),
+                ),
+                fhindex,
+            )
+        os.replace(index + ".tmp", index)
+        return blob, total
+
+    def forget(self, location):
+        """Forget about **location** (e.g. because it was overwritten)."""
+        shutil.rmtree(self._indexdir(location), ignore_errors=True)
+
+    def serve(self, blob, target, readonly=True):
+        """Create **target** from the **blob** cached file.
+
+        :param bool readonly: If ``False``, **target** may be modified: it
+                              must not be a hard link to the cached file.
+        :return: The method used (see :data:`ECFSCACHE_LINKS`)
+        """
+        links = self._links
+        if not readonly:
+            links = tuple(m for m in links if m != "hardlink") or ("copy",)
+        return link_or_copy(blob, target, links)
+
+    def evict(self):
+        """Remove the least recently used files until the cache is small enough."""
+        with self._locked("usage"):
+            blobs = self._objects()
+            total = sum(b[1] for b in blobs)
+            for _, size, path in sorted(blobs):
+                if total <= self._maxsize:
+                    break
+                LOG.debug("ECfs local cache: evicting %s", path)
+                with contextlib.suppress(FileNotFoundError):
+                    os.remove(path)
+                total -= size
+            self._usage_write(total)
+
+    def retrieve(self, location, target, fetch, variant="", readonly=True):
+        """Make a local copy of **location**, using the cache if possible.
+
+        Requests for the same **location** are serialised: the first one
+        calls **fetch** while the others wait and are served from the cache.
+
+        :param str location: The ECfs location
+        :param str target: The local file to be created
+        :param fetch: A callable that retrieves **location** into a given
+                      path and returns a return code
+        :param str variant: Anything that alters the retrieved file (e.g. the
+                            compression pipeline description)
+        :param bool readonly: If ``False``, **target** may be modified (see
+                              :meth:`serve`)
+        :return: return code
+        """
+        key = self._key(location)
+        fetching = False
+        total = None
+        try:
+            with self._locked(key):
+                blob = self.lookup(location, variant)
+                if blob is None:
+                    tmpdir = os.path.join(self._rootdir, "tmp")
+                    os.makedirs(tmpdir, exist_ok=True)
+                    fd, tmp = tempfile.mkstemp(prefix=key[:8], dir=tmpdir)
+                    os.close(fd)
+                    try:
+                        fetching = True
+                        rc = fetch(tmp)
+                        fetching = False
+                        if not (rc and os.path.isfile(tmp)):
+                            # Not a plain file: it can not be cached
+                            if rc:
+                                shutil.move(tmp, target)
+                            return rc
+                        blob, total = self._store(location, variant, tmp)
+                    finally:
+                        if os.path.isfile(tmp):
+                            os.remove(tmp)
+                    LOG.info("ECfs local cache: %s retrieved", location)
+                else:
+                    LOG.info("ECfs local cache: %s is available", location)
+                method = self.serve(blob, target, readonly=readonly)
+                LOG.debug("ECfs local cache: %s served by %s", target, method)
+            if total is not None and total > self._maxsize:
+                self.evict()
+        except OSError as e:
+            if fetching:
+                raise
+            LOG.warning("ECfs local cache failure (%s): %s", self._rootdir, e)
+            if not os.path.exists(target):
+                return fetch(target)
+        return True
@@ -0,0 +1,460 @@
+"""
+A local stand-in for the ECfs commands (for development and tests).
+
+The :class:`ECfsEmulator` class implements the ECfs commands used by
+:class:`~ecmwf.tools.ecfs.ECfsTools` (``ecp``, ``els``, ``etest``,
+``emkdir``, ``echmod``, ``erm``, ``emove`` and ``estage``) on top of a
+local directory tree: the ``ec:/path/to/file`` (resp.
+``ectmp:/path/to/file``) ECfs file is the ``<root>/ec/path/to/file`` (resp.
+``<root>/ectmp/path/to/file``) local file. Paths without a prefix are ECfs
+paths, except for ``ecp`` where they are local paths.
+
+Delays and failures can be injected:
+
+    * ``latency``: the delay (in seconds) of any command;
+    * ``recall_delay``: the time (in seconds) needed to recall a file from
+      tape. The files created by the emulator are on disk, the files
+      created by other means (e.g. copied into the tree by a test) are on
+      tape until they are read by ``ecp`` (which waits for the recall) or
+      recalled by ``estage``;
+    * ``failure_rate``: the probability that a command fails;
+    * ``bandwidth``: the ``ecp`` transfer rate (in bytes per second).
+
+The emulator is run as a command by adding a wrapper in front of the ECfs
+commands (see the ``ecfs_command_wrapper`` key of the ``ecmwf``
+configuration section in :class:`~ecmwf.tools.interfaces.ECMWFInterface`).
+For example, in Vortex' configuration file::
+
+    [ecmwf]
+    ecfs_command_wrapper = "python /path/to/ecfsemulator.py --root /tmp/ecfs --latency 0.2"
+
+This module only depends on the standard library: running it by its path
+(rather than with ``python -m``) avoids loading Vortex for each command.
+
+It may also act as a persistent helper process (see
+:mod:`ecmwf.tools.cmdsessions`), which avoids one Python start per
+command::
+
+    [ecmwf]
+    ecfs_session_command = "python /path/to/ecfsemulator.py --root /tmp/ecfs --session"
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import random
+import shutil
+import stat
+import sys
+import time
+import zlib
+
+#: No automatic export
+__all__ = []
+
+#: The emulated ECfs commands
+ECFSEMULATOR_COMMANDS = (
+    "echmod",
+    "ecp",
+    "els",
+    "emkdir",
+    "emove",
+    "erm",
+    "estage",
+    "etest",
+)
+
+#: The ECfs prefixes (and the corresponding sub-directories of the tree)
+ECFSEMULATOR_PREFIXES = dict(ec="ec", ectmp="ectmp")
+
+
+class ECfsEmulatorError(Exception):
+    """An ECfs command fails (the message is printed on the standard error)."""
+
+    pass
+
+
+class ECfsEmulator:
+    """Emulate the ECfs commands on top of the **root** local directory."""
+
+    def __init__(
+        self,
+        root,
+        latency=0.0,
+        recall_delay=0.0,
+        failure_rate=0.0,
+        bandwidth=0.0,
+        seed=None,
+    ):
+        """
+        :param str root: The directory where the ECfs files are stored
+        :param float latency: The delay of any command (in seconds)
+        :param float recall_delay: The tape recall delay (in seconds)
+        :param float failure_rate: The probability that a command fails
+        :param float bandwidth: The ``ecp`` transfer rate (in bytes per
+                                second, unlimited if zero)
+        :param seed: The seed of the failures random generator
+        """
+        # The session requests may change the current directory
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.recall_delay = recall_delay
+        self.failure_rate = failure_rate
+        self.bandwidth = bandwidth
+        self._random = random.Random(seed)
+
+    def remote_path(self, path, prefixed=False):
+        """The local path of the **path** ECfs file.
+
+        :param bool prefixed: Paths without an ECfs prefix are local paths
+        :return: The local path (``None`` if **path** is a local path)
+        """
+        prefix, sep, rpath = path.partition(":")
+        if not sep or prefix not in ECFSEMULATOR_PREFIXES:
+            if prefixed:
+                return None
+            prefix, rpath = "ec", path
+        return os.path.join(
+            self.root, ECFSEMULATOR_PREFIXES[prefix], rpath.lstrip("/")
+        )
+
+    def _marker(self, local):
+        """The file that tells when the **local** remote file is on disk."""
+        return os.path.join(
+            self.root, "state", os.path.relpath(local, self.root)
+        )
+
+    def _set_online(self, local, when=0.0):
+        """Record that **local** is on disk from the **when** time on."""
+        marker = self._marker(local)
+        os.makedirs(os.path.dirname(marker), exist_ok=True)
+        with open(marker, "w") as fhmarker:
+            fhmarker.write(repr(when))
+
+    def _online_time(self, local):
+        """When **local** is on disk (``None`` if no recall is requested)."""
+        if self.recall_delay <= 0:
+            return 0.0
+        try:
+            with open(self._marker(local)) as fhmarker:
+                return float(fhmarker.read())
+        except (OSError, ValueError):
+            return None
+
+    def _forget(self, local):
+        """Forget about the tape status of **local** (and of its content)."""
+        marker = self._marker(local)
+        if os.path.isdir(marker):
+            shutil.rmtree(marker)
+        elif os.path.exists(marker):
+            os.remove(marker)
+
+    def _recall(self, local):
+        """Start the recall of **local** and return when it is on disk."""
+        when = self._online_time(local)
+        if when is None:
+            when = time.time() + self.recall_delay
+            self._set_online(local, when)
+        return when
+
+    @staticmethod
+    def _tape(local):
+        """The (fake) tape name: the files of a directory share their tape."""
+        return "T{:04d}".format(
+            zlib.crc32(os.path.dirname(local).encode()) % 10000
+        )
+
+    def _copy(self, source, target):
+        """Copy **source** into **target** at the emulated bandwidth."""
+        with open(source, "rb") as fhin, open(target, "wb") as fhout:
+            if self.bandwidth <= 0:
+                shutil.copyfileobj(fhin, fhout)
+                return
+            t0 = time.monotonic()
+            done = 0
+            for chunk in iter(lambda: fhin.read(1024 * 1024), b""):
+                fhout.write(chunk)
+                done += len(chunk)
+                delay = done / self.bandwidth - (time.monotonic() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+
+    @staticmethod
+    def _parse(args):
+        """Split the arguments into a set of flags and a list of paths."""
+        flags = set()
+        paths = list()
+        for arg in args:
+            if arg.startswith("-") and len(arg) > 1:
+                flags.update(arg[1:])
+            else:
+                paths.append(arg)
+        return flags, paths
+
+    def run(self, argv, stdout=None, stderr=None):
+        """Run the **argv** ECfs command line.
+
+        :param list argv: The command line (the command name first)
+        :param stdout: The standard output (default: ``sys.stdout``)
+        :param stderr: The standard error (default: ``sys.stderr``)
+        :return: The command's exit code
+        """
+        stdout = sys.stdout if stdout is None else stdout
+        stderr = sys.stderr if stderr is None else stderr
+        command = os.path.basename(argv[0]) if argv else ""
+        if command not in ECFSEMULATOR_COMMANDS:
+            stderr.write("Unknown ECfs command: {!r}\n".format(command))
+            return 127
+        time.sleep(self.latency)
+        try:
+            if self._random.random() < self.failure_rate:
+                raise ECfsEmulatorError("injected failure")
+            flags, paths = self._parse(argv[1:])
+            return getattr(self, "_" + command)(flags, paths, stdout)
+        except (ECfsEmulatorError, OSError) as e:
+            stderr.write("{:s}: {!s}\n".format(command, e))
+            return 1
+
+    def _etest(self, flags, paths, stdout):
+        local = self.remote_path(paths[0])
+        if "d" in flags:
+            return 0 if os.path.isdir(local) else 1
+        if "f" in flags:
+            return 0 if os.path.isfile(local) else 1
+        return 0 if os.path.exists(local) else 1
+
+    def _els(self, flags, paths, stdout):
+        for path in paths:
+            local = self.remote_path(path)
+            if os.path.isdir(local):
+                names = sorted(os.listdir(local))
+                items = [(name, os.path.join(local, name)) for name in names]
+            elif os.path.exists(local):
+                items = [(os.path.basename(local), local)]
+            else:
+                raise ECfsEmulatorError(
+                    "{:s}: No such file or directory".format(path)
+                )
+            for name, item in items:
+                if "l" in flags:
+                    st = os.stat(item)
+                    stdout.write(
+                        "{:s} {:12d} {:s} {:s}\n".format(
+                            stat.filemode(st.st_mode),
+                            st.st_size,
+                            time.strftime(
+                                "%Y-%m-%d %H:%M", time.gmtime(st.st_mtime)
+                            ),
+                            name,
+                        )
+                    )
+                else:
+                    stdout.write(name + "\n")
+        return 0
+
+    def _emkdir(self, flags, paths, stdout):
+        for path in paths:
+            local = self.remote_path(path)
+            if "p" in flags:
+                os.makedirs(local, exist_ok=True)
+            else:
+                os.mkdir(local)
+        return 0
+
+    def _echmod(self, flags, paths, stdout):
+        mode = int(paths[0], 8)
+        for path in paths[1:]:
+            os.chmod(self.remote_path(path), mode)
+        return 0
+
+    def _erm(self, flags, paths, stdout):
+        for path in paths:
+            local = self.remote_path(path)
+            if os.path.isdir(local):
+                if not flags & {"r", "R"}:
+                    raise ECfsEmulatorError(
+                        "{:s}: Is a directory".format(path)
+                    )
+                shutil.rmtree(local)
+            elif os.path.exists(local):
+                os.remove(local)
+            elif "f" not in flags:
+                raise ECfsEmulatorError(
+                    "{:s}: No such file or directory".format(path)
+                )
+            self._forget(local)
+        return 0
+
+    def _emove(self, flags, paths, stdout):
+        source, target = [self.remote_path(path) for path in paths]
+        if os.path.isdir(target):
+            target = os.path.join(target, os.path.basename(source))
+        os.replace(source, target)
+        self._forget(target)
+        if os.path.exists(self._marker(source)):
+            os.makedirs(os.path.dirname(self._marker(target)), exist_ok=True)
+            os.replace(self._marker(source), self._marker(target))
+        return 0
+
+    def _estage(self, flags, paths, stdout):
+        for path in paths:
+            local = self.remote_path(path)
+            if not os.path.isfile(local):
+                continue
+            if "q" in flags:
+                when = self._online_time(local)
+                stdout.write(
+                    "{:s} {:s} {:s}\n".format(
+                        path,
+                        self._tape(local),
+                        "online"
+                        if when is not None and when <= time.time()
+                        else "offline",
+                    )
+                )
+            else:
+                self._recall(local)
+        return 0
+
+    def _ecp(self, flags, paths, stdout):
+        if len(paths) < 2:
+            raise ECfsEmulatorError("Source and target files are needed")
+        sources, target = paths[:-1], paths[-1]
+        rtarget = self.remote_path(target, prefixed=True)
+        for source in sources:
+            rsource = self.remote_path(source, prefixed=True)
+            local_source = source if rsource is None else rsource
+            if not os.path.exists(local_source):
+                raise ECfsEmulatorError(
+                    "{:s}: No such file or directory".format(source)
+                )
+            local_target = target if rtarget is None else rtarget
+            if os.path.isdir(local_target):
+                local_target = os.path.join(
+                    local_target, os.path.basename(local_source)
+                )
+            if os.path.isfile(local_target) and "o" not in flags:
+                if flags & {"e", "u"} and os.path.getmtime(
+                    local_target
+                ) >= os.path.getmtime(local_source):
+                    continue
+                raise ECfsEmulatorError(
+                    "{:s}: File exists".format(local_target)
+                )
+            if rsource is not None:
+                time.sleep(max(0, self._recall(rsource) - time.time()))
+            self._copy(local_source, local_target)
+            if (
+                "p" in flags
+                and os.path.isfile(local_source)
+                and os.path.isfile(local_target)
+            ):
+                shutil.copystat(local_source, local_target)
+            if rtarget is not None:
+                self._set_online(local_target)
+        return 0
+
+    def serve(self, stdin=None, stdout=None):
+        """Act as a persistent helper process (see :mod:`ecmwf.tools.cmdsessions`)."""
+        stdin = sys.stdin if stdin is None else stdin
+        stdout = sys.stdout if stdout is None else stdout
+        for line in stdin:
+            out = io.StringIO()
+            err = io.StringIO()
+            try:
+                request = json.loads(line)
+                with _request_context(request):
+                    rc = self.run(request["argv"], stdout=out, stderr=err)
+            except (ValueError, KeyError, TypeError) as e:
+                rc = 127
+                err.write(str(e) + "\n")
+            stdout.write(
+                json.dumps(
+                    dict(rc=rc, stdout=out.getvalue(), stderr=err.getvalue())
+                )
+                + "\n"
+            )
+            stdout.flush()
+
+
+@contextlib.contextmanager
+def _request_context(request):
+    """Run in the directory and environment of a session **request**."""
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+        if request.get("cwd") is not None:
+            os.chdir(request["cwd"])
+        if request.get("env") is not None:
+            os.environ.clear()
+            os.environ.update(request["env"])
+        yield
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def main(argv=None):
+    """The command line interface (see the module's documentation)."""
+    parser = argparse.ArgumentParser(
+        description="A local stand-in for the ECfs commands."
+    )
+    parser.add_argument(
+        "--root", required=True, help="The directory of the ECfs files"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="The delay of any command in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--recall-delay",
+        type=float,
+        default=0.0,
+        help="The tape recall delay in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="The probability that a command fails (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="The ecp transfer rate in bytes per second "
+        + "(0 means unlimited, default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="The seed of the failures random generator"
+    )
+    parser.add_argument(
+        "--session",
+        action="store_true",
+        help="Act as a persistent helper process",
+    )
+    parser.add_argument(
+        "command", nargs=argparse.REMAINDER, help="The ECfs command line"
+    )
+    args = parser.parse_args(argv)
+    emulator = ECfsEmulator(
+        args.root,
+        latency=args.latency,
+        recall_delay=args.recall_delay,
+        failure_rate=args.failure_rate,
+        bandwidth=args.bandwidth,
+        seed=args.seed,
+    )
+    if args.session:
+        emulator.serve()
+        return 0
+    return emulator.run(args.command)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
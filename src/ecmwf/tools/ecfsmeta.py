@@ -0,0 +1,267 @@
+"""
+A local on-disk cache for ECfs metadata (files existence and listings).
+
+Spawning an ``etest`` or an ``els`` command is slow: the answers are kept in
+a SQLite database so that they can be reused (by the current process and by
+the other processes of the same job) until they expire.
+
+The cache is disabled by default (see :func:`ecfsmeta_from_config`). Only
+positive answers are cached: a file that is not found is always looked for
+again since it may have been created by someone else in the meantime.
+"""
+
+import json
+import logging
+import os
+import posixpath
+import sqlite3
+import tempfile
+import threading
+import time
+
+from vortex.config import get_from_config_w_default
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+_ECFSMETA_SCHEMA = """
+CREATE TABLE IF NOT EXISTS ecfsmeta (
+    kind TEXT NOT NULL,
+    path TEXT NOT NULL,
+    options TEXT NOT NULL,
+    value TEXT NOT NULL,
+    stamp REAL NOT NULL,
+    atime REAL NOT NULL,
+    PRIMARY KEY (kind, path, options)
+)
+"""
+
+
+def ecfsmeta_from_config():
+    """Create an :class:`ECfsMetadataCache` object given Vortex' configuration.
+
+    The following keys of the ``ecmwf`` configuration section are used:
+
+        * ``ecfs_metacache_ttl``: The entries lifetime in seconds (default:
+          0). If zero, the cache is disabled (``None`` is returned);
+        * ``ecfs_metacache_size``: The maximum number of entries in the
+          cache (default: 50000);
+        * ``ecfs_metacache_path``: The path to the SQLite database (default:
+          ``vortex_ecfsmeta_<uid>/ecfs_metacache.db`` in the temporary
+          directory, that is ``$TMPDIR`` which is usually node-local and
+          specific to the job on batch systems). SQLite databases must not
+          be located on a shared (e.g. NFS) filesystem.
+
+    :return: An :class:`ECfsMetadataCache` object or ``None``
+    """
+    ttl = float(
+        get_from_config_w_default(
+            section="ecmwf", key="ecfs_metacache_ttl", default=0
+        )
+    )
+    if ttl <= 0:
+        return None
+    dbpath = get_from_config_w_default(
+        section="ecmwf", key="ecfs_metacache_path", default=None
+    )
+    if dbpath is None:
+        dbpath = os.path.join(
+            tempfile.gettempdir(),
+            "vortex_ecfsmeta_{:d}".format(os.getuid()),
+            "ecfs_metacache.db",
+        )
+    maxentries = get_from_config_w_default(
+        section="ecmwf", key="ecfs_metacache_size", default=50000
+    )
+    return ECfsMetadataCache(dbpath, ttl=ttl, maxentries=int(maxentries))
+
+
+class ECfsMetadataCache:
+    """Cache ECfs metadata in a SQLite database.
+
+    Three kinds of entries are stored:
+
+        * ``test``: the result of an existence test on a given path;
+        * ``dir``: the list of the names contained in a given directory
+          (it answers the existence tests for all the files of the directory);
+        * ``ls``: the raw output of an ``els`` command (given its options).
+
+    Entries expire **ttl** seconds after their creation. When the cache
+    contains more than **maxentries** entries, the least recently used ones
+    are discarded.
+
+    Negative existence tests are never recorded and a directory listing
+    only answers positively for the files it contains.
+
+    Any database error is logged and processed as a cache miss: the cache
+    never prevents the actual ECfs command to be run. The database connection
+    is not shared with forked child processes (they open their own).
+    """
+
+    def __init__(self, dbpath, ttl=600, maxentries=50000):
+        """
+        :param str dbpath: The path to the SQLite database
+        :param float ttl: The entries lifetime (in seconds)
+        :param int maxentries: The maximum number of entries
+        """
+        self._dbpath = dbpath
+        self._ttl = ttl
+        self._maxentries = maxentries
+        self._lock = threading.Lock()
+        self._db = None
+        self._pid = os.getpid()
+
+    @property
+    def dbpath(self):
+        """The path to the SQLite database."""
+        return self._dbpath
+
+    @property
+    def ttl(self):
+        """The entries lifetime (in seconds)."""
+        return self._ttl
+
+    @property
+    def maxentries(self):
+        """The maximum number of entries."""
+        return self._maxentries
+
+    def _check_fork(self):
+        """Drop the connection and lock inherited from a parent process."""
+        if self._pid != os.getpid():
+            # The inherited connection must not be used (nor closed)
+            self._db = None
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+
+    def _connect(self):
+        """Open the database (if not done already)."""
+        if self._db is None:
+            dbdir = os.path.dirname(os.path.abspath(self._dbpath))
+            os.makedirs(dbdir, exist_ok=True)
+            self._db = sqlite3.connect(
+                self._dbpath, timeout=10, check_same_thread=False
+            )
+            with self._db:
+                self._db.execute(_ECFSMETA_SCHEMA)
+        return self._db
+
+    def _run(self, action, *kargs):
+        """Run **action** (given an open database) in a transaction."""
+        self._check_fork()
+        with self._lock:
+            try:
+                db = self._connect()
+                with db:
+                    return action(db, *kargs)
+            except (OSError, sqlite3.Error) as e:
+                LOG.warning(
+                    "ECfs metadata cache failure (%s): %s", self._dbpath, e
+                )
+                return None
+
+    def _fetch(self, db, kind, path, options=""):
+        now = time.time()
+        row = db.execute(
+            "SELECT value, stamp FROM ecfsmeta "
+            + "WHERE kind = ? AND path = ? AND options = ?",
+            (kind, path, options),
+        ).fetchone()
+        if row is None:
+            return None
+        if now - row[1] > self._ttl:
+            db.execute(
+                "DELETE FROM ecfsmeta "
+                + "WHERE kind = ? AND path = ? AND options = ?",
+                (kind, path, options),
+            )
+            return None
+        db.execute(
+            "UPDATE ecfsmeta SET atime = ? "
+            + "WHERE kind = ? AND path = ? AND options = ?",
+            (now, kind, path, options),
+        )
+        return json.loads(row[0])
+
+    def _store(self, db, kind, path, value, options=""):
+        now = time.time()
+        db.execute(
+            "INSERT OR REPLACE INTO ecfsmeta VALUES (?, ?, ?, ?, ?, ?)",
+            (kind, path, options, json.dumps(value), now, now),
+        )
+        (nentries,) = db.execute("SELECT COUNT(*) FROM ecfsmeta").fetchone()
+        if nentries > self._maxentries:
+            db.execute(
+                "DELETE FROM ecfsmeta WHERE rowid IN "
+                + "(SELECT rowid FROM ecfsmeta ORDER BY atime LIMIT ?)",
+                (nentries - self._maxentries,),
+            )
+
+    def test(self, path):
+        """Does **path** exist (``None`` if the answer is not cached) ?"""
+
+        def _test(db):
+            rc = self._fetch(db, "test", path)
+            if rc is None:
+                names = self._fetch(db, "dir", posixpath.dirname(path))
+                if names is not None and posixpath.basename(path) in names:
+                    rc = True
+            return rc
+
+        return self._run(_test)
+
+    def store_test(self, path, rc):
+        """Record the result of an existence test on **path** (if positive)."""
+        if rc:
+            self._run(self._store, "test", path, True)
+
+    def directory(self, path):
+        """The names contained in the **path** directory (or ``None``)."""
+        return self._run(self._fetch, "dir", path)
+
+    def store_directory(self, path, names):
+        """Record the list of the **names** contained in the **path** directory."""
+        self._run(self._store, "dir", path, sorted(names))
+
+    def listing(self, path, options):
+        """The output of ``els`` for **path** and **options** (or ``None``)."""
+        return self._run(self._fetch, "ls", path, ",".join(options))
+
+    def store_listing(self, path, options, lines):
+        """Record the output of ``els`` for **path** and **options**."""
+        self._run(self._store, "ls", path, list(lines), ",".join(options))
+
+    def invalidate(self, path):
+        """Forget anything about **path**, its ancestors and its descendants."""
+        paths = [path.rstrip("/") or path]
+        while True:
+            parent = posixpath.dirname(paths[-1])
+            if not parent or parent == paths[-1]:
+                break
+            paths.append(parent)
+        prefix = paths[0] + "/"
+
+        def _invalidate(db):
+            db.execute(
+                "DELETE FROM ecfsmeta WHERE path IN ({:s}) ".format(
+                    ", ".join(["?"] * len(paths))
+                )
+                + "OR substr(path, 1, ?) = ?",
+                paths + [len(prefix), prefix],
+            )
+
+        self._run(_invalidate)
+
+    def clear(self):
+        """Remove all the entries."""
+        self._run(lambda db: db.execute("DELETE FROM ecfsmeta"))
+
+    def close(self):
+        """Close the database."""
+        self._check_fork()
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -2,14 +2,35 @@
 System Addons to support ECMWF' EcTrans data transfert tool.
 """
 
+import asyncio
+import contextlib
+import functools
 import logging
+import os
+import posixpath
+import re
+import tempfile
+import threading
+import time
+from collections import namedtuple
 
 import footprints
-from vortex.config import from_config
+from vortex import config
+from vortex.config import from_config, get_from_config_w_default
 from vortex.tools import addons
-from vortex.tools.systems import OSExtended, fmtshcmd
+from vortex.tools.systems import ExecutionError, OSExtended, fmtshcmd
 
+from . import checksums, metrics
+from .coalescing import coalesced, coalescing_key
 from .interfaces import ECtrans
+from .streams import (
+    compress2fifo,
+    compress2file,
+    fifo2fileobj,
+    fifo2uncompress,
+    file2uncompress,
+    fileobj2fifo,
+)
 
 #: No automatic export
 __all__ = []
@@ -35,6 +56,240 @@ class ECtransConfigurationError(ECtransError):
     pass
 
 
+#: Definition of a named tuple EctransStatusTuple
+EctransStatusTuple = namedtuple(
+    "EctransStatusTuple", ["pending", "done", "failed", "unknown"]
+)
+
+#: Predefined ECtrans transfers status values
+ectrans_status = EctransStatusTuple(
+    pending="pending", done="done", failed="failed", unknown="unknown"
+)
+
+#: A pre-resolved ECtrans gateway and remote pair (see
+#: :meth:`ECtransTools.ectrans_endpoint`)
+ECtransEndpoint = namedtuple("ECtransEndpoint", ["gateway", "remote"])
+
+#: How the status words displayed by ``ectrans -list`` are interpreted
+#: (the exact wording is not documented: this list is an assumption that may
+#: need to be adapted to the ECtrans version actually in use)
+_ECTRANS_STATUS_WORDS = {
+    "completed": ectrans_status.done,
+    "complete": ectrans_status.done,
+    "done": ectrans_status.done,
+    "success": ectrans_status.done,
+    "failed": ectrans_status.failed,
+    "error": ectrans_status.failed,
+    "stopped": ectrans_status.failed,
+    "aborted": ectrans_status.failed,
+    "queued": ectrans_status.pending,
+    "waiting": ectrans_status.pending,
+    "retrying": ectrans_status.pending,
+    "active": ectrans_status.pending,
+    "running": ectrans_status.pending,
+    "transferring": ectrans_status.pending,
+}
+
+#: The request ID is assumed to be displayed as ``request ID: <digits>`` by
+#: asynchronous ``ectrans`` commands (e.g. ``ECtrans: request ID: 1001``)
+_ECTRANS_REQID_RE = re.compile(
+    r"request(?:[\s_-]*id)?\s*[:=#]?\s*(?P<reqid>\d+)", re.IGNORECASE
+)
+
+
+class EctransTransfer:
+    """Describe an asynchronous ECtrans transfer (see :class:`AsyncEctransQueue`)."""
+
+    def __init__(self, source, target, deadline):
+        self.source = source
+        self.target = target
+        #: The ECtrans request ID (``None`` if it could not be found out)
+        self.request_id = None
+        #: The transfer status (see :data:`ectrans_status`)
+        self.status = ectrans_status.pending
+        #: Give up waiting after this date (in seconds since the epoch)
+        self.deadline = deadline
+        self.task = None
+
+    @property
+    def finished(self):
+        """Is the transfer over (successfully or not) ?"""
+        return self.status != ectrans_status.pending
+
+    def __str__(self):
+        return "<{:s} {:s} -> {:s} | request_id={!s} status={:s}>".format(
+            self.__class__.__name__,
+            self.source,
+            self.target,
+            self.request_id,
+            self.status,
+        )
+
+
+class AsyncEctransQueue:
+    """Submit many asynchronous ECtrans transfers and track their completion.
+
+    Transfers are submitted with ``sync=False`` (the ECtrans gateway retries
+    them for up to ``retryCnt * retryFrq`` seconds). The request ID returned
+    by the ``ectrans`` command is recorded and the transfer status is
+    obtained by polling ``ectrans -list`` (a unique listing is shared by all
+    the transfers tracked by the queue). Asynchronous transfers must be
+    submitted within a running asyncio event loop. Example::
+
+        async def disseminate(sh, todo):
+            queue = sh.ectransqueue()
+            transfers = [queue.submit(s, t, gateway=g, remote=r)
+                         for s, t in todo]
+            await queue.join()
+            return [t.status for t in transfers]
+
+    Synchronous code should rather use :meth:`ECtransTools.ectransbatchsubmit`.
+
+    :note: The format of the ``ectrans`` output is not documented. The
+           request ID is assumed to be displayed as ``request ID: <digits>``
+           and each line of the ``ectrans -list`` output is assumed to
+           contain the request ID and a status word (``completed``,
+           ``failed``, ``queued``, ...). Any output that does not match these
+           assumptions is treated as an error (i.e. the transfer is
+           considered failed). If ``ectrans -list`` itself fails, the
+           transfers keep their status and the listing is retried (with an
+           increasing delay): a transfer whose status could not be obtained
+           before its deadline is given the ``unknown`` status.
+
+    :note: The ``ectrans_maxinflight`` and ``ectrans_pollfreq`` keys of the
+           ``ecmwf`` configuration section provide the default number of
+           transfers being tracked simultaneously (default: 16) and the
+           polling period in seconds (default: 60).
+
+    :note: If an **endpoint** (see :class:`ECtransEndpoint`) is provided,
+           it gives the default gateway and remote of the submitted
+           transfers.
+    """
+
+    def __init__(self, sh, maxinflight=None, pollfreq=None, endpoint=None):
+        if maxinflight is None:
+            maxinflight = get_from_config_w_default(
+                section="ecmwf", key="ectrans_maxinflight", default=16
+            )
+        if pollfreq is None:
+            pollfreq = get_from_config_w_default(
+                section="ecmwf", key="ectrans_pollfreq", default=60
+            )
+        self._sh = sh
+        self._maxinflight = int(maxinflight)
+        self._pollfreq = float(pollfreq)
+        self._semaphore = None
+        self._listing = dict()
+        self._listing_time = None
+        self._listing_lock = None
+        self._transfers = list()
+        self._endpoint = endpoint
+
+    @property
+    def transfers(self):
+        """The list of transfers submitted so far."""
+        return list(self._transfers)
+
+    def _async_init(self):
+        """asyncio objects must be created within the running event loop."""
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self._maxinflight)
+            self._listing_lock = asyncio.Lock()
+
+    async def _refresh_listing(self):
+        """Run ``ectrans -list`` unless a fresh enough listing is available."""
+        async with self._listing_lock:
+            now = time.monotonic()
+            if (
+                self._listing_time is None
+                or now - self._listing_time >= self._pollfreq / 2
+            ):
+                loop = asyncio.get_running_loop()
+                try:
+                    self._listing = await loop.run_in_executor(
+                        None, self._sh.ectransstatus
+                    )
+                except ECtransError as e:
+                    LOG.error(
+                        "Unable to get the ECtrans requests status: %s", e
+                    )
+                    self._listing = None
+                self._listing_time = time.monotonic()
+        return self._listing
+
+    async def _track(self, transfer, kwargs):
+        """Submit the **transfer** and poll until it is over."""
+        loop = asyncio.get_running_loop()
+        async with self._semaphore:
+            rc, transfer.request_id = await loop.run_in_executor(
+                None,
+                lambda: self._sh.ectranssubmit(
+                    transfer.source, transfer.target, **kwargs
+                ),
+            )
+            if not rc:
+                transfer.status = ectrans_status.failed
+            elif transfer.request_id is None:
+                LOG.error("No request ID could be parsed for: %s", transfer)
+                transfer.status = ectrans_status.failed
+            delay = self._pollfreq
+            while not transfer.finished:
+                await asyncio.sleep(delay)
+                listing = await self._refresh_listing()
+                if listing is None:
+                    # The gateway may still be sending the data: try again
+                    delay = min(2 * delay, 16 * self._pollfreq)
+                else:
+                    delay = self._pollfreq
+                    transfer.status = listing.get(
+                        transfer.request_id, ectrans_status.pending
+                    )
+                if not transfer.finished and time.time() > transfer.deadline:
+                    LOG.warning("Giving up on: %s", transfer)
+                    transfer.status = ectrans_status.unknown
+        return transfer
+
+    def submit(self, source, target, **kwargs):
+        """Submit an asynchronous transfer of **source** to **target**.
+
+        This method must be called within a running asyncio event loop. Any
+        argument accepted by :meth:`ECtransTools.raw_ectransput` may be
+        provided (except **sync**).
+
+        :return: An :class:`EctransTransfer` object
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            raise ECtransError(
+                "AsyncEctransQueue.submit must be called within a running "
+                + "event loop (use ectransbatchsubmit from synchronous code)"
+            )
+        self._async_init()
+        if self._endpoint is not None:
+            for k, v in self._endpoint._asdict().items():
+                kwargs.setdefault(k, v)
+        retrycnt = kwargs.get("retryCnt", 72)
+        retryfrq = kwargs.get("retryFrq", 600)
+        transfer = EctransTransfer(
+            source,
+            target,
+            deadline=time.time() + (retrycnt + 1) * retryfrq + self._pollfreq,
+        )
+        transfer.task = asyncio.ensure_future(self._track(transfer, kwargs))
+        self._transfers.append(transfer)
+        return transfer
+
+    async def wait(self, *transfers):
+        """Wait for the completion of the **transfers**."""
+        await asyncio.gather(*[t.task for t in transfers])
+        return transfers
+
+    async def join(self):
+        """Wait for the completion of all the submitted transfers."""
+        return await self.wait(*self._transfers)
+
+
 class ECtransTools(addons.Addon):
     """
     Handle ECtrans use properly within Vortex.
@@ -63,9 +318,57 @@ class ECtransTools(addons.Addon):
     remote: str | None
     sh: OSExtended
 
+    def __init__(self, *kargs, **kwargs):
+        super().__init__(*kargs, **kwargs)
+        self._ectransinterface = ECtrans(system=self.sh)
+        self._ectrans_stamp = None
+        self._ectrans_resolved = dict()
+        self._ectranslistings_lock = threading.Lock()
+        self._ectranslistings = dict()
+
+    def _ectrans_resolved_cache(self):
+        """The cache of the values resolved by :meth:`_ectrans_resolve`.
+
+        It is emptied whenever the ``ectrans`` configuration section or the
+        environment object are replaced (e.g. when the configuration is
+        reloaded or when a new environment is activated). In-place
+        modifications are not noticed: see :meth:`ectrans_reset`.
+        """
+        stamp = (config.VORTEX_CONFIG.get("ectrans"), self.sh.env)
+        if self._ectrans_stamp is None or any(
+            a is not b for a, b in zip(stamp, self._ectrans_stamp)
+        ):
+            self._ectrans_stamp = stamp
+            self._ectrans_resolved = dict()
+        return self._ectrans_resolved
+
+    def ectrans_reset(self):
+        """Forget the gateway and remote values that were already resolved.
+
+        This is needed if the ``ectrans`` configuration section or the
+        environment variables it refers to are modified in place.
+        """
+        self._ectrans_stamp = None
+        self._ectrans_resolved = dict()
+
+    def _ectrans_resolve(self, key):
+        """Read **key** in the ``ectrans`` configuration section.
+
+        If the value is the name of an environment variable, the variable's
+        value is returned.
+        """
+        cache = self._ectrans_resolved_cache()
+        if key not in cache:
+            value = from_config("ectrans", key)
+            if isinstance(value, str) and value in self.sh.env:
+                value = self.sh.env[value]
+            cache[key] = value
+        return cache[key]
+
     def ectrans_gateway_init(self, gateway=None):
         """Initialize the gateway attribute used by ECtrans.
 
+        :param gateway: the gateway to be used (overrides the configuration)
         :return: the gateway to be used by ECtrans
         """
         if self.gateway is not None:
@@ -74,27 +377,44 @@ class ECtransTools(addons.Addon):
         if gateway is not None:
             return gateway
 
-        gateway = from_config("ectrans", "gateway")
-        if gateway in self.sh.env:
-            return self.sh.env[gateway]
-        return gateway
+        return self._ectrans_resolve("gateway")
 
-    def ectrans_remote_init(self, storage=None):
+    def ectrans_remote_init(self, storage=None, remote=None):
         """Initialize the remote attribute used by Ectrans.
 
         :param storage: the store place
+        :param remote: the remote to be used (overrides the configuration)
         :return: the remote to be used by ECtrans
         """
         if self.remote is not None:
             return self.remote
 
+        if remote is not None:
+            return remote
+
         if storage is None:
             storage = "default"
 
-        remote = from_config("ectrans", f"remote_{storage}")
-        if remote in self.sh.env:
-            return self.sh.env[remote]
-        return remote
+        return self._ectrans_resolve(f"remote_{storage}")
+
+    def ectrans_endpoint(self, storage=None, gateway=None, remote=None):
+        """Resolve the gateway and remote used by ECtrans once and for all.
+
+        The result can be reused for many transfers. Example::
+
+            endpoint = sh.ectrans_endpoint(storage="myhost")
+            for source, target in todo:
+                sh.ectransput(source, target, **endpoint._asdict())
+
+        :param storage: the store place
+        :param gateway: the gateway to be used (overrides the configuration)
+        :param remote: the remote to be used (overrides the configuration)
+        :return: an :class:`ECtransEndpoint` object
+        """
+        return ECtransEndpoint(
+            gateway=self.ectrans_gateway_init(gateway=gateway),
+            remote=self.ectrans_remote_init(storage=storage, remote=remote),
+        )
 
     @staticmethod
     def ectrans_defaults_init(**kwargs):
@@ -136,7 +456,7 @@ class ECtransTools(addons.Addon):
         :param bool sync: If False, allow asynchronous transfers.
         :return: return code
         """
-        ectrans = ECtrans(system=self.sh)
+        ectrans = self._ectransinterface
         list_args, list_options, dict_args = self.ectrans_defaults_init(
             sync=sync, **kwargs
         )
@@ -149,9 +469,316 @@ class ECtransTools(addons.Addon):
         rc = ectrans(
             list_args=list_args, list_options=list_options, dict_args=dict_args
         )
+        self._ectranslisting_forget(target, gateway, remote)
+        return rc
+
+    def ectranssubmit(
+        self, source, target, gateway=None, remote=None, **kwargs
+    ):
+        """Submit an asynchronous ECtrans transfer and return its request ID.
+
+        :param source: source file
+        :param target: target file
+        :param gateway: gateway used by ECtrans
+        :param remote: remote used by ECtrans
+        :return: a tuple: the return code and the request ID (``None`` if
+                 it can not be found in the ECtrans command output)
+
+        :note: The request ID is assumed to be displayed as
+               ``request ID: <digits>`` by the ``ectrans`` command.
+        """
+        ectrans = self._ectransinterface
+        list_args, list_options, dict_args = self.ectrans_defaults_init(
+            sync=False, **kwargs
+        )
+        dict_args["gateway"] = gateway
+        dict_args["remote"] = remote
+        dict_args["source"] = source
+        dict_args["target"] = target
+        output = ectrans(
+            list_args=list_args,
+            list_options=list_options,
+            dict_args=dict_args,
+            capture=True,
+        )
+        self._ectranslisting_forget(target, gateway, remote)
+        if output is False:
+            return False, None
+        for line in output:
+            m_reqid = _ECTRANS_REQID_RE.search(line)
+            if m_reqid:
+                return True, m_reqid.group("reqid")
+        return True, None
+
+    def ectransstatus(self):
+        """Return the status of the ECtrans requests listed by ``ectrans -list``.
+
+        :return: a dictionary that associates request IDs and their status (see
+                 :data:`ectrans_status`)
+        :raises ECtransError: if the ``ectrans -list`` command fails
+
+        :note: Each line of the ``ectrans -list`` output is assumed to contain
+               a request ID (the first numerical word) and a status word
+               (see :data:`_ECTRANS_STATUS_WORDS`). Lines without any
+               numerical word (e.g. headers) are ignored. A request whose
+               status word can not be recognised is considered failed.
+        """
+        ectrans = self._ectransinterface
+        output = ectrans(
+            list_args=list(),
+            list_options=[
+                "list",
+            ],
+            dict_args=dict(),
+            capture=True,
+            fatal=False,
+            silent=True,
+        )
+        if output is False:
+            raise ECtransError("The ectrans -list command failed")
+        listing = dict()
+        for line in output:
+            words = line.split()
+            reqids = [w for w in words if w.isdigit()]
+            if not reqids:
+                continue
+            statuses = [
+                _ECTRANS_STATUS_WORDS[w.lower()]
+                for w in words
+                if w.lower() in _ECTRANS_STATUS_WORDS
+            ]
+            if statuses:
+                listing[reqids[0]] = statuses[-1]
+            else:
+                LOG.error("Unable to parse the ECtrans status line: %s", line)
+                listing[reqids[0]] = ectrans_status.failed
+        return listing
+
+    def _ectranslisting(self, directory, gateway, remote):
+        """The names contained in the remote **directory**.
+
+        ECtrans has no standard listing command: the ``ectrans`` option that
+        lists a remote directory (if the remote supports it) must be given
+        by the ``ectrans_ls_option`` key of the ``ecmwf`` configuration
+        section. Otherwise, no listing is ever attempted.
+
+        Successful listings are cached for ``ectrans_listing_ttl`` seconds (a
+        key of the ``ecmwf`` configuration section, default: 600) so that
+        many checks on the same directory are answered by a unique
+        ``ectrans`` command.
+
+        :return: The list of names (``None`` if no listing is available)
+        """
+        lsoption = get_from_config_w_default(
+            section="ecmwf", key="ectrans_ls_option", default=None
+        )
+        if not lsoption:
+            return None
+        directory = directory.rstrip("/") or "/"
+        key = (gateway, remote, directory)
+        ttl = float(
+            get_from_config_w_default(
+                section="ecmwf", key="ectrans_listing_ttl", default=600
+            )
+        )
+        with self._ectranslistings_lock:
+            stamp, names = self._ectranslistings.get(key, (None, None))
+        if stamp is not None and time.monotonic() - stamp <= ttl:
+            return names
+        output = self._ectransinterface(
+            list_args=list(),
+            list_options=[lsoption],
+            dict_args=dict(gateway=gateway, remote=remote, source=directory),
+            capture=True,
+            fatal=False,
+            silent=True,
+        )
+        if output is False:
+            # Failures are not cached (the directory may be missing, or the
+            # listing may not be supported by the remote)
+            return None
+        names = sorted(
+            {
+                posixpath.basename(line.strip().rstrip("/"))
+                for line in output
+                if line.strip()
+            }
+        )
+        if ttl > 0:
+            with self._ectranslistings_lock:
+                self._ectranslistings[key] = (time.monotonic(), names)
+        return names
+
+    def _ectranslisting_forget(self, target, gateway, remote):
+        """Forget the cached listing of the directory that contains **target**."""
+        if isinstance(target, str):
+            directory = posixpath.dirname(target.rstrip("/")) or "/"
+            with self._ectranslistings_lock:
+                self._ectranslistings.pop((gateway, remote, directory), None)
+
+    def ectranslisting_clear(self):
+        """Forget all the cached remote listings."""
+        with self._ectranslistings_lock:
+            self._ectranslistings = dict()
+
+    @metrics.measured("ectrans", "test", answers=True)
+    def ectranstest(self, item, gateway=None, remote=None):
+        """Test the existence of a remote file (or directory).
+
+        The listing of the parent directory is obtained (and cached) using
+        the ``ectrans`` option given by the ``ectrans_ls_option`` key of the
+        ``ecmwf`` configuration section (there is no default). No data is
+        transferred.
+
+        :param item: the remote path
+        :param gateway: gateway used by ECtrans
+        :param remote: remote used by ECtrans
+        :return: ``True`` if **item** exists, ``False`` if it does not,
+                 ``None`` if no listing is available (see
+                 :meth:`ectransprobe`)
+        """
+        item = item.rstrip("/")
+        names = self._ectranslisting(
+            posixpath.dirname(item) or "/", gateway, remote
+        )
+        if names is None:
+            return None
+        return posixpath.basename(item) in names
+
+    @metrics.measured("ectrans", "probe", answers=True)
+    def ectransprobe(self, item, gateway=None, remote=None):
+        """Test the existence of a remote file by retrieving it.
+
+        The file is transferred into a temporary directory, then discarded:
+        this is only meant to be used when :meth:`ectranstest` can not tell.
+
+        :param item: the remote path
+        :param gateway: gateway used by ECtrans
+        :param remote: remote used by ECtrans
+        :return: ``True`` if **item** could be retrieved
+        """
+        list_args, list_options, dict_args = self.ectrans_defaults_init()
+        list_options.append("get")
+        with tempfile.TemporaryDirectory(prefix="vortex_ectransprobe_") as tmp:
+            dict_args["gateway"] = gateway
+            dict_args["remote"] = remote
+            dict_args["source"] = item
+            dict_args["target"] = os.path.join(tmp, "probe")
+            rc = self._ectransinterface(
+                list_args=list_args,
+                list_options=list_options,
+                dict_args=dict_args,
+                fatal=False,
+                silent=True,
+            )
+        return bool(rc)
+
+    @metrics.measured("ectrans", "ls")
+    def ectransls(self, location, gateway=None, remote=None):
+        """List a remote directory (see :meth:`ectranstest`).
+
+        :param location: the remote path
+        :param gateway: gateway used by ECtrans
+        :param remote: remote used by ECtrans
+        :return: the list of names contained in **location** if it is a
+                 directory, ``[basename]`` if it is a file, ``False``
+                 otherwise (or if no listing is available)
+        """
+        names = self._ectranslisting(location, gateway, remote)
+        if names is not None:
+            return names
+        if self.ectranstest(location, gateway=gateway, remote=remote):
+            return [posixpath.basename(location.rstrip("/"))]
+        return False
+
+    def ectransqueue(self, maxinflight=None, pollfreq=None, endpoint=None):
+        """Return an object that tracks many asynchronous ECtrans transfers.
+
+        :param int maxinflight: The maximum number of transfers being tracked
+        :param float pollfreq: The polling period (in seconds)
+        :param ECtransEndpoint endpoint: The default gateway and remote
+        :return: An :class:`AsyncEctransQueue` object
+        """
+        return AsyncEctransQueue(
+            self.sh,
+            maxinflight=maxinflight,
+            pollfreq=pollfreq,
+            endpoint=endpoint,
+        )
+
+    def ectransbatchsubmit(
+        self, todo, maxinflight=None, pollfreq=None, endpoint=None, **kwargs
+    ):
+        """Submit asynchronous ECtrans transfers and wait for their completion.
+
+        This is the entry point for synchronous code: an asyncio event loop
+        is run until all the transfers are over (see :class:`AsyncEctransQueue`).
+
+        :param todo: a list of (source, target) tuples
+        :param int maxinflight: The maximum number of transfers being tracked
+        :param float pollfreq: The polling period (in seconds)
+        :param ECtransEndpoint endpoint: The default gateway and remote
+        :param kwargs: any argument accepted by :meth:`AsyncEctransQueue.submit`
+        :return: the list of :class:`EctransTransfer` objects
+        """
+
+        async def _submit_all():
+            queue = self.ectransqueue(
+                maxinflight=maxinflight, pollfreq=pollfreq, endpoint=endpoint
+            )
+            transfers = [
+                queue.submit(source, target, **kwargs)
+                for source, target in todo
+            ]
+            await queue.join()
+            return transfers
+
+        return asyncio.run(_submit_all())
+
+    def _ectranschecksum_put(self, target, gateway, remote, hasher, sync):
+        """Send the checksum computed by **hasher** next to **target**.
+
+        It must be sent after the data (in the same way: with an
+        asynchronous transfer, it is queued after the data).
+        """
+        with self.sh.temporary_dir_context(prefix="ectrans_sum_") as tmpdir:
+            local = self.sh.path.join(tmpdir, "sidecar")
+            with open(local, "wb") as fhsum:
+                fhsum.write(checksums.sidecar_content(target, hasher))
+            return self.raw_ectransput(
+                source=local,
+                target=checksums.sidecar_path(target, hasher),
+                gateway=gateway,
+                remote=remote,
+                sync=sync,
+            )
+
+    def _ectranschecksum_verify(self, source, target, gateway, remote, hasher):
+        """Compare the checksum computed by **hasher** with the stored one.
+
+        If the checksums differ, **target** is removed.
+        """
+        content = None
+        with self.sh.temporary_dir_context(prefix="ectrans_sum_") as tmpdir:
+            local = self.sh.path.join(tmpdir, "sidecar")
+            try:
+                if self.raw_ectransget(
+                    source=checksums.sidecar_path(source, hasher),
+                    target=local,
+                    gateway=gateway,
+                    remote=remote,
+                ):
+                    with open(local, "rb") as fhsum:
+                        content = fhsum.read()
+            except (ExecutionError, OSError) as e:
+                LOG.warning("Could not get the checksum of %s: %s", source, e)
+        rc = checksums.verify(source, hasher, content)
+        if not rc:
+            self.sh.rm(target)
         return rc
 
     @fmtshcmd
+    @metrics.measured("ectrans", "put", nbytes="source")
     def ectransput(
         self,
         source,
@@ -172,31 +799,84 @@ class ECtransTools(addons.Addon):
         :param cpipeline: compression pipeline used if provided
         :param bool sync: If False, allow asynchronous transfers.
         :return: return code
+
+        :note: When a compression pipeline is provided, a temporary
+               compressed file is created. Streaming is opt-in: if the
+               ``ectrans_streaming`` key of the ``ecmwf`` configuration
+               section is true (default: false), the compressed data of
+               synchronous transfers are streamed to ``ectrans`` through a
+               named pipe.
+
+        :note: If the ``ectrans_checksum`` key of the ``ecmwf`` configuration
+               section is set, the checksum of the data sent is stored next
+               to **target** (see :mod:`ecmwf.tools.checksums`). It is
+               computed on the fly when the data are streamed or
+               compressed. Otherwise, the file is read once more to compute
+               it. The checksum of an asynchronous transfer is queued after
+               the data.
         """
-        if self.sh.is_iofile(source):
-            if cpipeline is None:
-                rc = self.raw_ectransput(
-                    source=source,
-                    target=target,
-                    gateway=gateway,
-                    remote=remote,
-                    sync=sync,
-                )
-            else:
-                csource = self.sh.safe_fileaddsuffix(source)
-                try:
-                    cpipeline.compress2file(source=source, destination=csource)
-                    rc = self.raw_ectransput(
-                        source=csource,
+        if not self.sh.is_iofile(source):
+            raise OSError("No such file or directory: {!r}".format(source))
+        hasher = checksums.new_hasher("ectrans")
+        streaming = sync and get_from_config_w_default(
+            section="ecmwf", key="ectrans_streaming", default=False
+        )
+        if cpipeline is None and not (streaming and hasher is not None):
+            if hasher is not None:
+                checksums.update_from_file(hasher, source)
+            rc = self.raw_ectransput(
+                source=source,
+                target=target,
+                gateway=gateway,
+                remote=remote,
+                sync=sync,
+            )
+        elif streaming:
+            rcs = list()
+            with contextlib.ExitStack() as stack:
+                if cpipeline is None:
+                    fhin = stack.enter_context(open(source, "rb"))
+                    fifo = stack.enter_context(
+                        fileobj2fifo(self.sh, fhin, rcs, hasher=hasher)
+                    )
+                else:
+                    fifo = stack.enter_context(
+                        compress2fifo(
+                            self.sh, cpipeline, source, rcs, hasher=hasher
+                        )
+                    )
+                rcs.append(
+                    self.raw_ectransput(
+                        source=fifo,
                         target=target,
                         gateway=gateway,
                         remote=remote,
                         sync=sync,
                     )
-                finally:
-                    self.sh.rm(csource)
+                )
+            rc = all(rcs)
         else:
-            raise OSError("No such file or directory: {!r}".format(source))
+            csource = self.sh.safe_fileaddsuffix(source)
+            try:
+                with metrics.compression_timer():
+                    rc = compress2file(
+                        self.sh, cpipeline, source, csource, hasher=hasher
+                    )
+                rc = rc and self.raw_ectransput(
+                    source=csource,
+                    target=target,
+                    gateway=gateway,
+                    remote=remote,
+                    sync=sync,
+                )
+                if rc:
+                    metrics.add_nbytes(self.sh.size(csource))
+            finally:
+                self.sh.rm(csource)
+        if rc and hasher is not None:
+            rc = self._ectranschecksum_put(
+                target, gateway, remote, hasher, sync
+            )
         return rc
 
     def raw_ectransget(self, source, target, gateway, remote):
@@ -208,7 +888,7 @@ class ECtransTools(addons.Addon):
         :param remote: remote used by ECtrans
         :return: return code
         """
-        ectrans = ECtrans(system=self.sh)
+        ectrans = self._ectransinterface
         list_args, list_options, dict_args = self.ectrans_defaults_init()
         list_options.append("get")
         dict_args["gateway"] = gateway
@@ -221,6 +901,7 @@ class ECtransTools(addons.Addon):
         return rc
 
     @fmtshcmd
+    @metrics.measured("ectrans", "get", nbytes="target")
     def ectransget(
         self, source, target, gateway=None, remote=None, cpipeline=None
     ):
@@ -234,13 +915,79 @@ class ECtransTools(addons.Addon):
         :param remote: remote used by ECtrans
         :param cpipeline: compression pipeline to be used if provided
         :return: return code
+
+        :note: When a compression pipeline is provided, a temporary
+               compressed file is created and uncompressed afterwards.
+               Streaming is opt-in: if the ``ectrans_streaming`` key of the
+               ``ecmwf`` configuration section is true (default: false),
+               ``ectrans`` writes into a named pipe and the data are
+               uncompressed on the fly.
+
+        :note: If the ``ectrans_checksum`` key of the ``ecmwf`` configuration
+               section is set, the checksum of the data received is compared
+               with the one stored by :meth:`ectransput` (see
+               :mod:`ecmwf.tools.checksums`). It is computed on the fly when
+               the data are streamed or uncompressed. Otherwise, the file
+               received is read once more to compute it.
+
+        :note: If the ``ectrans_coalescing`` key is true, concurrent
+               identical requests (from any thread or process of the node)
+               are coalesced (see :mod:`ecmwf.tools.coalescing`).
         """
+        return coalesced(
+            "ectrans",
+            coalescing_key(
+                "ectrans",
+                source,
+                gateway=gateway,
+                remote=remote,
+                cpipeline=getattr(cpipeline, "description_string", None),
+            ),
+            target,
+            functools.partial(
+                self._ectransget, source, target, gateway, remote, cpipeline
+            ),
+        )
+
+    def _ectransget(self, source, target, gateway, remote, cpipeline):
+        """See :meth:`ectransget` (without coalescing)."""
         if isinstance(target, str):
             self.sh.rm(target)
-        if cpipeline is None:
+        hasher = checksums.new_hasher("ectrans")
+        streaming = get_from_config_w_default(
+            section="ecmwf", key="ectrans_streaming", default=False
+        )
+        if cpipeline is None and (hasher is None or not streaming):
             rc = self.raw_ectransget(
                 source=source, target=target, gateway=gateway, remote=remote
             )
+            if rc and hasher is not None:
+                checksums.update_from_file(hasher, target)
+        elif streaming:
+            rcs = list()
+            with contextlib.ExitStack() as stack:
+                if cpipeline is None:
+                    fhout = stack.enter_context(open(target, "wb"))
+                    fifo = stack.enter_context(
+                        fifo2fileobj(self.sh, fhout, rcs, hasher=hasher)
+                    )
+                else:
+                    fifo = stack.enter_context(
+                        fifo2uncompress(
+                            self.sh, cpipeline, target, rcs, hasher=hasher
+                        )
+                    )
+                rcs.append(
+                    self.raw_ectransget(
+                        source=source,
+                        target=fifo,
+                        gateway=gateway,
+                        remote=remote,
+                    )
+                )
+            rc = all(rcs)
+            if not rc:
+                self.sh.rm(target)
         else:
             ctarget = self.sh.safe_fileaddsuffix(target)
             try:
@@ -250,9 +997,16 @@ class ECtransTools(addons.Addon):
                     gateway=gateway,
                     remote=remote,
                 )
-                rc = rc and cpipeline.file2uncompress(
-                    source=ctarget, destination=target
-                )
+                if rc:
+                    metrics.add_nbytes(self.sh.size(ctarget))
+                with metrics.compression_timer():
+                    rc = rc and file2uncompress(
+                        self.sh, cpipeline, ctarget, target, hasher=hasher
+                    )
             finally:
                 self.sh.rm(ctarget)
+        if rc and hasher is not None:
+            rc = self._ectranschecksum_verify(
+                source, target, gateway, remote, hasher
+            )
         return rc
@@ -0,0 +1,511 @@
+"""
+A local stand-in for the ``ectrans`` command (for development and tests).
+
+The :class:`ECtransEmulator` class implements the ``ectrans`` features used
+by :class:`~ecmwf.tools.ectrans.ECtransTools` on top of a local directory
+tree: the ``path/to/file`` file of the ``remote`` association of the
+``gateway`` gateway is the ``<root>/<gateway>/<remote>/path/to/file`` local
+file.
+
+    * ``-put`` (resp. ``-get``): synchronous transfers, tried
+      ``1 + retryCnt`` times (``retryFrq`` seconds apart);
+    * without ``-put`` or ``-get``: asynchronous transfers. The source file
+      is copied into a spool directory and the request is queued. A worker
+      process (started when needed) processes the queued requests one at
+      a time, by decreasing ``priority``, and retries the failed ones;
+    * ``-list``: the status of every request (``queued``, ``retrying``,
+      ``transferring``, ``completed`` or ``failed``);
+    * ``-ls``: the listing of a remote directory.
+
+Each request gets an ID (printed as ``ECtrans: request ID: <id>``) and its
+status is kept in the ``<root>/requests`` directory.
+
+Delays and failures can be injected:
+
+    * ``latency``: the delay (in seconds) of any command;
+    * ``bandwidth``: the transfer rate (in bytes per second);
+    * ``failure_rate``: the probability that a transfer attempt fails;
+    * ``time_scale``: the factor applied to the ``retryFrq`` delays (e.g.
+      ``0.01`` to retry after 1.2s rather than 120s).
+
+The emulator is put in front of the ``ectrans`` command with the
+``ectrans_command_wrapper`` key of the ``ecmwf`` configuration section. For
+example, in Vortex' configuration file::
+
+    [ecmwf]
+    ectrans_command_wrapper = "python /path/to/ectransemulator.py --root /tmp/ectrans --bandwidth 10e6"
+
+Like :mod:`ecmwf.tools.ecfsemulator`, this module only depends on the
+standard library and may act as a persistent helper process (``--session``,
+see :mod:`ecmwf.tools.cmdsessions`).
+"""
+
+import argparse
+import contextlib
+import fcntl
+import io
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import time
+
+#: No automatic export
+__all__ = []
+
+#: The requests status words (as displayed by ``ectrans -list``)
+ECTRANSEMULATOR_STATUS = (
+    "queued",
+    "retrying",
+    "transferring",
+    "completed",
+    "failed",
+)
+
+
+class ECtransEmulatorError(Exception):
+    """An ECtrans request fails (the message is printed on the standard error)."""
+
+    pass
+
+
+class ECtransEmulator:
+    """Emulate the ``ectrans`` command on top of the **root** local directory."""
+
+    def __init__(
+        self,
+        root,
+        latency=0.0,
+        bandwidth=0.0,
+        failure_rate=0.0,
+        time_scale=1.0,
+        seed=None,
+    ):
+        """
+        :param str root: The directory where the remote files are stored
+        :param float latency: The delay of any command (in seconds)
+        :param float bandwidth: The transfer rate (in bytes per second,
+                                unlimited if zero)
+        :param float failure_rate: The probability that a transfer attempt
+                                   fails
+        :param float time_scale: The factor applied to the retry delays
+        :param seed: The seed of the failures random generator
+        """
+        # The session requests may change the current directory
+        self.root = os.path.abspath(root)
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.failure_rate = failure_rate
+        self.time_scale = time_scale
+        self.seed = seed
+        self._random = random.Random(seed)
+        self._workers = list()
+
+    def remote_path(self, gateway, remote, path):
+        """The local path of the **path** file of the **remote** association."""
+        if not gateway or not remote:
+            raise ECtransEmulatorError("The gateway and remote are mandatory")
+        return os.path.join(self.root, gateway, remote, path.lstrip("/"))
+
+    def _dir(self, name):
+        path = os.path.join(self.root, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def _request_path(self, reqid):
+        return os.path.join(self._dir("requests"), "{:d}.json".format(reqid))
+
+    def _new_request(self, **request):
+        """Record a new request and return it (with its ``id``)."""
+        with open(os.path.join(self._dir("requests"), "last_id"), "a+") as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            fh.seek(0)
+            reqid = int(fh.read() or "1000") + 1
+            fh.seek(0)
+            fh.truncate()
+            fh.write(str(reqid))
+        request.update(id=reqid, submitted=time.time(), attempts=0)
+        self._save(request)
+        return request
+
+    def _save(self, request):
+        path = self._request_path(request["id"])
+        with open(path + ".tmp", "w") as fhreq:
+            json.dump(request, fhreq)
+        os.replace(path + ".tmp", path)
+
+    def requests(self):
+        """The list of all the requests (sorted by ID)."""
+        requests = list()
+        for filename in os.listdir(self._dir("requests")):
+            if filename.endswith(".json"):
+                try:
+                    with open(
+                        os.path.join(self.root, "requests", filename)
+                    ) as fh:
+                        requests.append(json.load(fh))
+                except (OSError, ValueError):
+                    continue
+        return sorted(requests, key=lambda r: r["id"])
+
+    def _copy(self, source, target, overwrite):
+        """Copy **source** into **target** at the emulated bandwidth."""
+        if self._random.random() < self.failure_rate:
+            raise ECtransEmulatorError("injected failure")
+        if not os.path.exists(source):
+            raise ECtransEmulatorError(
+                "{:s}: No such file or directory".format(source)
+            )
+        if os.path.exists(target) and not overwrite:
+            raise ECtransEmulatorError("{:s}: File exists".format(target))
+        os.makedirs(os.path.dirname(os.path.abspath(target)), exist_ok=True)
+        with open(source, "rb") as fhin, open(target, "wb") as fhout:
+            if self.bandwidth <= 0:
+                shutil.copyfileobj(fhin, fhout)
+                return
+            t0 = time.monotonic()
+            done = 0
+            for chunk in iter(lambda: fhin.read(1024 * 1024), b""):
+                fhout.write(chunk)
+                done += len(chunk)
+                delay = done / self.bandwidth - (time.monotonic() - t0)
+                if delay > 0:
+                    time.sleep(delay)
+
+    def _attempt(self, request, source, target):
+        """Try to carry out **request** once and update its status.
+
+        :return: ``True`` if the request is over (whatever its outcome)
+        """
+        request["attempts"] += 1
+        try:
+            self._copy(source, target, request["overwrite"])
+        except (ECtransEmulatorError, OSError) as e:
+            request["message"] = str(e)
+            if request["attempts"] > request["retryCnt"]:
+                request["status"] = "failed"
+            else:
+                request["status"] = "retrying"
+                request["next_try"] = (
+                    time.time() + request["retryFrq"] * self.time_scale
+                )
+        else:
+            request["status"] = "completed"
+            request["message"] = ""
+        if request["status"] in ("completed", "failed"):
+            request["finished"] = time.time()
+        self._save(request)
+        return "finished" in request
+
+    @staticmethod
+    def _parse(args):
+        """Split the arguments into a set of flags and a dictionary of values."""
+        flags = set()
+        values = dict()
+        i = 0
+        while i < len(args):
+            name = args[i].lstrip("-")
+            if i + 1 < len(args) and not args[i + 1].startswith("-"):
+                values[name] = args[i + 1]
+                i += 2
+            else:
+                flags.add(name)
+                i += 1
+        return flags, values
+
+    def run(self, argv, stdout=None, stderr=None):
+        """Run the **argv** command line (e.g. ``["ectrans", "-list"]``).
+
+        :param list argv: The command line
+        :param stdout: The standard output (default: ``sys.stdout``)
+        :param stderr: The standard error (default: ``sys.stderr``)
+        :return: The command's exit code
+        """
+        stdout = sys.stdout if stdout is None else stdout
+        stderr = sys.stderr if stderr is None else stderr
+        if not argv or os.path.basename(argv[0]) != "ectrans":
+            stderr.write(
+                "{:s}: command not found\n".format(" ".join(argv[:1]))
+            )
+            return 127
+        time.sleep(self.latency)
+        flags, values = self._parse(argv[1:])
+        try:
+            if "list" in flags:
+                return self._list(stdout)
+            if "ls" in flags:
+                return self._ls(values, stdout)
+            return self._transfer(flags, values, stdout)
+        except (ECtransEmulatorError, OSError) as e:
+            stderr.write("ectrans: {!s}\n".format(e))
+            return 1
+
+    def _list(self, stdout):
+        stdout.write(
+            "{:>8s}  {:12s}  {:>8s}  {:s}\n".format(
+                "Request", "Status", "Priority", "Target"
+            )
+        )
+        for request in self.requests():
+            stdout.write(
+                "{:8d}  {:12s}  {:8d}  {:s}\n".format(
+                    request["id"],
+                    request["status"],
+                    request["priority"],
+                    request["target"],
+                )
+            )
+        return 0
+
+    def _ls(self, values, stdout):
+        source = values.get("source", "/")
+        local = self.remote_path(
+            values.get("gateway"), values.get("remote"), source
+        )
+        if os.path.isdir(local):
+            names = sorted(os.listdir(local))
+        elif os.path.exists(local):
+            names = [os.path.basename(local)]
+        else:
+            raise ECtransEmulatorError(
+                "{:s}: No such file or directory".format(source)
+            )
+        stdout.write("".join([name + "\n" for name in names]))
+        return 0
+
+    def _transfer(self, flags, values, stdout):
+        if "source" not in values or "target" not in values:
+            raise ECtransEmulatorError("The source and target are mandatory")
+        gateway = values.get("gateway")
+        remote = values.get("remote")
+        if "get" in flags:
+            source = self.remote_path(gateway, remote, values["source"])
+            target = values["target"]
+        else:
+            source = values["source"]
+            target = self.remote_path(gateway, remote, values["target"])
+        request = self._new_request(
+            gateway=gateway,
+            remote=remote,
+            source=values["source"],
+            target=values["target"],
+            priority=int(values.get("priority", 50)),
+            retryCnt=int(values.get("retryCnt", 0)),
+            retryFrq=float(values.get("retryFrq", 0)),
+            overwrite="overwrite" in flags,
+            status="queued",
+        )
+        stdout.write("ECtrans: request ID: {:d}\n".format(request["id"]))
+        if flags & {"put", "get"}:
+            request["status"] = "transferring"
+            while not self._attempt(request, source, target):
+                time.sleep(max(0, request["next_try"] - time.time()))
+            if request["status"] == "failed":
+                raise ECtransEmulatorError(request["message"])
+            return 0
+        # Asynchronous transfer: the data are spooled right now
+        spool = os.path.join(self._dir("spool"), str(request["id"]))
+        try:
+            shutil.copyfile(source, spool)
+        except OSError:
+            request.update(status="failed", message="Unable to spool the data")
+            self._save(request)
+            raise
+        request["spool"] = spool
+        self._save(request)
+        self.start_worker()
+        return 0
+
+    def _pending(self):
+        """The asynchronous requests that are waiting to be processed."""
+        return [
+            r
+            for r in self.requests()
+            if r["status"] in ("queued", "retrying") and "spool" in r
+        ]
+
+    def _step(self):
+        """Process the most urgent pending request.
+
+        :return: ``False`` if there is no pending request at all
+        """
+        pending = self._pending()
+        if not pending:
+            return False
+        now = time.time()
+        due = [r for r in pending if r.get("next_try", 0) <= now]
+        if not due:
+            time.sleep(min(1.0, min([r["next_try"] for r in pending]) - now))
+            return True
+        request = min(due, key=lambda r: (-r["priority"], r["id"]))
+        request["status"] = "transferring"
+        self._save(request)
+        target = self.remote_path(
+            request["gateway"], request["remote"], request["target"]
+        )
+        if self._attempt(request, request["spool"], target):
+            os.remove(request["spool"])
+        return True
+
+    def process(self):
+        """Process the queued requests until there is none left.
+
+        Only one process at a time processes the queue (others return
+        immediately).
+        """
+        with open(os.path.join(self.root, "worker.lock"), "a") as fhlock:
+            while True:
+                try:
+                    fcntl.flock(fhlock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except BlockingIOError:
+                    return
+                try:
+                    while self._step():
+                        pass
+                finally:
+                    fcntl.flock(fhlock, fcntl.LOCK_UN)
+                # A request may have been submitted while leaving
+                if not self._pending():
+                    return
+
+    def start_worker(self):
+        """Start a worker process (see :meth:`process`) in the background."""
+        self._workers = [p for p in self._workers if p.poll() is None]
+        cmd = [
+            sys.executable,
+            os.path.abspath(__file__),
+            "--root",
+            self.root,
+            "--bandwidth",
+            str(self.bandwidth),
+            "--failure-rate",
+            str(self.failure_rate),
+            "--time-scale",
+            str(self.time_scale),
+            "--worker",
+        ]
+        if self.seed is not None:
+            cmd.extend(["--seed", str(self.seed)])
+        self._workers.append(
+            subprocess.Popen(
+                cmd,
+                stdin=subprocess.DEVNULL,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                start_new_session=True,
+            )
+        )
+
+    def serve(self, stdin=None, stdout=None):
+        """Act as a persistent helper process (see :mod:`ecmwf.tools.cmdsessions`)."""
+        stdin = sys.stdin if stdin is None else stdin
+        stdout = sys.stdout if stdout is None else stdout
+        for line in stdin:
+            out = io.StringIO()
+            err = io.StringIO()
+            try:
+                request = json.loads(line)
+                with _request_context(request):
+                    rc = self.run(request["argv"], stdout=out, stderr=err)
+            except (ValueError, KeyError, TypeError) as e:
+                rc = 127
+                err.write(str(e) + "\n")
+            stdout.write(
+                json.dumps(
+                    dict(rc=rc, stdout=out.getvalue(), stderr=err.getvalue())
+                )
+                + "\n"
+            )
+            stdout.flush()
+
+
+@contextlib.contextmanager
+def _request_context(request):
+    """Run in the directory and environment of a session **request**."""
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    try:
+        if request.get("cwd") is not None:
+            os.chdir(request["cwd"])
+        if request.get("env") is not None:
+            os.environ.clear()
+            os.environ.update(request["env"])
+        yield
+    finally:
+        os.chdir(cwd)
+        os.environ.clear()
+        os.environ.update(environ)
+
+
+def main(argv=None):
+    """The command line interface (see the module's documentation)."""
+    parser = argparse.ArgumentParser(
+        description="A local stand-in for the ectrans command."
+    )
+    parser.add_argument(
+        "--root", required=True, help="The directory of the remote files"
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.0,
+        help="The delay of any command in seconds (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--bandwidth",
+        type=float,
+        default=0.0,
+        help="The transfer rate in bytes per second "
+        + "(0 means unlimited, default: %(default)s)",
+    )
+    parser.add_argument(
+        "--failure-rate",
+        type=float,
+        default=0.0,
+        help="The probability that a transfer attempt fails "
+        + "(default: %(default)s)",
+    )
+    parser.add_argument(
+        "--time-scale",
+        type=float,
+        default=1.0,
+        help="The factor applied to the retry delays (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--seed", type=int, help="The seed of the failures random generator"
+    )
+    parser.add_argument(
+        "--session",
+        action="store_true",
+        help="Act as a persistent helper process",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Process the queued asynchronous requests",
+    )
+    parser.add_argument(
+        "command", nargs=argparse.REMAINDER, help="The ectrans command line"
+    )
+    args = parser.parse_args(argv)
+    emulator = ECtransEmulator(
+        args.root,
+        latency=args.latency,
+        bandwidth=args.bandwidth,
+        failure_rate=args.failure_rate,
+        time_scale=args.time_scale,
+        seed=args.seed,
+    )
+    if args.session:
+        emulator.serve()
+        return 0
+    if args.worker:
+        emulator.process()
+        return 0
+    return emulator.run(args.command)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -4,9 +4,20 @@ This module contains the generic interface used for ECtrans and ECfs.
 
 import itertools
 import logging
+import os
 import re
+import shlex
+import sys
 
 from vortex.config import get_from_config_w_default
+from vortex.tools.systems import ExecutionError
+
+from . import metrics
+from .cmdsessions import (
+    CommandSessionError,
+    sessions_generation,
+    sessions_pool,
+)
 
 LOG = logging.getLogger(__name__)
 
@@ -19,6 +30,7 @@ class ECMWFInterface:
         self._system = system
         self._command = command
         self._command_interface = command_interface
+        self._resolved = dict()
 
     @property
     def system(self):
@@ -47,6 +59,53 @@ class ECMWFInterface:
         else:
             return command
 
+    def reset(self):
+        """Forget the cached command headers and helper processes pools.
+
+        This is needed if the configuration changes after the first call
+        (see :meth:`command_header`).
+        """
+        self._resolved = dict()
+
+    def _resolve(self, command):
+        """The command header and the helper processes pool (cached).
+
+        The helper processes pool is looked for again in forked child
+        processes and after :func:`ecmwf.tools.cmdsessions.close_all`.
+        """
+        stamp = (os.getpid(), sessions_generation())
+        resolved = self._resolved.get(command)
+        if resolved is None or resolved[0] != stamp:
+            if resolved is None:
+                wrapper = get_from_config_w_default(
+                    section="ecmwf",
+                    key="{:s}_command_wrapper".format(self.command),
+                    default=None,
+                )
+                header = tuple(shlex.split(wrapper or "")) + tuple(
+                    shlex.split(self.actual_command(command))
+                )
+            else:
+                header = resolved[1]
+            resolved = (stamp, header, sessions_pool(self.command))
+            self._resolved[command] = resolved
+        return resolved[1:]
+
+    def command_header(self, command=None):
+        """Return the command header as a tuple of arguments.
+
+        The header is resolved (see :meth:`actual_command`) and split once:
+        it is then cached by this interface object (together with the
+        helper processes pool, see :mod:`ecmwf.tools.cmdsessions`) until
+        :meth:`reset` is called.
+
+        If the ``<command>_command_wrapper`` key of the ``ecmwf``
+        configuration section is set (e.g. ``ecfs_command_wrapper``), it is
+        put in front of the command (e.g. to run the commands through an
+        emulator, see :mod:`ecmwf.tools.ecfsemulator`).
+        """
+        return self._resolve(command)[0]
+
     def __call__(
         self,
         list_args=list(),
@@ -58,15 +117,32 @@ class ECMWFInterface:
         silent=False,
     ):
         """Construct the command line and run it in the shell"""
-        actual_command = self.actual_command(command)
-        command_line = self.build_command_line(
-            command=actual_command,
+        header, pool = self._resolve(command)
+        command_line = self.build_command_argv(
+            header=header,
             list_args=list_args,
             dict_args=dict_args,
             list_options=list_options,
         )
-        LOG.debug("The command line launched is: {}".format(command_line))
-        command_line = command_line.split()
+        LOG.debug("The command line launched is: %s", command_line)
+        if pool is not None:
+            try:
+                return self._session_call(
+                    pool,
+                    command_line,
+                    fatal=fatal,
+                    capture=capture,
+                    silent=silent,
+                )
+            except CommandSessionError as e:
+                if e.sent:
+                    # The command may have been run: it must not be re-run
+                    LOG.error("The helper process failed: %s", e)
+                    if fatal:
+                        raise ExecutionError(str(e))
+                    return False
+                LOG.warning("Falling back to a new process: %s", e)
+                metrics.add_retries()
         return self.system.spawn(
             command_line,
             shell=False,
@@ -76,32 +152,74 @@ class ECMWFInterface:
         )
 
     @staticmethod
-    def build_command_line(command, list_args, dict_args, list_options):
+    def _session_call(pool, command_line, fatal, capture, silent):
+        """Run the command line in a persistent helper process.
+
+        The outcome mimics :meth:`vortex.tools.systems.OSExtended.spawn`.
         """
-        Build the command line using the different elements passed to the function.
+        # The command line may refer to relative local paths
+        rc, stdout, stderr = pool.run(
+            command_line, cwd=os.getcwd(), env=dict(os.environ)
+        )
+        if rc == 0:
+            if capture:
+                return stdout.rstrip("\n").split("\n")
+            sys.stdout.write(stdout)
+            sys.stderr.write(stderr)
+            return True
+        if not silent:
+            LOG.warning("Bad return code [%d] for %s", rc, str(command_line))
+            sys.stderr.write(stderr)
+        if fatal:
+            raise ExecutionError()
+        LOG.warning("Carry on because fatal is off")
+        return False
 
-        :param command: header of the command line
+    @staticmethod
+    def build_command_argv(header, list_args, dict_args, list_options):
+        """
+        Build the command line (as a list of arguments) using the different
+        elements passed to the function.
+
+        Arguments are never split: paths that contain spaces are preserved.
+
+        :param header: header of the command line (list of arguments)
         :param list_args: list of positional arguments
         :param dict_args: list of named options with value(s)
         :param list_options: list of named options without values
         :return: the complete command line
         """
         # Initialize the command line with the header
-        command_line = command
+        argv = list(header)
         # Add named options with value(s)
         for kwarg, value in dict_args.items():
+            argv.append("-" + kwarg)
             if isinstance(value, (set, list, tuple)):
-                value = " ".join([val for val in value])
-            command_line = " ".join(
-                [command_line, "-{attr} {val}".format(attr=kwarg, val=value)]
-            )
+                argv.extend(value)
+            else:
+                argv.append(str(value))
         # Add named options without value
-        for arg in list_options:
-            command_line = " ".join([command_line, "-{attr}".format(attr=arg)])
+        argv.extend(["-" + arg for arg in list_options])
         # Add positional arguments
-        for arg in list_args:
-            command_line = " ".join([command_line, arg])
-        return command_line
+        argv.extend(list_args)
+        return argv
+
+    @classmethod
+    def build_command_line(cls, command, list_args, dict_args, list_options):
+        """
+        Build the command line using the different elements passed to the function.
+
+        :param command: header of the command line
+        :param list_args: list of positional arguments
+        :param dict_args: list of named options with value(s)
+        :param list_options: list of named options without values
+        :return: the complete command line (as a string, for display purposes)
+        """
+        return " ".join(
+            cls.build_command_argv(
+                [command], list_args, dict_args, list_options
+            )
+        )
 
     def prepare_arguments(self, list_args):
         """
@@ -0,0 +1,459 @@
+"""
+Instrumentation of the ECfs and ECtrans operations.
+
+Each measured operation produces a :class:`TransferRecord` object (wall
+time, bytes moved, retries, success and time spent in the compression
+pipeline) that is aggregated in the :class:`MetricsRegistry` of the current
+Vortex session (see :func:`metrics_registry`). Only the most recent records
+are kept as such (``metrics_maxrecords`` key of the ``ecmwf`` configuration
+section, default: 10000).
+
+Records can be exported by the exporters attached to the registry. If the
+``metrics_jsonl`` (resp. ``metrics_prometheus``) key of the ``ecmwf``
+configuration section is set, a :class:`JsonLinesExporter` (resp. a
+:class:`PrometheusTextfileExporter`) writing into the given path is attached
+to any new registry. Registries are exported at exit (and before the
+records kept in memory are discarded).
+"""
+
+import atexit
+import collections
+import contextlib
+import functools
+import inspect
+import json
+import logging
+import os
+import threading
+import time
+
+from vortex import sessions
+from vortex.config import get_from_config_w_default
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+_LOCAL = threading.local()
+
+
+class TransferRecord:
+    """The metrics of one ECfs or ECtrans operation."""
+
+    def __init__(self, tube, operation, source=None, target=None, labels=None):
+        #: The tool used (``ecfs`` or ``ectrans``)
+        self.tube = tube
+        #: The operation name (e.g. ``get``)
+        self.operation = operation
+        self.source = source
+        self.target = target
+        #: Additional labels (e.g. the archive that triggered the operation)
+        self.labels = dict(labels or dict())
+        #: Start date (in seconds since the epoch)
+        self.start = time.time()
+        #: Wall time (in seconds)
+        self.walltime = 0.0
+        #: Number of bytes sent or received (``None`` if unknown)
+        self.nbytes = None
+        #: Number of retries (e.g. one by one copies after a batch failure)
+        self.retries = 0
+        #: Did the operation succeed ?
+        self.rc = None
+        #: Time spent in the compression pipeline (in seconds)
+        self.ctime = 0.0
+        #: The record serial number (set by :meth:`MetricsRegistry.add`)
+        self.serial = None
+
+    def as_dict(self):
+        """The record as a JSON serialisable dictionary."""
+        return dict(
+            tube=self.tube,
+            operation=self.operation,
+            source=None if self.source is None else str(self.source),
+            target=None if self.target is None else str(self.target),
+            labels=self.labels,
+            start=self.start,
+            walltime=self.walltime,
+            nbytes=self.nbytes,
+            retries=self.retries,
+            rc=self.rc,
+            ctime=self.ctime,
+        )
+
+    def __str__(self):
+        return (
+            "<{:s} {:s}/{:s} | rc={!s} walltime={:.3f}s nbytes={!s}>".format(
+                self.__class__.__name__,
+                self.tube,
+                self.operation,
+                self.rc,
+                self.walltime,
+                self.nbytes,
+            )
+        )
+
+
+class MetricsRegistry:
+    """Aggregate :class:`TransferRecord` objects and export them.
+
+    The aggregated metrics are kept for each combination of tube, operation
+    and labels. Only the **maxrecords** most recent records are kept as such:
+    the exporters are run whenever **maxrecords** new records were added.
+    """
+
+    _AGGREGATES = (
+        "count",
+        "failures",
+        "walltime",
+        "nbytes",
+        "retries",
+        "ctime",
+    )
+
+    def __init__(self, tag=None, maxrecords=10000):
+        self.tag = tag
+        self._lock = threading.Lock()
+        self._maxrecords = maxrecords
+        self._records = collections.deque(maxlen=maxrecords)
+        self._aggregates = collections.OrderedDict()
+        self._serial = 0
+        self._unexported = 0
+        self._exporters = list()
+
+    @property
+    def records(self):
+        """The list of the most recent records."""
+        with self._lock:
+            return list(self._records)
+
+    @property
+    def exporters(self):
+        """The list of exporters attached to this registry."""
+        return list(self._exporters)
+
+    def add(self, record):
+        """Add a new record."""
+        key = (
+            record.tube,
+            record.operation,
+            tuple(sorted(record.labels.items())),
+        )
+        with self._lock:
+            self._serial += 1
+            record.serial = self._serial
+            self._records.append(record)
+            entry = self._aggregates.setdefault(
+                key, dict.fromkeys(self._AGGREGATES, 0)
+            )
+            entry["count"] += 1
+            entry["failures"] += int(record.rc is False)
+            entry["walltime"] += record.walltime
+            entry["nbytes"] += record.nbytes or 0
+            entry["retries"] += record.retries
+            entry["ctime"] += record.ctime
+            self._unexported += 1
+            export = self._exporters and self._unexported >= self._maxrecords
+        if export:
+            # The oldest records are about to be discarded
+            self.export()
+
+    def add_exporter(self, exporter):
+        """Attach an **exporter** (an object with an ``export`` method)."""
+        self._exporters.append(exporter)
+
+    def summary(self, by=("tube", "operation")):
+        """Aggregate the records.
+
+        :param by: The labels (or ``tube`` and ``operation``) used to group
+                   records
+        :return: A dictionary that associates tuples of **by** values with
+                 dictionaries of aggregated metrics (``count``, ``failures``,
+                 ``walltime``, ``nbytes``, ``retries``, ``ctime``)
+        """
+        with self._lock:
+            aggregates = [(k, dict(v)) for k, v in self._aggregates.items()]
+        summary = collections.OrderedDict()
+        for (tube, operation, labels), aggregate in aggregates:
+            values = dict(tube=tube, operation=operation)
+            values.update(labels)
+            entry = summary.setdefault(
+                tuple(values.get(k) for k in by),
+                dict.fromkeys(self._AGGREGATES, 0),
+            )
+            for k in self._AGGREGATES:
+                entry[k] += aggregate[k]
+        return summary
+
+    def export(self):
+        """Run all the exporters."""
+        with self._lock:
+            self._unexported = 0
+        for exporter in self._exporters:
+            try:
+                exporter.export(self)
+            except OSError as e:
+                LOG.error("Metrics export failed (%s): %s", exporter, e)
+
+    def clear(self):
+        """Forget about all the records (and the aggregated metrics)."""
+        with self._lock:
+            self._records.clear()
+            self._aggregates.clear()
+            self._unexported = 0
+
+
+class JsonLinesExporter:
+    """Append the new records to a JSON lines file."""
+
+    def __init__(self, path):
+        self.path = path
+        self._done = 0
+
+    def export(self, registry):
+        records = [r for r in registry.records if r.serial > self._done]
+        with open(self.path, "a") as fhjson:
+            for record in records:
+                fhjson.write(json.dumps(record.as_dict()) + "\n")
+        if records:
+            self._done = records[-1].serial
+
+    def __str__(self):
+        return "{:s}({:s})".format(self.__class__.__name__, self.path)
+
+
+class PrometheusTextfileExporter:
+    """Write aggregated metrics in the Prometheus textfile format.
+
+    Such files are meant to be collected by the node exporter's textfile
+    collector. The file is replaced atomically.
+    """
+
+    _METRICS = (
+        ("count", "transfers_total", "Number of operations"),
+        ("failures", "transfer_failures_total", "Number of failed operations"),
+        ("walltime", "transfer_seconds_total", "Wall time spent"),
+        ("nbytes", "transfer_bytes_total", "Bytes moved"),
+        ("retries", "transfer_retries_total", "Number of retries"),
+        ("ctime", "compression_seconds_total", "Time spent compressing"),
+    )
+
+    def __init__(
+        self, path, prefix="vortex_ecmwf", by=("tube", "operation", "archive")
+    ):
+        self.path = path
+        self.prefix = prefix
+        self.by = by
+
+    def export(self, registry):
+        summary = registry.summary(by=self.by)
+        lines = list()
+        for key, name, doc in self._METRICS:
+            fullname = "{:s}_{:s}".format(self.prefix, name)
+            lines.append("# HELP {:s} {:s}".format(fullname, doc))
+            lines.append("# TYPE {:s} counter".format(fullname))
+            for values, entry in summary.items():
+                labels = ",".join(
+                    '{:s}="{!s}"'.format(k, v)
+                    for k, v in zip(self.by, values)
+                    if v is not None
+                )
+                lines.append(
+                    "{:s}{{{:s}}} {!s}".format(fullname, labels, entry[key])
+                )
+        tmppath = self.path + ".tmp"
+        with open(tmppath, "w") as fhprom:
+            fhprom.write("\n".join(lines) + "\n")
+        os.replace(tmppath, self.path)
+
+    def __str__(self):
+        return "{:s}({:s})".format(self.__class__.__name__, self.path)
+
+
+_REGISTRIES = dict()
+_REGISTRIES_LOCK = threading.Lock()
+
+
+def metrics_registry():
+    """Return the :class:`MetricsRegistry` of the current Vortex session."""
+    tag = sessions.current().tag
+    with _REGISTRIES_LOCK:
+        if tag not in _REGISTRIES:
+            registry = MetricsRegistry(
+                tag,
+                maxrecords=int(
+                    get_from_config_w_default(
+                        section="ecmwf",
+                        key="metrics_maxrecords",
+                        default=10000,
+                    )
+                ),
+            )
+            jsonl = get_from_config_w_default(
+                section="ecmwf", key="metrics_jsonl", default=None
+            )
+            if jsonl:
+                registry.add_exporter(JsonLinesExporter(jsonl))
+            prometheus = get_from_config_w_default(
+                section="ecmwf", key="metrics_prometheus", default=None
+            )
+            if prometheus:
+                registry.add_exporter(PrometheusTextfileExporter(prometheus))
+            _REGISTRIES[tag] = registry
+        return _REGISTRIES[tag]
+
+
+@atexit.register
+def export_all():
+    """Export all the registries."""
+    with _REGISTRIES_LOCK:
+        registries = list(_REGISTRIES.values())
+    for registry in registries:
+        registry.export()
+
+
+def _stack(name):
+    if not hasattr(_LOCAL, name):
+        setattr(_LOCAL, name, list())
+    return getattr(_LOCAL, name)
+
+
+def current():
+    """The innermost record being measured in this thread (or ``None``)."""
+    records = _stack("records")
+    return records[-1] if records else None
+
+
+@contextlib.contextmanager
+def labelled(**labels):
+    """Add **labels** to the records created within this context."""
+    _stack("labels").append(labels)
+    try:
+        yield
+    finally:
+        _stack("labels").pop()
+
+
+@contextlib.contextmanager
+def measure(tube, operation, source=None, target=None):
+    """Measure an operation and record it in the current registry.
+
+    This method creates a context manager that yields the
+    :class:`TransferRecord` object (so that **rc** and **nbytes** can be
+    filled in). If an exception is raised, the record's **rc** is ``False``.
+    """
+    labels = dict()
+    for more_labels in _stack("labels"):
+        labels.update(more_labels)
+    record = TransferRecord(tube, operation, source, target, labels)
+    t0 = time.monotonic()
+    _stack("records").append(record)
+    try:
+        yield record
+    except BaseException:
+        record.rc = False
+        raise
+    finally:
+        _stack("records").pop()
+        record.walltime = time.monotonic() - t0
+        metrics_registry().add(record)
+        LOG.debug("Transfer metrics: %s", record)
+
+
+@contextlib.contextmanager
+def unmeasured():
+    """Do not count anything in the current record within this context."""
+    _stack("records").append(None)
+    try:
+        yield
+    finally:
+        _stack("records").pop()
+
+
+def add_retries(n=1):
+    """Count **n** retries in the current record (if any)."""
+    record = current()
+    if record is not None:
+        record.retries += n
+
+
+def add_nbytes(nbytes):
+    """Count **nbytes** bytes sent or received in the current record (if any).
+
+    When bytes are counted that way, the size of the local file is not
+    recorded (see :func:`measured`).
+    """
+    record = current()
+    if record is not None:
+        record.nbytes = (record.nbytes or 0) + nbytes
+
+
+def add_compression_time(seconds):
+    """Add **seconds** to the compression time of the current record (if any)."""
+    record = current()
+    if record is not None:
+        record.ctime += seconds
+
+
+@contextlib.contextmanager
+def compression_timer():
+    """Count the time spent in this context as compression time."""
+    t0 = time.monotonic()
+    try:
+        yield
+    finally:
+        add_compression_time(time.monotonic() - t0)
+
+
+def _file_size(path):
+    if isinstance(path, str):
+        try:
+            return os.path.getsize(path)
+        except OSError:
+            return None
+    return None
+
+
+def measured(tube, operation, nbytes=None, many=False, answers=False):
+    """Decorator that measures a method (see :func:`measure`).
+
+    The **source** (or **item**, or **location**) and **target** arguments
+    of the method are recorded. The record's **rc** tells whether the call
+    succeeded: it did not raise an exception and did not return ``False``
+    (an empty listing is a success). A list of return codes is reduced with
+    :func:`all`.
+
+    :param str tube: The tool used (``ecfs`` or ``ectrans``)
+    :param str operation: The operation name
+    :param str nbytes: The argument that designates the local file the size
+                       of which is recorded (``"source"`` or ``"target"``),
+                       unless the actual number of bytes sent or received
+                       is counted by the method (see :func:`add_nbytes`)
+    :param bool many: The method returns a list of return codes
+    :param bool answers: The method answers a question (e.g. an existence
+                         test): any answer is a success
+    """
+
+    def decorator(method):
+        signature = inspect.signature(method)
+
+        @functools.wraps(method)
+        def measured_method(*kargs, **kwargs):
+            arguments = signature.bind_partial(*kargs, **kwargs).arguments
+            source = arguments.get(
+                "source", arguments.get("item", arguments.get("location"))
+            )
+            target = arguments.get("target")
+            with measure(tube, operation, source, target) as record:
+                rc = method(*kargs, **kwargs)
+                if many:
+                    record.rc = all(rc)
+                else:
+                    record.rc = answers or rc is not False
+                if nbytes is not None and record.nbytes is None:
+                    record.nbytes = _file_size(arguments.get(nbytes))
+                return rc
+
+        return measured_method
+
+    return decorator
@@ -0,0 +1,47 @@
+"""
+Prestaging of tape resident ECfs files (see :mod:`vortex.tools.prestaging`).
+"""
+
+import logging
+
+from vortex.tools.prestaging import PrestagingTool
+from vortex.tools.systems import ExecutionError
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+
+class ECfsPrestagingTool(PrestagingTool):
+    """Recall tape resident ECfs files (grouped by tape)."""
+
+    _footprint = dict(
+        info="Recall tape resident ECfs files",
+        attr=dict(
+            storage=dict(
+                info="The ECfs storage place",
+                values=["ecgate.ecmwf.int", "ecfs.ecmwf.int"],
+            ),
+        ),
+    )
+
+    def flush(self, email=None):
+        """Send the recall request for all the recorded locations.
+
+        :param email: Ignored (ECfs does not send notifications)
+        """
+        if "ecfs" not in self.system.loaded_addons():
+            LOG.error("The ecfs addon is not loaded: no prestaging")
+            return False
+        try:
+            ready = self.system.ecfsprestage(sorted(self.items()))
+        except ExecutionError as e:
+            LOG.error("ECfs prestaging failed: %s", e)
+            return False
+        LOG.info(
+            "ECfs prestaging: %d files requested, %d already online",
+            len(ready),
+            sum(ready.values()),
+        )
+        return True
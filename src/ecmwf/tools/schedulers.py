@@ -2,11 +2,17 @@
 Interface to SMS commands.
 """
 
+import atexit
+import collections
 import logging
 import tempfile
+import threading
+import time
 import uuid
+import weakref
 
 import footprints
+from vortex.config import get_from_config_w_default
 from vortex.tools.schedulers import EcmwfLikeScheduler
 
 __all__ = []
@@ -14,9 +20,194 @@ __all__ = []
 LOG = logging.getLogger(__name__)
 
 
+_SMSItem = collections.namedtuple(
+    "_SMSItem", ("stamp", "command", "header", "key", "urgent")
+)
+
+
+#: The dispatchers whose queued commands are sent when the script ends
+_DISPATCHERS = weakref.WeakSet()
+
+
+@atexit.register
+def _flush_dispatchers():
+    """Wait for the queued commands of all the dispatchers to be sent."""
+    for dispatcher in list(_DISPATCHERS):
+        dispatcher.flush()
+
+
+class _SMSDispatcher:
+    """Send the SMS commands on a background thread, in batches.
+
+    The commands submitted within **window** seconds of the oldest pending
+    one are sent together (provided that they share the same environment
+    header). Batches are sent one at a time, in submission order.
+
+    Commands submitted with a coalescing **key** (e.g. meter or label
+    updates) replace any pending command with the same key (the number of
+    such dropped commands is counted) and are sent at most once every
+    **interval** seconds: the other commands do not wait for them, except
+    for urgent commands. These are never sent before the pending commands
+    queued earlier with the same header (i.e. for the same task).
+    """
+
+    def __init__(self, send, window, interval=0):
+        """
+        :param send: A callable that sends a list of commands (given the
+                     environment header) and returns a return code
+        :param float window: The batching window (in seconds)
+        :param float interval: The minimum interval between two commands
+                               with the same coalescing key (in seconds)
+        """
+        self._send = send
+        self._window = window
+        self._interval = interval
+        self._cond = threading.Condition()
+        self._queue = list()
+        self._sent = dict()
+        self._flushing = 0
+        self._urgent = False
+        self._busy = False
+        self._rc = True
+        self._thread = None
+        self.dropped = 0
+        _DISPATCHERS.add(self)
+
+    def submit(self, command, header, key=None, urgent=False):
+        """Queue **command** (to be sent with the **header** environment).
+
+        :param key: The coalescing key (``None`` if the command must be
+                    sent whatever happens)
+        :param bool urgent: Send the pending commands without waiting for
+                            the end of the batching window (and whatever
+                            the rate limit of the previous commands with
+                            the same header)
+        """
+        with self._cond:
+            if key is not None:
+                pending = len(self._queue)
+                self._queue = [i for i in self._queue if i.key != key]
+                if len(self._queue) < pending:
+                    self.dropped += 1
+                    LOG.debug("SMS update coalesced: %s", command)
+            self._queue.append(
+                _SMSItem(time.monotonic(), command, header, key, urgent)
+            )
+            self._urgent = self._urgent or urgent
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="EctransSMS dispatcher", daemon=True
+                )
+                self._thread.start()
+            self._cond.notify_all()
+
+    def flush(self):
+        """Wait for all the queued commands to be sent.
+
+        :return: ``False`` if any batch failed since the previous flush
+        """
+        with self._cond:
+            self._flushing += 1
+            self._cond.notify_all()
+            self._cond.wait_for(lambda: not (self._queue or self._busy))
+            self._flushing -= 1
+            rc, self._rc = self._rc, True
+        return rc
+
+    def _release(self, item):
+        """When **item** may be sent (given the rate limit)."""
+        if item.key is None or self._flushing:
+            return 0
+        return self._sent.get(item.key, -self._interval) + self._interval
+
+    def _batch(self, now):
+        """Pop the oldest commands that are due and share the same header.
+
+        :return: The list of items (empty if nothing is due) and the time
+                 of the next check (``None`` if the queue is empty)
+        """
+        # The rate limit is lifted for the commands that precede an urgent
+        # one with the same header (they must not be overtaken)
+        last_urgent = {
+            i.header: n for n, i in enumerate(self._queue) if i.urgent
+        }
+        releases = [
+            0 if last_urgent.get(i.header, -1) > n else self._release(i)
+            for n, i in enumerate(self._queue)
+        ]
+        due = [i for i, r in zip(self._queue, releases) if r <= now]
+        wakeups = [r for r in releases if r > now]
+        if due:
+            if self._flushing or self._urgent:
+                ready = now
+            else:
+                ready = due[0].stamp + self._window
+            if ready <= now:
+                batch = list()
+                for item in due:
+                    if item.header != due[0].header:
+                        break
+                    batch.append(item)
+                sent = set(map(id, batch))
+                self._queue = [i for i in self._queue if id(i) not in sent]
+                self._urgent = self._urgent and bool(self._queue)
+                return batch, now
+            wakeups.append(ready)
+        return list(), min(wakeups) if wakeups else None
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                batch, wakeup = self._batch(now)
+                if not batch:
+                    self._cond.wait(
+                        timeout=None if wakeup is None else wakeup - now
+                    )
+                    continue
+                commands = [item.command for item in batch]
+                self._busy = True
+                self._cond.release()
+                try:
+                    rc = self._send(commands, batch[0].header)
+                except Exception as e:
+                    LOG.error(
+                        "SMS commands %s could not be sent: %s", commands, e
+                    )
+                    rc = False
+                finally:
+                    self._cond.acquire()
+                    self._busy = False
+                for item in batch:
+                    if item.key is not None:
+                        self._sent[item.key] = now
+                self._rc = self._rc and bool(rc)
+                self._cond.notify_all()
+
+
 class EctransSMS(EcmwfLikeScheduler):
     """
     Client interface to SMS scheduling and monitoring system.
+
+    By default, each command is sent (synchronously) in its own ``smsupd.*``
+    file. If the ``sms_dispatch_window`` key of the ``ecmwf`` configuration
+    section is set to a positive number of seconds, the commands are sent
+    by a background thread and the commands queued within this window are
+    merged into a single ``smsupd.*`` file (one command per line, followed
+    by the environment variables). The ``complete`` and ``abort`` commands
+    wait for all the queued commands to be sent (so does the end of the
+    script).
+
+    The ``meter`` and ``label`` updates are coalesced: a pending update
+    is replaced by any newer update of the same meter (or label). If the
+    ``sms_update_interval`` key of the ``ecmwf`` configuration section is
+    set to a positive number of seconds, a given meter (or label) is not
+    updated more than once per interval (the commands are then sent by a
+    background thread, even if ``sms_dispatch_window`` is not set). The
+    ``event``, ``complete`` and ``abort`` commands are sent without waiting
+    for the end of the batching window, together with the meter and label
+    updates held back by the interval (so that they keep their order). The
+    number of dropped updates is available in :attr:`dropped_updates`.
     """
 
     _footprint = dict(
@@ -45,6 +236,18 @@ class EctransSMS(EcmwfLikeScheduler):
         "fix",
     )
 
+    #: The commands that wait for all the queued commands to be sent
+    _FLUSH_CMD = ("abort", "complete")
+
+    #: The commands that may be replaced by a newer one with the same name
+    _COALESCED_CMD = ("label", "meter")
+
+    #: The commands that are sent without waiting for the batching window
+    _URGENT_CMD = ("event",)
+
+    #: The prefixes of the environment variables sent with the commands
+    _HEADER_PREFIXES = ("SMS", "SWAPP_SERVER_ID")
+
     def __init__(self, *args, **kw):
         LOG.debug("EctransSMS scheduler client init %s", self)
         super().__init__(*args, **kw)
@@ -54,13 +257,29 @@ class EctransSMS(EcmwfLikeScheduler):
             and "VORTEX_UPDSERVER_PATH" in self.env
         )
         if self._confcheck:
-            self._remote = self.sh.ectrans_remote_init(
+            self._gateway, self._remote = self.sh.ectrans_endpoint(
                 storage=self.env.VORTEX_UPDSERVER_HOST
             )
-            self._gateway = self.sh.ectrans_gateway_init()
             self._targetpath = self.env.VORTEX_UPDSERVER_PATH
         else:
             LOG.warning("EctransSMS service could not be configured")
+        self._header_vars = None
+        self._header = b""
+        self._dispatcher = None
+        window = float(
+            get_from_config_w_default(
+                section="ecmwf", key="sms_dispatch_window", default=0
+            )
+        )
+        interval = float(
+            get_from_config_w_default(
+                section="ecmwf", key="sms_update_interval", default=0
+            )
+        )
+        if self._confcheck and (window > 0 or interval > 0):
+            self._dispatcher = _SMSDispatcher(
+                self._sms_send, max(window, 0), interval=max(interval, 0)
+            )
 
     def info(self):
         """Dump current defined variables."""
@@ -80,24 +299,55 @@ class EctransSMS(EcmwfLikeScheduler):
             cmd = cmd[3:]
         return cmd
 
-    def _actual_child(self, cmd, options):
-        """Miscellaneous smschild subcommand."""
-        if not self._confcheck:
-            raise RuntimeError("EctransSMS is not configured properly !")
-        args = ["sms" + self.cmd_rename(cmd)]
-        args.extend(options)
-        with tempfile.NamedTemporaryFile("w", prefix="smscmd_send.") as fhdir:
-            fhdir.write(" ".join(args) + "\n")
-            for prefix in ("SMS", "SWAPP_SERVER_ID"):
-                fhdir.write(
-                    "".join(
-                        [
-                            var + "=" + str(self.env.get(var, "") + "\n")
-                            for var in self.env.keys()
-                            if var.startswith(prefix)
-                        ]
-                    )
-                )
+    @property
+    def dropped_updates(self):
+        """The number of meter and label updates dropped by the coalescing."""
+        return 0 if self._dispatcher is None else self._dispatcher.dropped
+
+    def flush(self):
+        """Wait for the queued commands to be sent (if they are batched).
+
+        :return: ``False`` if any of them could not be sent
+        """
+        if self._dispatcher is None:
+            return True
+        return self._dispatcher.flush()
+
+    def _sms_header(self):
+        """The environment variables sent with the commands (as bytes).
+
+        The environment is scanned for each command (it may change at any
+        time) but the header text is only rebuilt when these variables
+        change.
+        """
+        variables = [
+            (var, value)
+            for var, value in self.env.items()
+            if var.startswith(self._HEADER_PREFIXES)
+        ]
+        if variables != self._header_vars:
+            self._header_vars = variables
+            self._header = "".join(
+                [
+                    var + "=" + str(value) + "\n"
+                    for prefix in self._HEADER_PREFIXES
+                    for var, value in variables
+                    if var.startswith(prefix)
+                ]
+            ).encode()
+        return self._header
+
+    def _sms_send(self, commands, header):
+        """Send the **commands** (and the **header**) in a ``smsupd.*`` file.
+
+        The file content is built in memory and written to a temporary file
+        in one go. It is not streamed: ``ectrans`` retries need a file that
+        can be read twice.
+        """
+        payload = "".join([command + "\n" for command in commands]).encode()
+        payload += header
+        with tempfile.NamedTemporaryFile(prefix="smscmd_send.") as fhdir:
+            fhdir.write(payload)
             fhdir.flush()
             return self.sh.raw_ectransput(
                 source=fhdir.name,
@@ -107,7 +357,33 @@ class EctransSMS(EcmwfLikeScheduler):
                 gateway=self._gateway,
                 remote=self._remote,
                 priority=99,
+                sync=True,
                 retryCnt=15,
                 retryFrq=120,
-                sync=True,
             )
+
+    def _actual_child(self, cmd, options):
+        """Miscellaneous smschild subcommand."""
+        if not self._confcheck:
+            raise RuntimeError("EctransSMS is not configured properly !")
+        cmd = self.cmd_rename(cmd)
+        args = ["sms" + cmd]
+        args.extend(options)
+        command = " ".join(args)
+        # The environment is captured now (it may change before the
+        # command is actually sent)
+        header = self._sms_header()
+        if self._dispatcher is None:
+            return self._sms_send([command], header)
+        key = None
+        if cmd in self._COALESCED_CMD and options:
+            key = (cmd, options[0], header)
+        self._dispatcher.submit(
+            command,
+            header,
+            key=key,
+            urgent=cmd in self._URGENT_CMD or cmd in self._FLUSH_CMD,
+        )
+        if cmd in self._FLUSH_CMD:
+            return self._dispatcher.flush()
+        return True
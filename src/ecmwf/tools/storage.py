@@ -2,11 +2,55 @@
 This package is used to implement the Archive Store class only used at ECMWF.
 """
 
+import functools
+import json
+import logging
+
+from vortex.tools.delayedactions import d_action_status
 from vortex.tools.storage import Archive
 from vortex.tools.systems import ExecutionError, OSExtended
 
+from . import metrics
+from .ecfscache import ecfscache_from_config
+
+LOG = logging.getLogger(__name__)
+
+
+class _MeasuredArchiveMixin:
+    """Label the metrics of the ECfs/ECtrans operations with the archive tag.
+
+    See :mod:`ecmwf.tools.metrics`.
+    """
+
+    def _actual_proxy_method(self, pmethod):
+        """Create a proxy method that labels the metrics."""
+        actual_proxy = super()._actual_proxy_method(pmethod)
+
+        def measured_proxy(*kargs, **kwargs):
+            with metrics.labelled(archive=self.tag):
+                return actual_proxy(*kargs, **kwargs)
 
-class EctransArchive(Archive):
+        measured_proxy.__name__ = actual_proxy.__name__
+        measured_proxy.__doc__ = actual_proxy.__doc__
+        return measured_proxy
+
+    def metrics_summary(self):
+        """Aggregated metrics of the operations triggered by this archive.
+
+        :return: A dictionary that associates (tube, operation) tuples with
+                 the aggregated metrics
+                 (see :meth:`ecmwf.tools.metrics.MetricsRegistry.summary`)
+        """
+        return {
+            k[1:]: v
+            for k, v in metrics.metrics_registry()
+            .summary(by=("archive", "tube", "operation"))
+            .items()
+            if k[0] == self.tag
+        }
+
+
+class EctransArchive(_MeasuredArchiveMixin, Archive):
     """The specific class to handle Archive from ECMWF super-computers"""
 
     _footprint = dict(
@@ -20,6 +64,23 @@ class EctransArchive(Archive):
 
     sh: OSExtended
 
+    def __init__(self, *kargs, **kwargs):
+        super().__init__(*kargs, **kwargs)
+        self._ectrans_endpoints = dict()
+
+    def _ectrans_endpoint(self, storage, gateway=None):
+        """The ECtrans gateway and remote (resolved once per archive object).
+
+        See :meth:`ecmwf.tools.ectrans.ECtransTools.ectrans_endpoint`.
+        """
+        endpoint = self._ectrans_endpoints.get((storage, gateway))
+        if endpoint is None:
+            endpoint = self.sh.ectrans_endpoint(
+                storage=storage, gateway=gateway
+            )
+            self._ectrans_endpoints[(storage, gateway)] = endpoint
+        return endpoint
+
     @staticmethod
     def _ectransfullpath(item, **kwargs):
         """Actual _fullpath using ectrans"""
@@ -27,35 +88,57 @@ class EctransArchive(Archive):
 
     def _ectransprestageinfo(self, item, **kwargs):
         """Actual _prestageinfo using ectrans"""
-        raise NotImplementedError
+        endpoint = self._ectrans_endpoint(self.storage)
+        return dict(
+            storage=self.storage,
+            location=item,
+            gateway=endpoint.gateway,
+            remote=endpoint.remote,
+        ), dict()
 
     def _ectranscheck(self, item, **kwargs):
-        """Actual _check using ectrans"""
-        raise NotImplementedError
+        """Actual _check using ectrans
+
+        If no remote listing is available, the file is retrieved (see
+        :meth:`ecmwf.tools.ectrans.ECtransTools.ectransprobe`).
+        """
+        endpoint = self._ectrans_endpoint(self.storage)
+        rc = self.sh.ectranstest(
+            item, gateway=endpoint.gateway, remote=endpoint.remote
+        )
+        if rc is None:
+            rc = self.sh.ectransprobe(
+                item, gateway=endpoint.gateway, remote=endpoint.remote
+            )
+        return rc, dict()
 
     def _ectranslist(self, item, **kwargs):
         """Actual _list using ectrans"""
-        raise NotImplementedError
+        endpoint = self._ectrans_endpoint(self.storage)
+        rc = self.sh.ectransls(
+            item, gateway=endpoint.gateway, remote=endpoint.remote
+        )
+        return (None if rc is False else rc), dict()
 
     def _ectransretrieve(self, item, local, **kwargs):
         """Actual _retrieve using ectrans"""
-        remote = self.sh.ectrans_remote_init(self.storage)
-        gateway = self.sh.ectrans_gateway_init()
+        endpoint = self._ectrans_endpoint(self.storage)
         extras = dict(
             fmt=kwargs.get("fmt", "foo"),
             cpipeline=kwargs.get("compressionpipeline", None),
         )
         return self.sh.ectransget(
-            source=item, target=local, gateway=gateway, remote=remote, **extras
+            source=item,
+            target=local,
+            gateway=endpoint.gateway,
+            remote=endpoint.remote,
+            **extras,
         ), extras
 
     def _ectransinsert(self, item, local, **kwargs):
         """Actual _insert using ectrans"""
-        remote = self.sh.ectrans_remote_init(
-            storage=kwargs.get("remote", None)
-        )
-        gateway = self.sh.ectrans_gateway_init(
-            gateway=kwargs.get("gateway", None)
+        endpoint = self._ectrans_endpoint(
+            kwargs.get("remote", None), gateway=kwargs.get("gateway", None)
         )
         extras = dict(
             fmt=kwargs.get("fmt", "foo"),
@@ -64,8 +147,8 @@ class EctransArchive(Archive):
         return self.sh.ectransput(
             source=local,
             target=item,
-            gateway=gateway,
-            remote=remote,
+            gateway=endpoint.gateway,
+            remote=endpoint.remote,
             sync=kwargs.get("enforcesync", False),
             **extras,
         ), extras
@@ -75,7 +158,7 @@ class EctransArchive(Archive):
         raise NotImplementedError
 
 
-class EcfsArchive(Archive):
+class EcfsArchive(_MeasuredArchiveMixin, Archive):
     """The specific class to handle Archive from ECMWF super-computers"""
 
     _footprint = dict(
@@ -109,7 +192,32 @@ class EcfsArchive(Archive):
 
     def _ecfsprestageinfo(self, item, **kwargs):
         """Actual _prestageinfo using ecfs"""
-        raise NotImplementedError
+        return dict(
+            storage=self.storage,
+            location=self._ecfsfullpath(item)[0],
+        ), dict()
+
+    def prestage(self, items, wait=False, **kwargs):
+        """Recall many tape resident **items** at once.
+
+        See :meth:`ecmwf.tools.ecfs.ECfsTools.ecfsprestage`.
+
+        :param list items: The items (as given to :meth:`retrieve`)
+        :param bool wait: Wait until all the items are online
+        :return: a dictionary that associates each item with its readiness
+        :raises ExecutionError: if the recall request fails
+        """
+        locations = {
+            self._ecfsfullpath(self._formatted_path(item, **kwargs))[0]: item
+            for item in items
+        }
+        ready = self.sh.ecfsprestage(
+            list(locations),
+            wait=wait,
+            timeout=kwargs.get("timeout", None),
+            pollfreq=kwargs.get("pollfreq", None),
+        )
+        return {item: ready[location] for location, item in locations.items()}
 
     def _ecfscheck(self, item, **kwargs):
         """Actual _check using ecfs"""
@@ -126,31 +234,142 @@ class EcfsArchive(Archive):
         except ExecutionError:
             return None, dict()
 
+    def _ecfslocalcache(self, local, fmt):
+        """The node-local cache to be used for this retrieval (if any).
+
+        See :func:`ecmwf.tools.ecfscache.ecfscache_from_config`.
+        """
+        if not isinstance(local, str) or self.sh.fmtspecific_mtd(
+            "ecfsget", fmt
+        ):
+            return None
+        return ecfscache_from_config()
+
     def _ecfsretrieve(self, item, local, **kwargs):
-        """Actual _retrieve using ecfs"""
+        """Actual _retrieve using ecfs
+
+        If the node-local cache is enabled, the file is retrieved through it
+        (see :mod:`ecmwf.tools.ecfscache`). The cached files are shared (hard
+        links) only with the resources retrieved with ``intent="in"``.
+        """
         item = self._ecfsfullpath(item)[0]
         options = kwargs.get("options", None)
         extras = dict(
             fmt=kwargs.get("fmt", "foo"),
             cpipeline=kwargs.get("compressionpipeline", None),
         )
-        return self.sh.ecfsget(
-            source=item, target=local, options=options, **extras
+        fetch = functools.partial(
+            self.sh.ecfsget, item, options=options, **extras
+        )
+        localcache = self._ecfslocalcache(local, extras["fmt"])
+        if localcache is None:
+            return fetch(local), extras
+        variant = json.dumps(
+            dict(
+                cpipeline=getattr(
+                    extras["cpipeline"], "description_string", None
+                ),
+                options=options,
+            ),
+            sort_keys=True,
+            default=str,
+        )
+        return localcache.retrieve(
+            item,
+            local,
+            fetch,
+            variant=variant,
+            readonly=kwargs.get("intent", "in") == "in",
         ), extras
 
+    def _ecfsearlyretrieve(self, item, local, **kwargs):
+        """
+        If no compression is involved, trigger a delayed action in order to
+        fetch several files at once (unless the node-local cache is enabled).
+        """
+        fmt = kwargs.get("fmt", "foo")
+        if (
+            isinstance(local, str)
+            and self._ecfslocalcache(local, fmt) is None
+            and kwargs.get("compressionpipeline", None) is None
+            and kwargs.get("options", None) is None
+            and not self.sh.fmtspecific_mtd("ecfsget", fmt)
+        ):
+            return self.context.delayedactions_hub.register(
+                (self._ecfsfullpath(item)[0], fmt),
+                kind="archive",
+                storage=self.storage,
+                goal="get",
+                tube="ecfs",
+            )
+        else:
+            return None
+
+    def _ecfsfinaliseretrieve(
+        self, item, local, retrieve_id, **kwargs
+    ):  # @UnusedVariable
+        """
+        Get the resource given the **retrieve_id** identifier returned by the
+        :meth:`_ecfsearlyretrieve` method.
+        """
+        extras = dict(
+            fmt=kwargs.get("fmt", "foo"),
+        )
+        d_action = self.context.delayedactions_hub.retrieve(
+            retrieve_id, bareobject=True
+        )
+        if d_action.status == d_action_status.done:
+            if self.sh.filecocoon(local):
+                rc = self.sh.mv(d_action.result, local, **extras)
+            else:
+                raise OSError("Could not cocoon: {!s}".format(local))
+        elif d_action.status == d_action_status.failed:
+            LOG.info("The earlyretrieve failed (retrieve_id=%s)", retrieve_id)
+            rc = False
+        else:
+            rc = None
+        return rc, extras
+
+    def insertbatch(self):
+        """Defer the permission changes of the inserts within a block.
+
+        See :meth:`ecmwf.tools.ecfs.ECfsTools.ecfschmod_batch`. Example::
+
+            with archive.insertbatch() as batch:
+                for item, local in todo:
+                    archive.insert(item, local)
+            if not batch.rc:
+                ...
+
+        :return: An :class:`ecmwf.tools.ecfs.ECfsChmodBatch` object
+        """
+        return self.sh.ecfschmod_batch()
+
+    def flushinserts(self):
+        """Apply the permission changes left pending by the inserts.
+
+        :return: return code
+        """
+        return self.sh.ecfschmod_flush()
+
     def _ecfsinsert(self, item, local, **kwargs):
-        """Actual _insert using ecfs"""
+        """Actual _insert using ecfs
+
+        The permissions of the inserted file are changed right away unless
+        the insert occurs within an :meth:`insertbatch` block.
+        """
         item = self._ecfsfullpath(item)[0]
         options = kwargs.get("options", None)
         extras = dict(
             fmt=kwargs.get("fmt", "foo"),
             cpipeline=kwargs.get("compressionpipeline", None),
         )
-        rc = self.sh.ecfsmkdir(target=self.sh.path.dirname(item))
-        rc = rc and self.sh.ecfsput(
-            source=local, target=item, options=options, **extras
+        rc = self.sh.ecfsinsert(
+            source=local, target=item, mode="644", options=options, **extras
         )
-        rc = rc and self.sh.ecfschmod("644", item)
+        localcache = ecfscache_from_config()
+        if localcache is not None:
+            localcache.forget(item)
         return rc, extras
 
     def _ecfsdelete(self, item, **kwargs):
@@ -158,4 +377,7 @@ class EcfsArchive(Archive):
         item = self._ecfsfullpath(item)[0]
         options = kwargs.get("options", None)
         fmt = kwargs.get("fmt", "foo")
+        localcache = ecfscache_from_config()
+        if localcache is not None:
+            localcache.forget(item)
         return self.sh.ecfsrm(item, options=options, fmt=fmt), dict(fmt=fmt)
@@ -0,0 +1,512 @@
+"""
+Named pipes (FIFO) based helpers used to stream data to or from the ECfs and
+ECtrans commands (without intermediate files).
+
+The helpers that compress into (or uncompress from) a regular file also
+feed a checksum on the way (see :mod:`ecmwf.tools.checksums`).
+
+Streaming compressed data is opt-in (see the ``ecfs_streaming`` and
+``ectrans_streaming`` keys of the ``ecmwf`` configuration section): the
+actual tools are not guaranteed to handle named pipes properly and failed
+transfers that involve a named pipe can not be retried.
+"""
+
+import contextlib
+import hashlib
+import logging
+import os
+import stat
+import threading
+import time
+
+from . import metrics
+
+#: No automatic export
+__all__ = []
+
+LOG = logging.getLogger(__name__)
+
+
+def fileobj_path(fileobj):
+    """Return a path that gives access to the **fileobj** file object.
+
+    Provided that **fileobj** is associated with a regular file, the
+    ``/proc/<pid>/fd/<fd>`` path can be opened by any other process of the
+    same user (even if the file was removed or is anonymous). ``None`` is
+    returned if such a path can not be found.
+    """
+    try:
+        fd = fileobj.fileno()
+    except (AttributeError, OSError, ValueError):
+        return None
+    path = "/proc/{:d}/fd/{:d}".format(os.getpid(), fd)
+    try:
+        if not stat.S_ISREG(os.fstat(fd).st_mode) or not os.path.exists(path):
+            return None
+    except OSError:
+        return None
+    if hasattr(fileobj, "flush"):
+        fileobj.flush()
+    return path
+
+
+class FileRangeReader:
+    """A read-only file-like object over **length** bytes of **fileobj**.
+
+    The data are read from **offset** and a checksum is computed on the fly
+    (see :meth:`hexdigest`). Only rewinding is supported by :meth:`seek`.
+    An :class:`OSError` is raised if **fileobj** ends prematurely.
+    """
+
+    def __init__(self, fileobj, offset, length, algorithm="sha256"):
+        """
+        :param fileobj: The underlying (seekable) file object
+        :param int offset: The position of the first byte
+        :param int length: The number of bytes available
+        :param str algorithm: The checksum algorithm (see :mod:`hashlib`)
+        """
+        self._fileobj = fileobj
+        self._offset = offset
+        self._length = length
+        self._algorithm = algorithm
+        self.seek(0)
+
+    def seek(self, pos, whence=0):
+        if pos != 0 or whence != 0:
+            raise ValueError("Only rewinding is supported")
+        self._pos = 0
+        self._hash = hashlib.new(self._algorithm)
+        return 0
+
+    def read(self, size=-1):
+        remaining = self._length - self._pos
+        if size is None or size < 0 or size > remaining:
+            size = remaining
+        if size == 0:
+            return b""
+        self._fileobj.seek(self._offset + self._pos)
+        data = self._fileobj.read(size)
+        if not data:
+            raise OSError(
+                "Unexpected end of file at offset {:d}".format(
+                    self._offset + self._pos
+                )
+            )
+        self._pos += len(data)
+        self._hash.update(data)
+        return data
+
+    def hexdigest(self):
+        """The checksum of the data read so far."""
+        return self._hash.hexdigest()
+
+
+class FileRangeWriter:
+    """A write-only file-like object that writes into **fileobj** from **offset**.
+
+    A checksum of the data written is computed on the fly (see
+    :meth:`hexdigest`).
+    """
+
+    def __init__(self, fileobj, offset, algorithm="sha256"):
+        """
+        :param fileobj: The underlying (seekable) file object
+        :param int offset: The position of the first byte
+        :param str algorithm: The checksum algorithm (see :mod:`hashlib`)
+        """
+        self._fileobj = fileobj
+        self._offset = offset
+        self._hash = hashlib.new(algorithm)
+        #: The number of bytes written so far
+        self.length = 0
+
+    def write(self, data):
+        self._fileobj.seek(self._offset + self.length)
+        self._fileobj.write(data)
+        self._hash.update(data)
+        self.length += len(data)
+        return len(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+    def hexdigest(self):
+        """The checksum of the data written so far."""
+        return self._hash.hexdigest()
+
+
+class _MeteredWriter:
+    """Count the data written into **fileobj** (and feed **hasher** with them)."""
+
+    def __init__(self, fileobj, hasher=None):
+        self._fileobj = fileobj
+        self._hasher = hasher
+        self.nbytes = 0
+
+    def write(self, data):
+        if self._hasher is not None:
+            self._hasher.update(data)
+        self.nbytes += memoryview(data).nbytes
+        return self._fileobj.write(data)
+
+    def flush(self):
+        self._fileobj.flush()
+
+
+@contextlib.contextmanager
+def _compress2pipe(sh, cpipeline, local, rcs):
+    """Compress **local** into a pipe.
+
+    Like :meth:`vortex.tools.compression.CompressionPipeline.compress2stream`
+    except that, when leaving the context, the outcome of the compression
+    processes is appended to the **rcs** list (rather than being logged).
+    """
+    opened = isinstance(local, str)
+    stream = open(local, "rb") if opened else local
+    processes = list()
+    try:
+        lstream = stream
+        for unit in cpipeline.units:
+            p = unit.compress(sh, lstream)
+            lstream = p.stdout
+            processes.append(p)
+        yield lstream
+    finally:
+        for i, p in enumerate(processes):
+            if not sh.pclose(p):
+                LOG.error("The compression process #%d failed", i)
+                rcs.append(False)
+        if opened:
+            stream.close()
+
+
+def _copy2fifo(sh, fhin, fhout):
+    """Copy **fhin** into **fhout** (in one go for in-memory buffers)."""
+    if hasattr(fhin, "getbuffer"):
+        with fhin.getbuffer() as view:
+            fhout.write(view)
+    else:
+        sh.copyfileobj(fhin, fhout)
+
+
+class FifoFeeder(threading.Thread):
+    """A thread that writes data into a FIFO.
+
+    The data are either the output of a compression pipeline or the
+    raw content of a file-like object (if **cpipeline** is ``None``).
+
+    The :attr:`rc` attribute tells whether the whole data were written into
+    the FIFO and whether the compression processes succeeded (it is only
+    meaningful once the thread is over).
+    """
+
+    def __init__(self, sh, cpipeline, local, fifo, hasher=None):
+        """
+        :param sh: The System object used by the compression pipeline
+        :param cpipeline: The compression pipeline (or ``None``)
+        :param local: The data to be compressed (filename or file-like object)
+                      or the file-like object to be copied
+        :param fifo: The path to the named pipe
+        :param hasher: A :mod:`hashlib` object fed with the data written
+                       into the FIFO (or ``None``)
+        """
+        super().__init__(name="fifo_feeder", daemon=True)
+        self._sh = sh
+        self._cpipeline = cpipeline
+        self._local = local
+        self._fifo = fifo
+        self._hasher = hasher
+        self.rc = False
+        #: Time spent processing data (in seconds)
+        self.elapsed = 0.0
+        #: Number of bytes written into the FIFO
+        self.nbytes = 0
+
+    @contextlib.contextmanager
+    def _instream(self, rcs):
+        if self._cpipeline is None:
+            self._local.seek(0)
+            yield self._local
+        else:
+            with _compress2pipe(
+                self._sh, self._cpipeline, self._local, rcs
+            ) as fhin:
+                yield fhin
+
+    def run(self):
+        try:
+            # This blocks until the reader opens the FIFO
+            with open(self._fifo, "wb") as fhout:
+                t0 = time.monotonic()
+                rcs = list()
+                with self._instream(rcs) as fhin:
+                    metered = _MeteredWriter(fhout, self._hasher)
+                    try:
+                        _copy2fifo(self._sh, fhin, metered)
+                        rcs.append(True)
+                    except OSError as e:
+                        LOG.error(
+                            "Streaming into %s failed: %s", self._fifo, e
+                        )
+                        if self._cpipeline is not None:
+                            # Close the pipe so that the compression
+                            # processes do not block
+                            fhin.close()
+                    finally:
+                        self.nbytes = metered.nbytes
+                # A compression process that crashed only truncates its output
+                self.rc = bool(rcs) and all(rcs)
+                self.elapsed = time.monotonic() - t0
+        except OSError as e:
+            LOG.error("Could not stream into %s: %s", self._fifo, e)
+
+    def abandon(self):
+        """Unblock the writer if nobody ever opened the FIFO for reading."""
+        try:
+            fd = os.open(self._fifo, os.O_RDONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def _fifo_feeding(sh, cpipeline, local, rcs, hasher):
+    """See :func:`compress2fifo` and :func:`fileobj2fifo`."""
+    suffix = "" if cpipeline is None else cpipeline.suffix
+    with sh.temporary_dir_context(prefix="ecmwf_fifo_") as tmpdir:
+        fifo = sh.path.join(tmpdir, "stream" + suffix)
+        os.mkfifo(fifo)
+        feeder = FifoFeeder(sh, cpipeline, local, fifo, hasher=hasher)
+        feeder.start()
+        try:
+            yield fifo
+        finally:
+            while feeder.is_alive():
+                feeder.abandon()
+                feeder.join(0.1)
+            rcs.append(feeder.rc)
+            metrics.add_nbytes(feeder.nbytes)
+            if cpipeline is not None:
+                metrics.add_compression_time(feeder.elapsed)
+
+
+def compress2fifo(sh, cpipeline, local, rcs, hasher=None):
+    """Compress **local** into a named pipe.
+
+    This method creates a context manager that yields the path to the named
+    pipe. The transfer command should read it before leaving the context.
+    When leaving the context, the compression outcome is appended to the
+    **rcs** list. Example::
+
+        rcs = list()
+        with compress2fifo(sh, cpipeline, "myfile", rcs) as fifo:
+            rcs.append(sh.ecfscp(fifo, "ec:/user/myfile.gz"))
+        rc = all(rcs)
+
+    :param sh: The System object used by the compression pipeline
+    :param cpipeline: The compression pipeline
+    :param local: The data to be compressed (filename or file-like object)
+    :param list rcs: The list where the compression return code is stored
+    :param hasher: A :mod:`hashlib` object fed with the compressed data (see
+                   :mod:`ecmwf.tools.checksums`)
+    """
+    return _fifo_feeding(sh, cpipeline, local, rcs, hasher)
+
+
+def fileobj2fifo(sh, fileobj, rcs, hasher=None):
+    """Copy the whole content of **fileobj** into a named pipe.
+
+    Like :func:`compress2fifo`, without compression.
+
+    :param sh: The System object
+    :param fileobj: The file-like object to be copied
+    :param list rcs: The list where the copy return code is stored
+    :param hasher: A :mod:`hashlib` object fed with the data
+    """
+    return _fifo_feeding(sh, None, fileobj, rcs, hasher)
+
+
+def compress2file(sh, cpipeline, local, destination, hasher=None):
+    """Compress **local** into the **destination** file.
+
+    Like :meth:`vortex.tools.compression.CompressionPipeline.compress2file`
+    except that **hasher** is fed with the compressed data while they are
+    written (rather than by reading **destination** once more) and that a
+    failed compression process makes it fail.
+
+    :param sh: The System object used by the compression pipeline
+    :param cpipeline: The compression pipeline
+    :param local: The data to be compressed (filename or file-like object)
+    :param str destination: The compressed file
+    :param hasher: A :mod:`hashlib` object fed with the compressed data
+    :return: return code
+    """
+    rcs = list()
+    with open(destination, "wb") as fhout:
+        with _compress2pipe(sh, cpipeline, local, rcs) as fhin:
+            try:
+                sh.copyfileobj(fhin, _MeteredWriter(fhout, hasher))
+                rcs.append(True)
+            except OSError as e:
+                LOG.error("Compressing into %s failed: %s", destination, e)
+                rcs.append(False)
+                # Close the pipe so that the compression processes do not block
+                fhin.close()
+    return all(rcs)
+
+
+def file2uncompress(sh, cpipeline, local, destination, hasher=None):
+    """Uncompress the **local** file into **destination**.
+
+    Like :meth:`vortex.tools.compression.CompressionPipeline.file2uncompress`
+    except that **hasher** is fed with the compressed data while they are
+    read.
+
+    :param sh: The System object used by the compression pipeline
+    :param cpipeline: The compression pipeline
+    :param str local: The compressed file
+    :param destination: The uncompressed data destination (filename or
+                        file-like object)
+    :param hasher: A :mod:`hashlib` object fed with the compressed data
+    :return: return code
+    """
+    try:
+        with cpipeline.stream2uncompress(destination) as fhout:
+            with open(local, "rb") as fhin:
+                sh.copyfileobj(fhin, _MeteredWriter(fhout, hasher))
+    except OSError as e:
+        LOG.error("Uncompressing %s failed: %s", local, e)
+        return False
+    return True
+
+
+class FifoDrainer(threading.Thread):
+    """A thread that reads the data written into a FIFO.
+
+    The data are either uncompressed by a compression pipeline or copied
+    as such into a file-like object (if **cpipeline** is ``None``).
+
+    The :attr:`rc` attribute tells whether the whole FIFO content was read
+    and processed (it is only meaningful once the thread is over).
+    """
+
+    def __init__(self, sh, cpipeline, local, fifo, hasher=None):
+        """
+        :param sh: The System object used by the compression pipeline
+        :param cpipeline: The compression pipeline (or ``None``)
+        :param local: The data destination (filename or file-like object if
+                      **cpipeline** is provided, file-like object otherwise)
+        :param fifo: The path to the named pipe
+        :param hasher: A :mod:`hashlib` object fed with the data read from
+                       the FIFO (or ``None``)
+        """
+        super().__init__(name="fifo_drainer", daemon=True)
+        self._sh = sh
+        self._cpipeline = cpipeline
+        self._local = local
+        self._fifo = fifo
+        self._hasher = hasher
+        self.abandoned = False
+        self.rc = False
+        #: Time spent processing data (in seconds)
+        self.elapsed = 0.0
+        #: Number of bytes read from the FIFO
+        self.nbytes = 0
+
+    @contextlib.contextmanager
+    def _outstream(self):
+        if self._cpipeline is None:
+            yield self._local
+        else:
+            with self._cpipeline.stream2uncompress(self._local) as fhout:
+                yield fhout
+
+    def run(self):
+        try:
+            # This blocks until the writer opens the FIFO
+            with open(self._fifo, "rb") as fhin:
+                if self.abandoned:
+                    return
+                t0 = time.monotonic()
+                with self._outstream() as fhout:
+                    metered = _MeteredWriter(fhout, self._hasher)
+                    try:
+                        self._sh.copyfileobj(fhin, metered)
+                    finally:
+                        self.nbytes = metered.nbytes
+                    self.rc = True
+                self.elapsed = time.monotonic() - t0
+        except OSError as e:
+            LOG.error("Could not stream from %s: %s", self._fifo, e)
+
+    def abandon(self):
+        """Unblock the reader if nobody ever opened the FIFO for writing."""
+        self.abandoned = True
+        try:
+            fd = os.open(self._fifo, os.O_WRONLY | os.O_NONBLOCK)
+        except OSError:
+            return
+        os.close(fd)
+
+
+@contextlib.contextmanager
+def _fifo_draining(sh, cpipeline, local, rcs, hasher):
+    """See :func:`fifo2uncompress` and :func:`fifo2fileobj`."""
+    suffix = "" if cpipeline is None else cpipeline.suffix
+    with sh.temporary_dir_context(prefix="ecmwf_fifo_") as tmpdir:
+        fifo = sh.path.join(tmpdir, "stream" + suffix)
+        os.mkfifo(fifo)
+        drainer = FifoDrainer(sh, cpipeline, local, fifo, hasher=hasher)
+        drainer.start()
+        ok = False
+        try:
+            yield fifo
+            ok = True
+        finally:
+            while drainer.is_alive():
+                drainer.abandon()
+                drainer.join(0.1)
+            rcs.append(drainer.rc)
+            metrics.add_nbytes(drainer.nbytes)
+            if cpipeline is not None:
+                metrics.add_compression_time(drainer.elapsed)
+            if not (ok and all(rcs)) and isinstance(local, str):
+                sh.rm(local)
+
+
+def fifo2uncompress(sh, cpipeline, local, rcs, hasher=None):
+    """Uncompress the data written into a named pipe into **local**.
+
+    This method creates a context manager that yields the path to the named
+    pipe. The transfer command should write into it before leaving the
+    context. When leaving the context, the uncompression outcome is appended
+    to the **rcs** list. If anything went wrong, **local** is removed (if it
+    is a filename). Example::
+
+        rcs = list()
+        with fifo2uncompress(sh, cpipeline, "myfile", rcs) as fifo:
+            rcs.append(sh.ecfscp("ec:/user/myfile.gz", fifo))
+        rc = all(rcs)
+
+    :param sh: The System object used by the compression pipeline
+    :param cpipeline: The compression pipeline
+    :param local: The uncompressed data destination (filename or file-like
+                  object)
+    :param list rcs: The list where the uncompression return code is stored
+    :param hasher: A :mod:`hashlib` object fed with the compressed data (see
+                   :mod:`ecmwf.tools.checksums`)
+    """
+    return _fifo_draining(sh, cpipeline, local, rcs, hasher)
+
+
+def fifo2fileobj(sh, fileobj, rcs, hasher=None):
+    """Copy the data written into a named pipe into **fileobj**.
+
+    Like :func:`fifo2uncompress`, without uncompression.
+
+    :param sh: The System object
+    :param fileobj: The destination file-like object
+    :param list rcs: The list where the copy return code is stored
+    :param hasher: A :mod:`hashlib` object fed with the data
+    """
+    return _fifo_draining(sh, None, fileobj, rcs, hasher)
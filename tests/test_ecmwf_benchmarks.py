@@ -0,0 +1,77 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase, main
+
+import vortex_ecmwf  # noqa: F401
+from vortex_ecmwf.tools.benchmarks import (
+    BenchmarkCase,
+    compare_with_baseline,
+    default_cases,
+    load_baseline,
+    main as benchmarks_main,
+    run_benchmarks,
+    save_baseline,
+)
+
+
+class TestBenchmarks(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_benchmarks_")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_cases(self):
+        cases = default_cases(nfiles=(1, 2), sizes=(10,))
+        self.assertEqual(len(cases), 3 * 2 * 2 + 2 + 2)
+        self.assertIn("ecfstest-n2-s0-raw", [c.name for c in cases])
+        self.assertIn("ectransqueue-n2-s10-raw", [c.name for c in cases])
+        with self.assertRaises(ValueError):
+            BenchmarkCase("ecfsdance", 1, 10)
+
+    def test_run(self):
+        cases = default_cases(nfiles=(2,), sizes=(4096,))
+        results = run_benchmarks(cases, latency=0.01, repeat=1)
+        self.assertEqual(sorted(results), sorted(c.name for c in cases))
+        for result in results.values():
+            self.assertGreaterEqual(result["latency"], 0.01 / 2)
+        self.assertGreater(results["ecfsput-n2-s4096-gzip"]["throughput"], 0)
+        self.assertGreater(
+            results["ectransqueue-n2-s4096-raw"]["throughput"], 0
+        )
+
+    def test_baseline(self):
+        results = dict(
+            a=dict(walltime=1.0, latency=0.1, throughput=1000.0),
+            b=dict(walltime=1.0, latency=0.1, throughput=0.0),
+        )
+        baseline = os.path.join(self.tmpdir, "baseline.json")
+        save_baseline(baseline, results, latency=0.1)
+        self.assertEqual(load_baseline(baseline), (results, dict(latency=0.1)))
+        self.assertEqual(compare_with_baseline(results, results), [])
+        slower = dict(
+            a=dict(walltime=2.0, latency=0.2, throughput=500.0),
+            b=dict(walltime=1.1, latency=0.11, throughput=0.0),
+            c=dict(walltime=9.0, latency=0.9, throughput=1.0),
+        )
+        regressions = compare_with_baseline(slower, results, tolerance=0.2)
+        self.assertEqual(len(regressions), 2)
+        self.assertTrue(all(r.startswith("a: ") for r in regressions))
+
+    def test_main(self):
+        baseline = os.path.join(self.tmpdir, "baseline.json")
+        argv = [
+            "--operations=ecfstest",
+            "--nfiles=1",
+            "--repeat=1",
+        ]
+        self.assertEqual(benchmarks_main(argv + ["--save", baseline]), 0)
+        results, _ = load_baseline(baseline)
+        results["ecfstest-n1-s0-raw"]["latency"] = 1e-6
+        save_baseline(baseline, results, latency=0.0, bandwidth=0)
+        self.assertEqual(benchmarks_main(argv + ["--baseline", baseline]), 1)
+
+
+if __name__ == "__main__":
+    main(verbosity=2)
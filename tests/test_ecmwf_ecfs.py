@@ -0,0 +1,976 @@
+import gzip
+import hashlib
+import io
+import multiprocessing
+import os
+import shutil
+import sys
+import tempfile
+import threading
+from unittest import TestCase, main, mock
+
+import footprints
+from vortex import config, sessions, ticket
+from vortex.tools.compression import CompressionPipeline
+from vortex.tools.net import uriparse
+from vortex.tools.systems import ExecutionError
+
+import vortex_ecmwf  # noqa: F401
+from vortex_ecmwf.tools import checksums, cmdsessions, metrics
+from vortex_ecmwf.tools.ecfscache import ECfsLocalCache
+from vortex_ecmwf.tools.ecfs import (
+    ECfsDirectoriesMemo,
+    ecfs_known_directories,
+)
+from vortex_ecmwf.tools.ecfsmeta import ECfsMetadataCache
+
+sh = ticket().sh
+
+FAKE_ECFS = """#!{python:s}
+import os
+import shutil
+import sys
+import time
+
+root = os.environ["FAKE_ECFS_ROOT"]
+command = os.path.basename(sys.argv[0])
+with open(os.environ["FAKE_ECFS_LOG"], "a") as fhlog:
+    fhlog.write(" ".join([command] + sys.argv[1:]) + "\\n")
+paths = [
+    os.path.join(root, a[3:].lstrip("/")) if a.startswith("ec:") else a
+    for a in sys.argv[1:]
+    if not a.startswith("-")
+]
+if command == "etest":
+    sys.exit(0 if os.path.exists(paths[0]) else 1)
+if command == "els":
+    if os.path.isdir(paths[0]):
+        print("\\n".join(sorted(os.listdir(paths[0]))))
+    elif os.path.exists(paths[0]):
+        print(os.path.basename(paths[0]))
+    else:
+        sys.exit(1)
+    sys.exit(0)
+if command == "echmod":
+    for path in paths[1:]:
+        os.chmod(path, int(paths[0], 8))
+    sys.exit(0)
+if command == "emkdir":
+    os.makedirs(paths[0], exist_ok=True)
+    sys.exit(0)
+if command == "emove":
+    os.rename(paths[0], paths[1])
+    sys.exit(0)
+if command == "erm":
+    if os.path.isdir(paths[0]):
+        shutil.rmtree(paths[0])
+    else:
+        os.remove(paths[0])
+    sys.exit(0)
+if command == "estage":
+    staged = os.path.join(root, "staged.txt")
+    items = [a for a in sys.argv[1:] if not a.startswith("-")]
+    if "-q" not in sys.argv:
+        if "FAKE_ECFS_STAGE_FAIL" in os.environ:
+            sys.exit(1)
+        with open(staged, "a") as fhstaged:
+            fhstaged.write("\\n".join(items) + "\\n")
+        sys.exit(0)
+    done = open(staged).read().split() if os.path.exists(staged) else []
+    for item in items:
+        name = os.path.basename(item)
+        offline = name.startswith("off") and item not in done
+        tape = name[3:].split("_")[0] if name.startswith("off") else "disk"
+        print(item, tape, "offline" if offline else "online")
+    sys.exit(0)
+failures = os.environ.get("FAKE_ECFS_FAILURES")
+if failures and os.path.exists(failures):
+    # "<n> <m>": the n next copies succeed, the m following ones fail
+    with open(failures) as fhfail:
+        nok, nko = [int(n) for n in fhfail.read().split()]
+    with open(failures, "w") as fhfail:
+        if nok:
+            fhfail.write("{{:d}} {{:d}}".format(nok - 1, nko))
+        else:
+            fhfail.write("0 {{:d}}".format(max(0, nko - 1)))
+    if not nok and nko:
+        # Interrupted while reading
+        open(paths[0], "rb").read(10)
+        sys.exit(1)
+if "FAKE_ECFS_DELAY" in os.environ:
+    time.sleep(float(os.environ["FAKE_ECFS_DELAY"]))
+target = paths.pop()
+for source in paths:
+    if not os.path.exists(source):
+        sys.exit(1)
+    if os.path.isdir(target):
+        ftarget = os.path.join(target, os.path.basename(source))
+    else:
+        ftarget = target
+    with open(source, "rb") as fhin, open(ftarget, "wb") as fhout:
+        shutil.copyfileobj(fhin, fhout)
+"""
+
+WARM_BACKEND = """
+import os
+
+calls = []
+
+
+def factory():
+    def run(argv, cwd=None, env=None):
+        calls.append(argv)
+        return 0, "{:d} {:d}\\n".format(os.getpid(), len(calls)), ""
+
+    return run
+"""
+
+FAKE_ECFS_COMMANDS = (
+    "echmod",
+    "ecp",
+    "els",
+    "emkdir",
+    "emove",
+    "erm",
+    "estage",
+    "etest",
+)
+
+
+class _FakeEcfsTestCase(TestCase):
+    """Run the ECfs commands against fake executables (in a temporary cwd)."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_ecfs_")
+        self.root = os.path.join(self.tmpdir, "root")
+        self.bindir = os.path.join(self.tmpdir, "bin")
+        self.log = os.path.join(self.tmpdir, "calls.log")
+        os.makedirs(os.path.join(self.root, "a"))
+        os.makedirs(os.path.join(self.root, "b"))
+        os.makedirs(self.bindir)
+        for command in FAKE_ECFS_COMMANDS:
+            fake = os.path.join(self.bindir, command)
+            with open(fake, "w") as fhfake:
+                fhfake.write(FAKE_ECFS.format(python=sys.executable))
+            os.chmod(fake, 0o755)
+        self._environ = os.environ.copy()
+        os.environ["PATH"] = self.bindir + os.pathsep + os.environ["PATH"]
+        os.environ["FAKE_ECFS_ROOT"] = self.root
+        os.environ["FAKE_ECFS_LOG"] = self.log
+        os.environ["FAKE_ECFS_FAILURES"] = os.path.join(
+            self.tmpdir, "failures.txt"
+        )
+        self._config = dict(config.VORTEX_CONFIG.get("ecmwf", dict()))
+        config.set_config(
+            "ecmwf",
+            "ecfs_metacache_path",
+            os.path.join(self.tmpdir, "metacache.db"),
+        )
+        config.set_config(
+            "ecmwf", "coalescing_path", os.path.join(self.tmpdir, "locks")
+        )
+        ecfs_known_directories.clear()
+        footprints.proxy.addon(kind="ecfs", shell=sh)
+        self._oldpwd = sh.pwd()
+        sh.cd(self.tmpdir)
+
+    def tearDown(self):
+        config.VORTEX_CONFIG["ecmwf"] = self._config
+        cmdsessions.close_all()
+        sh.cd(self._oldpwd)
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tmpdir)
+
+    def _ncalls(self, command=None):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as fhlog:
+            return len(
+                [
+                    line
+                    for line in fhlog
+                    if command is None or line.split()[0] == command
+                ]
+            )
+
+    def _fail_copies(self, nok, nko):
+        with open(os.environ["FAKE_ECFS_FAILURES"], "w") as fhfail:
+            fhfail.write("{:d} {:d}".format(nok, nko))
+
+
+class TestEcfsBatch(_FakeEcfsTestCase):
+    def test_batch_get(self):
+        for subdir in ("a", "b"):
+            for i in range(3):
+                with open(
+                    os.path.join(self.root, subdir, "f{:d}".format(i)), "w"
+                ) as fhs:
+                    fhs.write(subdir + str(i))
+        sources = ["ec:/{:s}/f{:d}".format(d, i) for d in "ab" for i in (0, 1)]
+        targets = ["loc/{:s}_f{:d}".format(d, i) for d in "ab" for i in (0, 1)]
+        sources.append("ec:/a/missing")
+        targets.append("loc/missing")
+        rcs = sh.ecfsbatchcp(sources, targets)
+        self.assertEqual(rcs, [True, True, True, True, False])
+        # Two batches (because of duplicated basenames), the first one fails
+        # because of the missing file: its 3 items are copied one by one
+        self.assertEqual(self._ncalls(), 5)
+        with open("loc/b_f1") as fhl:
+            self.assertEqual(fhl.read(), "b1")
+        self.assertEqual(
+            sorted(os.listdir("loc")),
+            sorted([os.path.basename(t) for t in targets[:-1]]),
+        )
+
+    def test_batch_put(self):
+        os.makedirs("loc")
+        sources = list()
+        for i in range(4):
+            sources.append("loc/f{:d}".format(i))
+            with open(sources[-1], "w") as fhl:
+                fhl.write(str(i))
+        targets = ["ec:/a/g0", "ec:/a/g1", "ec:/b/g0", "ec:/b/g1"]
+        rcs = sh.ecfsbatchcp(sources, targets)
+        self.assertEqual(rcs, [True] * 4)
+        self.assertEqual(self._ncalls(), 2)
+        with open(os.path.join(self.root, "b", "g1")) as fhr:
+            self.assertEqual(fhr.read(), "3")
+
+    def test_delayed_get(self):
+        for i in range(4):
+            with open(os.path.join(self.root, "a", str(i)), "w") as fhs:
+                fhs.write(str(i))
+        hub = sessions.current().context.delayedactions_hub
+        self.addCleanup(hub.clear)
+        archive = footprints.proxy.archive(
+            kind="std", storage="ecfs.ecmwf.int", tube="ecfs", entry="/"
+        )
+        store = footprints.proxy.store(scheme="ecfs", netloc="ecfs.ecmwf.int")
+        todo = [
+            (archive, "/a/0", "loc0"),
+            (archive, "/a/1", "loc1"),
+            (store, uriparse("ecfs://ecfs.ecmwf.int/a/2"), "loc2"),
+            (archive, "/a/missing", "locm"),
+        ]
+        r_ids = list()
+        for actor, item, local in todo:
+            if actor is archive:
+                r_ids.append(archive.earlyretrieve(item, local))
+            else:
+                r_ids.append(store.earlyget(item, local))
+        self.assertTrue(all(r_ids))
+        self.assertEqual(self._ncalls(), 0)
+        hub.finalise(*r_ids)
+        # One batch, that fails because of the missing file: its items
+        # are then copied one by one
+        self.assertEqual(self._ncalls("ecp"), 1 + 4)
+        rcs = list()
+        for (actor, item, local), r_id in zip(todo, r_ids):
+            if actor is archive:
+                rcs.append(archive.finaliseretrieve(r_id, item, local))
+            else:
+                rcs.append(store.finaliseget(r_id, item, local))
+        self.assertEqual(rcs, [True, True, True, False])
+        for i in range(3):
+            with open("loc{:d}".format(i)) as fhl:
+                self.assertEqual(fhl.read(), str(i))
+        self.assertFalse(os.path.exists("locm"))
+        # Compressed gets are not delayed
+        cpipeline = CompressionPipeline(sh, "gzip")
+        self.assertIsNone(
+            archive.earlyretrieve(
+                "/a/3", "loc3", compressionpipeline=cpipeline
+            )
+        )
+
+
+class TestEcfsWorkersPool(_FakeEcfsTestCase):
+    def test_workers_pool(self):
+        for i in range(6):
+            with open(os.path.join(self.root, "a", str(i)), "w") as fhs:
+                fhs.write(str(i))
+        with sh.ecfsworkers(maxworkers=3) as pool:
+            self.assertEqual(pool.maxworkers, 3)
+            for i in range(6):
+                pool.ecfsget("ec:/a/{:d}".format(i), "loc_{:d}".format(i))
+            pool.ecfsget("ec:/a/missing", "loc_missing")
+        results = pool.results()
+        self.assertEqual(results[:6], [True] * 6)
+        self.assertIsInstance(results[6], Exception)
+        with open("loc_5") as fhl:
+            self.assertEqual(fhl.read(), "5")
+
+
+class TestEcfsMetadataCache(_FakeEcfsTestCase):
+    def setUp(self):
+        super().setUp()
+        # The metadata cache is disabled by default
+        self.assertIsNone(
+            footprints.proxy.addon(kind="ecfs", shell=sh).ecfsmetacache
+        )
+        config.set_config("ecmwf", "ecfs_metacache_ttl", 600)
+        footprints.proxy.addon(kind="ecfs", shell=sh)
+
+    def test_metadata_cache(self):
+        for i in range(3):
+            with open(os.path.join(self.root, "a", str(i)), "w") as fhs:
+                fhs.write(str(i))
+        self.assertTrue(sh.ecfstest("ec:/a/0"))
+        self.assertTrue(sh.ecfstest("ec:/a/1"))
+        # A unique listing of the directory answers the positive tests
+        self.assertEqual(self._ncalls("els"), 1)
+        # Negative answers are not cached
+        self.assertFalse(sh.ecfstest("ec:/a/missing"))
+        self.assertFalse(sh.ecfstest("ec:/a/missing"))
+        self.assertEqual(self._ncalls("els"), 3)
+        self.assertEqual(self._ncalls("etest"), 0)
+        self.assertEqual(sh.ecfsls("ec:/a", None), ["0", "1", "2"])
+        self.assertEqual(sh.ecfsls("ec:/a", None), ["0", "1", "2"])
+        self.assertEqual(self._ncalls("els"), 4)
+        # Puts and removals invalidate the cache
+        with open("missing", "w") as fhl:
+            fhl.write("new")
+        self.assertTrue(sh.ecfsput("missing", "ec:/a/missing"))
+        self.assertTrue(sh.ecfstest("ec:/a/missing"))
+        self.assertTrue(sh.ecfsrm("ec:/a/0", None))
+        self.assertFalse(sh.ecfstest("ec:/a/0"))
+        self.assertEqual(sh.ecfsls("ec:/a", None), ["1", "2", "missing"])
+        self.assertEqual(self._ncalls("els"), 7)
+        # Other tests are not cached
+        self.assertTrue(sh.ecfstest("ec:/a/1", options=["d"]))
+        self.assertEqual(self._ncalls("etest"), 1)
+
+    def test_metadata_cache_fork(self):
+        cache = ECfsMetadataCache(os.path.join(self.tmpdir, "other.db"))
+        cache.store_test("ec:/a/0", True)
+        cache.store_test("ec:/a/1", False)
+        self.assertIsNone(cache.test("ec:/a/1"))
+        parent_db = cache._db
+        # Pretend that the cache object was inherited from a parent process
+        cache._pid = -1
+        self.assertTrue(cache.test("ec:/a/0"))
+        self.assertIsNot(cache._db, parent_db)
+        cache.close()
+        parent_db.close()
+
+
+class TestEcfsKnownDirectories(_FakeEcfsTestCase):
+    def test_memo(self):
+        memo = ECfsDirectoriesMemo(maxsize=3)
+        memo.add("ec:a")
+        memo.add("rel/dir/")
+        self.assertEqual(list(memo._directories), ["ec:a", "rel", "rel/dir"])
+        memo.add("ec:/x/y")
+        # The leaf is the most recently used, its ancestors come before it
+        self.assertEqual(
+            list(memo._directories), ["rel/dir", "ec:/x", "ec:/x/y"]
+        )
+        memo.add("ec:/x/z")
+        self.assertEqual(
+            list(memo._directories), ["ec:/x/y", "ec:/x", "ec:/x/z"]
+        )
+        self.assertIn("ec:/x/y/", memo)
+
+    def test_known_directories(self):
+        self.assertTrue(sh.ecfsmkdir("ec:/c/d"))
+        self.assertTrue(sh.ecfsmkdir("ec:/c/d"))
+        self.assertTrue(sh.ecfsmkdir("ec:/c"))
+        self.assertEqual(self._ncalls("emkdir"), 1)
+        with open("f", "w") as fhl:
+            fhl.write("f")
+        self.assertTrue(sh.ecfsput("f", "ec:/a/f"))
+        self.assertTrue(sh.ecfsmkdir("ec:/a"))
+        self.assertEqual(self._ncalls("emkdir"), 1)
+        self.assertTrue(sh.ecfsrm("ec:/a/f", None))
+        self.assertTrue(sh.ecfsrm("ec:/c", None))
+        self.assertTrue(sh.ecfsmkdir("ec:/c/d"))
+        self.assertEqual(self._ncalls("emkdir"), 2)
+
+
+class TestEcfsInsert(_FakeEcfsTestCase):
+    def test_insert(self):
+        for i in range(3):
+            with open("f{:d}".format(i), "w") as fhl:
+                fhl.write(str(i))
+        # Outside of a batch, permissions are changed right away
+        self.assertTrue(sh.ecfsinsert("f0", "ec:/d/f0", mode="600"))
+        self.assertEqual(self._ncalls("echmod"), 1)
+        fstat = os.stat(os.path.join(self.root, "d", "f0"))
+        self.assertEqual(fstat.st_mode & 0o777, 0o600)
+        with sh.ecfschmod_batch() as batch:
+            for i in range(3):
+                self.assertTrue(
+                    sh.ecfsinsert("f{:d}".format(i), "ec:/c/f{:d}".format(i))
+                )
+            self.assertEqual(self._ncalls("echmod"), 1)
+        self.assertTrue(batch.rc)
+        self.assertEqual(self._ncalls("emkdir"), 2)
+        self.assertEqual(self._ncalls("ecp"), 4)
+        self.assertEqual(self._ncalls("echmod"), 2)
+        for i in range(3):
+            fstat = os.stat(os.path.join(self.root, "c", "f{:d}".format(i)))
+            self.assertEqual(fstat.st_mode & 0o777, 0o644)
+        # The failure of the deferred changes is reported by the batch
+        archive = footprints.proxy.archive(
+            kind="std", storage="ecfs.ecmwf.int", tube="ecfs", entry="/"
+        )
+        with archive.insertbatch() as batch:
+            self.assertTrue(archive.insert("/c/g0", "f0"))
+            self.assertTrue(archive.insert("/c/g1", "f1"))
+            os.remove(os.path.join(self.root, "c", "g1"))
+        self.assertFalse(batch.rc)
+        fstat = os.stat(os.path.join(self.root, "c", "g0"))
+        self.assertEqual(fstat.st_mode & 0o777, 0o644)
+        self.assertTrue(archive.flushinserts())
+        # With batches, permissions are changed right after each batch
+        ncalls = self._ncalls("echmod")
+        rcs = sh.ecfsbatchcp(
+            ["f0", "f1"], ["ec:/a/g0", "ec:/b/g1"], mode="600"
+        )
+        self.assertEqual(rcs, [True, True])
+        self.assertEqual(self._ncalls("echmod"), ncalls + 2)
+        fstat = os.stat(os.path.join(self.root, "b", "g1"))
+        self.assertEqual(fstat.st_mode & 0o777, 0o600)
+
+
+class TestEcfsStreaming(_FakeEcfsTestCase):
+    def setUp(self):
+        super().setUp()
+        # Streaming is opt-in
+        config.set_config("ecmwf", "ecfs_streaming", True)
+
+    def test_streaming_put(self):
+        with open("f", "wb") as fhl:
+            fhl.write(b"streamed" * 10000)
+        cpipeline = CompressionPipeline(sh, "gzip")
+        self.assertTrue(sh.ecfsput("f", "ec:/a/f.gz", cpipeline=cpipeline))
+        with gzip.open(os.path.join(self.root, "a", "f.gz")) as fhr:
+            self.assertEqual(fhr.read(), b"streamed" * 10000)
+        self.assertFalse(
+            [f for f in os.listdir(".") if f.startswith("f") and f != "f"]
+        )
+        # The reader fails: the compression is abandoned
+        with self.assertRaises(ExecutionError):
+            sh.ecfsput("f", "ec:/missing/f.gz", cpipeline=cpipeline)
+        # The compression fails: the truncated stream is not a success
+        (unit,) = cpipeline.units
+        with mock.patch.object(
+            type(unit),
+            "compress",
+            lambda self, sh, stream: sh.popen(
+                ["sh", "-c", "head -c 100; exit 1"],
+                stdin=stream,
+                stdout=True,
+            ),
+        ):
+            self.assertFalse(
+                sh.ecfsput("f", "ec:/a/g.gz", cpipeline=cpipeline)
+            )
+
+    def test_streaming_get(self):
+        with gzip.open(os.path.join(self.root, "a", "f.gz"), "wb") as fhr:
+            fhr.write(b"streamed" * 10000)
+        cpipeline = CompressionPipeline(sh, "gzip")
+        self.assertTrue(sh.ecfsget("ec:/a/f.gz", "f", cpipeline=cpipeline))
+        with open("f", "rb") as fhl:
+            self.assertEqual(fhl.read(), b"streamed" * 10000)
+        # The writer fails: nothing is left behind
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget("ec:/a/missing.gz", "g", cpipeline=cpipeline)
+        self.assertFalse(os.path.exists("g"))
+
+
+class TestEcfsChecksums(_FakeEcfsTestCase):
+    def test_checksums(self):
+        config.set_config("ecmwf", "ecfs_checksum", "sha256")
+        for streaming in (False, True):
+            with self.subTest(streaming=streaming):
+                config.set_config("ecmwf", "ecfs_streaming", streaming)
+                self._check_checksums()
+
+    def _check_checksums(self):
+        data = b"checked" * 10000
+        with open("f", "wb") as fhl:
+            fhl.write(data)
+        self.assertTrue(sh.ecfsput("f", "ec:/a/f"))
+        with open(os.path.join(self.root, "a", "f.sha256")) as fhsum:
+            self.assertEqual(
+                fhsum.read(), hashlib.sha256(data).hexdigest() + "  f\n"
+            )
+        self.assertTrue(sh.ecfsget("ec:/a/f", "g"))
+        with open("g", "rb") as fhl:
+            self.assertEqual(fhl.read(), data)
+        # The checksum of the compressed data is stored (it is computed
+        # while compressing, without reading the files once more)
+        cpipeline = CompressionPipeline(sh, "gzip")
+        with mock.patch.object(
+            checksums, "update_from_file", side_effect=AssertionError
+        ):
+            self.assertTrue(sh.ecfsput("f", "ec:/a/f.gz", cpipeline=cpipeline))
+            self.assertTrue(sh.ecfsget("ec:/a/f.gz", "h", cpipeline=cpipeline))
+        with open(os.path.join(self.root, "a", "f.gz"), "rb") as fhr:
+            digest = hashlib.sha256(fhr.read()).hexdigest()
+        with open(os.path.join(self.root, "a", "f.gz.sha256")) as fhsum:
+            self.assertEqual(fhsum.read().split()[0], digest)
+        with open("h", "rb") as fhl:
+            self.assertEqual(fhl.read(), data)
+        # Corrupted data are detected
+        with open(os.path.join(self.root, "a", "f"), "r+b") as fhr:
+            fhr.write(b"C")
+        self.assertFalse(sh.ecfsget("ec:/a/f", "g"))
+        self.assertFalse(os.path.exists("g"))
+        # Without a sidecar file, nothing is checked
+        with open(os.path.join(self.root, "a", "nosum"), "wb") as fhr:
+            fhr.write(b"unchecked")
+        self.assertTrue(sh.ecfsget("ec:/a/nosum", "g"))
+
+
+class TestEcfsFileObjects(_FakeEcfsTestCase):
+    def test_fileobj(self):
+        with open(os.path.join(self.root, "a", "f"), "wb") as fhr:
+            fhr.write(b"remote")
+        target = io.BytesIO()
+        self.assertTrue(sh.ecfscp("ec:/a/f", target))
+        self.assertEqual(target.getvalue(), b"remote")
+        self.assertTrue(sh.ecfscp(io.BytesIO(b"memory"), "ec:/a/g"))
+        with open(os.path.join(self.root, "a", "g"), "rb") as fhr:
+            self.assertEqual(fhr.read(), b"memory")
+        with tempfile.TemporaryFile() as fhl:
+            fhl.write(b"anonymous")
+            self.assertTrue(sh.ecfscp(fhl, "ec:/a/h"))
+        with open(os.path.join(self.root, "a", "h"), "rb") as fhr:
+            self.assertEqual(fhr.read(), b"anonymous")
+        # No copy of the anonymous file was created
+        with open(self.log) as fhlog:
+            self.assertIn("/proc/", fhlog.readlines()[-1])
+
+    def test_spaces(self):
+        with open(os.path.join(self.root, "a", "my file"), "w") as fhr:
+            fhr.write("spaces")
+        self.assertTrue(sh.ecfsget("ec:/a/my file", "local file"))
+        with open("local file") as fhl:
+            self.assertEqual(fhl.read(), "spaces")
+
+
+class TestEcfsRetries(_FakeEcfsTestCase):
+    def test_retries(self):
+        with open(os.path.join(self.root, "a", "f"), "w") as fhs:
+            fhs.write("data")
+        config.set_config("ecmwf", "ecfs_retries", 2)
+        config.set_config("ecmwf", "ecfs_retry_delay", 0)
+        self._fail_copies(0, 2)
+        self.assertTrue(sh.ecfsget("ec:/a/f", "f"))
+        self.assertEqual(self._ncalls("ecp"), 3)
+        self._fail_copies(0, 3)
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget("ec:/a/f", "f")
+
+    def test_resumable(self):
+        data = os.urandom(3500)
+        with open("big", "wb") as fhl:
+            fhl.write(data)
+        chunkdir = os.path.join(self.root, "a", "big.chunks")
+        config.set_config("ecmwf", "ecfs_chunksize", 1000)
+        config.set_config("ecmwf", "ecfs_retries", 1)
+        config.set_config("ecmwf", "ecfs_retry_delay", 0)
+        # The second chunk fails once
+        self._fail_copies(1, 1)
+        self.assertTrue(sh.ecfsput_resumable("big", "ec:/a/big"))
+        self.assertEqual(len(os.listdir(chunkdir)), 4 + 1)
+        self.assertEqual(self._ncalls("ecp"), 4 + 1 + 1)
+        # Resume an interrupted transfer: only the missing chunk is sent
+        os.remove(os.path.join(chunkdir, "manifest.json"))
+        os.remove(os.path.join(chunkdir, sorted(os.listdir(chunkdir))[2]))
+        os.remove(self.log)
+        self.assertTrue(sh.ecfsput_resumable("big", "ec:/a/big"))
+        self.assertEqual(self._ncalls("ecp"), 1 + 1)
+        # An interrupted retrieval is resumed too
+        config.set_config("ecmwf", "ecfs_retries", 0)
+        self._fail_copies(2, 1)
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget_resumable("ec:/a/big", "back")
+        self.assertTrue(os.path.exists("back.resume"))
+        os.remove(self.log)
+        self.assertTrue(sh.ecfsget_resumable("ec:/a/big", "back"))
+        self.assertEqual(self._ncalls("ecp"), 1 + 3)
+        self.assertFalse(os.path.exists("back.resume"))
+        with open("back", "rb") as fhl:
+            self.assertEqual(fhl.read(), data)
+        # Corrupted chunks are detected
+        chunk = os.path.join(chunkdir, sorted(os.listdir(chunkdir))[1])
+        with open(chunk, "wb") as fhc:
+            fhc.write(b"x" * 1000)
+        self.assertFalse(sh.ecfsget_resumable("ec:/a/big", "back"))
+        # Transparent use by ecfsput/ecfsget
+        config.set_config("ecmwf", "ecfs_resumable_threshold", 3000)
+        self.assertTrue(sh.ecfsput("big", "ec:/b/big"))
+        self.assertFalse(os.path.exists(os.path.join(self.root, "b", "big")))
+        os.remove(self.log)
+        self.assertTrue(sh.ecfsget("ec:/b/big", "back2"))
+        with open("back2", "rb") as fhl:
+            self.assertEqual(fhl.read(), data)
+        # A unique listing tells if the file is stored by chunks
+        self.assertEqual((self._ncalls("els"), self._ncalls("etest")), (1, 0))
+        with open(os.path.join(self.root, "a", "f"), "w") as fhs:
+            fhs.write("data")
+        os.remove(self.log)
+        self.assertTrue(sh.ecfsget("ec:/a/f", "f"))
+        self.assertEqual((self._ncalls("els"), self._ncalls("etest")), (1, 0))
+
+
+class TestEcfsPrestage(_FakeEcfsTestCase):
+    def test_prestage(self):
+        items = [
+            "ec:/a/offB_1",
+            "ec:/a/disk",
+            "ec:/a/offA_1",
+            "ec:/a/offB_2",
+            "ec:/a/offA_2",
+        ]
+        self.assertEqual(
+            sh.ecfsstageinfo(items[:2]),
+            {"ec:/a/offB_1": ("B", False), "ec:/a/disk": ("disk", True)},
+        )
+        ready = sh.ecfsprestage(items, wait=True, pollfreq=0)
+        self.assertTrue(all(ready.values()))
+        # One recall, ordered by tape
+        with open(self.log) as fhlog:
+            recalls = [
+                line.split()[1:]
+                for line in fhlog
+                if line.startswith("estage ") and "-q" not in line
+            ]
+        self.assertEqual(
+            recalls,
+            [["ec:/a/offA_1", "ec:/a/offA_2", "ec:/a/offB_1", "ec:/a/offB_2"]],
+        )
+        # Through the archive
+        archive = footprints.proxy.archive(
+            kind="std", storage="ecfs.ecmwf.int", tube="ecfs", entry="/"
+        )
+        self.assertEqual(
+            archive.prestage(["b/offC_1", "b/disk"]),
+            {"b/offC_1": False, "b/disk": True},
+        )
+        self.assertEqual(
+            archive.prestageinfo("b/offC_1"),
+            dict(storage="ecfs.ecmwf.int", location="ec:/b/offC_1"),
+        )
+        # Through the Vortex prestaging hub
+        ptool = footprints.proxy.prestagingtool(
+            system=sh,
+            issuerkind="archivestore",
+            storage="ecfs.ecmwf.int",
+            priority=50,
+        )
+        ptool.add("ec:/b/offD_1")
+        self.assertTrue(ptool.flush())
+        self.assertEqual(
+            sh.ecfsstageinfo(["ec:/b/offD_1"]), {"ec:/b/offD_1": ("D", True)}
+        )
+        # The recall request fails
+        os.environ["FAKE_ECFS_STAGE_FAIL"] = "1"
+        with self.assertRaises(ExecutionError):
+            sh.ecfsprestage(["ec:/b/offE_1"])
+        ptool.add("ec:/b/offE_1")
+        self.assertFalse(ptool.flush())
+
+
+class TestEcfsLocalCache(_FakeEcfsTestCase):
+    def test_localcache(self):
+        lcache = os.path.join(self.tmpdir, "lcache")
+        config.set_config("ecmwf", "ecfs_localcache_path", lcache)
+        config.set_config("ecmwf", "ecfs_localcache_links", ["hardlink"])
+        with open(os.path.join(self.root, "a", "clim"), "w") as fhr:
+            fhr.write("clim")
+        archive = footprints.proxy.archive(
+            kind="std", storage="ecfs.ecmwf.int", tube="ecfs", entry="/"
+        )
+        self.assertTrue(archive.retrieve("/a/clim", "c1"))
+        self.assertTrue(archive.retrieve("/a/clim", "c2"))
+        self.assertEqual(self._ncalls("ecp"), 1)
+        self.assertEqual(os.stat("c1").st_ino, os.stat("c2").st_ino)
+        with open("c2") as fhl:
+            self.assertEqual(fhl.read(), "clim")
+        # Files that may be modified are never hard links
+        self.assertTrue(archive.retrieve("/a/clim", "cw", intent="inout"))
+        self.assertNotEqual(os.stat("c1").st_ino, os.stat("cw").st_ino)
+        with open("cw", "w") as fhl:
+            fhl.write("modified")
+        with open("c1") as fhl:
+            self.assertEqual(fhl.read(), "clim")
+        # The options are part of the cache key
+        self.assertTrue(archive.retrieve("/a/clim", "co", options=["o"]))
+        self.assertEqual(self._ncalls("ecp"), 2)
+        # Overwriting the file invalidates the cache
+        with open("newclim", "w") as fhl:
+            fhl.write("newclim")
+        self.assertTrue(archive.insert("/a/clim", "newclim"))
+        self.assertTrue(archive.retrieve("/a/clim", "c3"))
+        with open("c3") as fhl:
+            self.assertEqual(fhl.read(), "newclim")
+        # Concurrent requests share a single download
+        with open(os.path.join(self.root, "a", "clim2"), "w") as fhr:
+            fhr.write("clim2")
+        localcache = ECfsLocalCache(lcache, maxsize=6, links=["copy"])
+        os.remove(self.log)
+        rcs = list()
+        threads = [
+            threading.Thread(
+                target=lambda i=i: rcs.append(
+                    localcache.retrieve(
+                        "ec:/a/clim2",
+                        "d{:d}".format(i),
+                        lambda tmp: sh.ecfsget("ec:/a/clim2", tmp),
+                    )
+                )
+            )
+            for i in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(rcs, [True] * 4)
+        self.assertEqual(self._ncalls("ecp"), 1)
+        # The least recently used files were evicted (6 bytes at most)
+        self.assertIsNotNone(localcache.lookup("ec:/a/clim2"))
+        self.assertEqual(
+            [
+                len(files)
+                for _, _, files in os.walk(os.path.join(lcache, "objects"))
+                if files
+            ],
+            [1],
+        )
+        with open(os.path.join(lcache, "usage")) as fhusage:
+            self.assertEqual(int(fhusage.read()), len("clim2"))
+        # The remaining file is still served by the cache
+        localcache.retrieve(
+            "ec:/a/clim2", "d4", lambda tmp: sh.ecfsget("ec:/a/clim2", tmp)
+        )
+        self.assertEqual(self._ncalls("ecp"), 1)
+
+
+class TestEcfsCoalescing(_FakeEcfsTestCase):
+    def test_coalescing(self):
+        with open(os.path.join(self.root, "a", "f"), "w") as fhr:
+            fhr.write("shared")
+        os.environ["FAKE_ECFS_DELAY"] = "0.5"
+        config.set_config("ecmwf", "ecfs_coalescing", True)
+        process = multiprocessing.get_context("fork").Process(
+            target=sh.ecfsget, args=("ec:/a/f", "p")
+        )
+        process.start()
+        rcs = list()
+        threads = [
+            threading.Thread(
+                target=lambda i=i: rcs.append(
+                    sh.ecfsget("ec:/a/f", "t{:d}".format(i))
+                )
+            )
+            for i in range(3)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        process.join()
+        self.assertEqual(process.exitcode, 0)
+        self.assertEqual(rcs, [True] * 3)
+        self.assertEqual(self._ncalls("ecp"), 1)
+        for target in ("p", "t0", "t1", "t2"):
+            with open(target) as fhl:
+                self.assertEqual(fhl.read(), "shared")
+        # The waiters were given private copies
+        self.assertEqual(
+            len({os.stat(t).st_ino for t in ("p", "t0", "t1", "t2")}), 4
+        )
+        # Nothing is left behind
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, "locks")), [])
+        # Later requests are not coalesced
+        self.assertTrue(sh.ecfsget("ec:/a/f", "t3"))
+        self.assertEqual(self._ncalls("ecp"), 2)
+        # Coalescing is opt-in
+        config.set_config("ecmwf", "ecfs_coalescing", False)
+        os.environ["FAKE_ECFS_DELAY"] = "0.2"
+        threads = [
+            threading.Thread(
+                target=sh.ecfsget, args=("ec:/a/f", "u{:d}".format(i))
+            )
+            for i in range(2)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self._ncalls("ecp"), 4)
+
+
+class TestEcfsSessions(_FakeEcfsTestCase):
+    def test_sessions(self):
+        config.set_config(
+            "ecmwf",
+            "ecfs_session_command",
+            [sys.executable, "-m", "vortex_ecmwf.tools.cmdsessions"],
+        )
+        with open(os.path.join(self.root, "a", "f"), "w") as fhr:
+            fhr.write("f")
+        self.assertTrue(sh.ecfstest("ec:/a/f"))
+        self.assertEqual(sh.ecfsls("ec:/a", None), ["f"])
+        self.assertTrue(sh.ecfsget("ec:/a/f", "f"))
+        with open("f") as fhl:
+            self.assertEqual(fhl.read(), "f")
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget("ec:/a/missing", "g")
+        self.assertEqual(self._ncalls(), 4)
+        # A unique helper process did all the work
+        self.assertEqual(len(cmdsessions.sessions_pool("ecfs").pids), 1)
+        # Helper processes are not shared with forked processes
+        with mock.patch("os.getpid", return_value=-1):
+            self.assertFalse(cmdsessions.sessions_pool("ecfs").pids)
+
+    def test_sessions_context(self):
+        config.set_config(
+            "ecmwf",
+            "ecfs_session_command",
+            [sys.executable, "-m", "vortex_ecmwf.tools.cmdsessions"],
+        )
+        with open(os.path.join(self.root, "a", "f"), "w") as fhr:
+            fhr.write("f")
+        self.assertTrue(sh.ecfsget("ec:/a/f", "f"))
+        # The commands run in the caller's current directory and environment
+        sh.mkdir("sub")
+        sh.cd("sub")
+        os.environ["FAKE_ECFS_LOG"] = os.path.join(self.tmpdir, "other.log")
+        self.assertTrue(sh.ecfsget("ec:/a/f", "g"))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, "f")))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, "sub", "g")))
+        with open(os.path.join(self.tmpdir, "other.log")) as fhlog:
+            self.assertEqual(len(fhlog.readlines()), 1)
+        self.assertEqual(len(cmdsessions.sessions_pool("ecfs").pids), 1)
+
+    def test_sessions_backend(self):
+        with open(os.path.join(self.tmpdir, "warm_backend.py"), "w") as fhb:
+            fhb.write(WARM_BACKEND)
+        os.environ["PYTHONPATH"] = self.tmpdir
+        config.set_config(
+            "ecmwf",
+            "ecfs_session_command",
+            [
+                sys.executable,
+                "-m",
+                "vortex_ecmwf.tools.cmdsessions",
+                "--backend",
+                "warm_backend:factory",
+            ],
+        )
+        # The backend is created once and runs the commands in-process
+        (first,) = sh.ecfsls("ec:/a", None)
+        (second,) = sh.ecfsls("ec:/a", None)
+        self.assertEqual(first.split()[0], second.split()[0])
+        self.assertEqual([first.split()[1], second.split()[1]], ["1", "2"])
+        self.assertEqual(self._ncalls(), 0)
+
+    def test_sessions_failures(self):
+        with open(os.path.join(self.root, "a", "f"), "w") as fhr:
+            fhr.write("f")
+        # The helper can not be started: a new process is used instead
+        config.set_config(
+            "ecmwf", "ecfs_session_command", [self.tmpdir + "/missing"]
+        )
+        self.assertTrue(sh.ecfstest("ec:/a/f"))
+        self.assertEqual(self._ncalls(), 1)
+        # The helper hangs: the command must not be run twice
+        config.set_config(
+            "ecmwf",
+            "ecfs_session_command",
+            [sys.executable, "-c", "import time; input(); time.sleep(60)"],
+        )
+        config.set_config("ecmwf", "ecfs_session_timeout", 0.5)
+        with self.assertRaises(ExecutionError):
+            sh.ecfsrm("ec:/a/f", None)
+        self.assertEqual(self._ncalls(), 1)
+        self.assertTrue(os.path.exists(os.path.join(self.root, "a", "f")))
+
+
+class TestEcfsMetrics(_FakeEcfsTestCase):
+    def test_metrics(self):
+        registry = metrics.metrics_registry()
+        registry.clear()
+        with open(os.path.join(self.root, "a", "f"), "w") as fhr:
+            fhr.write("remote")
+        archive = footprints.proxy.archive(
+            kind="std", storage="ecfs.ecmwf.int", tube="ecfs", entry="/"
+        )
+        self.assertTrue(archive.check("/a/f"))
+        self.assertTrue(sh.ecfsget("ec:/a/f", "f"))
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget("ec:/a/missing", "g")
+        summary = registry.summary()
+        self.assertEqual(summary[("ecfs", "get")]["count"], 2)
+        self.assertEqual(summary[("ecfs", "get")]["failures"], 1)
+        self.assertEqual(summary[("ecfs", "get")]["nbytes"], 6)
+        self.assertEqual(
+            list(archive.metrics_summary().keys()), [("ecfs", "test")]
+        )
+        # Empty listings and negative tests are successful calls
+        os.makedirs(os.path.join(self.root, "empty"))
+        self.assertFalse([n for n in sh.ecfsls("ec:/empty", None) if n])
+        metrics.measured("ecfs", "ls")(lambda location: [])("ec:/empty")
+        self.assertFalse(sh.ecfstest("ec:/a/missing"))
+        summary = registry.summary()
+        self.assertEqual(summary[("ecfs", "ls")]["failures"], 0)
+        self.assertEqual(summary[("ecfs", "test")]["failures"], 0)
+        # The compressed bytes actually sent are counted
+        with open("big", "wb") as fhl:
+            fhl.write(b"0" * 100000)
+        cpipeline = CompressionPipeline(sh, "gzip")
+        self.assertTrue(sh.ecfsput("big", "ec:/a/big.gz", cpipeline=cpipeline))
+        self.assertEqual(
+            registry.summary()[("ecfs", "put")]["nbytes"],
+            os.path.getsize(os.path.join(self.root, "a", "big.gz")),
+        )
+        registry.clear()
+        self.assertTrue(sh.ecfsget("ec:/a/f", "f"))
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget("ec:/a/missing", "g")
+        self.assertTrue(archive.check("/a/f"))
+        jsonl = os.path.join(self.tmpdir, "metrics.jsonl")
+        prom = os.path.join(self.tmpdir, "metrics.prom")
+        registry.add_exporter(metrics.JsonLinesExporter(jsonl))
+        registry.add_exporter(metrics.PrometheusTextfileExporter(prom))
+        try:
+            registry.export()
+            registry.export()
+        finally:
+            registry.clear()
+            registry._exporters = list()
+        with open(jsonl) as fhjson:
+            self.assertEqual(len(fhjson.readlines()), 3)
+        with open(prom) as fhprom:
+            self.assertIn(
+                'vortex_ecmwf_transfers_total{tube="ecfs",operation="get"} 2',
+                fhprom.read(),
+            )
+
+    def test_bounded_records(self):
+        registry = metrics.MetricsRegistry(maxrecords=3)
+        exported = list()
+        registry.add_exporter(
+            mock.Mock(export=lambda r: exported.append(len(r.records)))
+        )
+        for i in range(7):
+            record = metrics.TransferRecord("ecfs", "get")
+            record.rc = bool(i % 2)
+            registry.add(record)
+        # Only the most recent records are kept, but nothing is lost
+        self.assertEqual(len(registry.records), 3)
+        self.assertEqual(exported, [3, 3])
+        self.assertEqual(registry.summary()[("ecfs", "get")]["count"], 7)
+        self.assertEqual(registry.summary()[("ecfs", "get")]["failures"], 4)
+
+
+if __name__ == "__main__":
+    main(verbosity=2)
@@ -0,0 +1,181 @@
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase, main
+
+import footprints
+from vortex import config, ticket
+from vortex.tools.compression import CompressionPipeline
+from vortex.tools.systems import ExecutionError
+
+import vortex_ecmwf  # noqa: F401
+from vortex_ecmwf.tools import cmdsessions, ecfsemulator
+from vortex_ecmwf.tools.ecfs import ecfs_known_directories
+from vortex_ecmwf.tools.ecfsemulator import ECfsEmulator
+
+sh = ticket().sh
+
+
+class TestECfsEmulator(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_ecfsemulator_")
+        self.root = os.path.join(self.tmpdir, "root")
+        self.emulator = ECfsEmulator(self.root)
+        self.local = os.path.join(self.tmpdir, "local")
+        with open(self.local, "w") as fhl:
+            fhl.write("data")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, *argv):
+        out = io.StringIO()
+        rc = self.emulator.run(list(argv), stdout=out, stderr=io.StringIO())
+        return rc, out.getvalue().splitlines()
+
+    def test_commands(self):
+        self.assertEqual(self._run("emkdir", "-p", "/u/d")[0], 0)
+        self.assertEqual(self._run("emkdir", "/x/y")[0], 1)
+        self.assertEqual(self._run("ecp", "-o", self.local, "ec:/u/d/f")[0], 0)
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.root, "ec", "u", "d", "f"))
+        )
+        # No overwrite without -o
+        self.assertEqual(self._run("ecp", self.local, "ec:/u/d/f")[0], 1)
+        self.assertEqual(self._run("etest", "ec:/u/d/f")[0], 0)
+        self.assertEqual(self._run("etest", "-d", "/u/d")[0], 0)
+        self.assertEqual(self._run("etest", "/u/d/g")[0], 1)
+        self.assertEqual(self._run("els", "-1", "ec:/u/d"), (0, ["f"]))
+        self.assertEqual(self._run("els", "-l", "/u/d/f")[1][0][-1], "f")
+        self.assertEqual(self._run("echmod", "444", "ec:/u/d/f")[0], 0)
+        self.assertEqual(self._run("emove", "ec:/u/d/f", "ec:/u/g")[0], 0)
+        back = os.path.join(self.tmpdir, "back")
+        self.assertEqual(self._run("ecp", "-p", "ec:/u/g", back)[0], 0)
+        with open(back) as fhb:
+            self.assertEqual(fhb.read(), "data")
+        self.assertEqual(os.stat(back).st_mode & 0o777, 0o444)
+        self.assertEqual(self._run("erm", "/u")[0], 1)
+        self.assertEqual(self._run("erm", "-R", "/u")[0], 0)
+        self.assertEqual(self._run("els", "/u")[0], 1)
+        self.assertEqual(self._run("eunknown")[0], 127)
+
+    def test_delays(self):
+        self.emulator = ECfsEmulator(self.root, latency=0.05, recall_delay=0.2)
+        t0 = time.monotonic()
+        self.assertEqual(self._run("emkdir", "-p", "/u")[0], 0)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.05)
+        # Files created by the emulator are on disk
+        self.assertEqual(self._run("ecp", "-o", self.local, "ec:/u/f")[0], 0)
+        shutil.copyfile(self.local, os.path.join(self.root, "ec", "u", "g"))
+        rc, lines = self._run("estage", "-q", "/u/f", "/u/g", "/u/h")
+        self.assertEqual(
+            [line.split()[2] for line in lines], ["online", "offline"]
+        )
+        self.assertEqual(lines[0].split()[1], lines[1].split()[1])
+        # Others must be recalled from tape
+        t0 = time.monotonic()
+        self.assertEqual(self._run("ecp", "ec:/u/g", self.local + "g")[0], 0)
+        self.assertGreaterEqual(time.monotonic() - t0, 0.2)
+        self.assertEqual(
+            self._run("estage", "-q", "/u/g")[1][0].split()[2], "online"
+        )
+        # Failures
+        self.emulator = ECfsEmulator(self.root, failure_rate=1)
+        self.assertEqual(self._run("etest", "/u/f")[0], 1)
+
+    def test_session(self):
+        requests = [
+            dict(argv=["emkdir", "-p", "ec:/u"]),
+            dict(argv=["els", "-1", "ec:/"]),
+            dict(argv=["etest", "ec:/missing"]),
+        ]
+        stdin = io.StringIO(
+            "".join([json.dumps(r) + "\n" for r in requests]) + "garbage\n"
+        )
+        stdout = io.StringIO()
+        self.emulator.serve(stdin=stdin, stdout=stdout)
+        answers = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([a["rc"] for a in answers], [0, 0, 1, 127])
+        self.assertEqual(answers[1]["stdout"], "u\n")
+
+
+class TestECfsToolsEmulated(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_ecfsemulator_")
+        self.root = os.path.join(self.tmpdir, "root")
+        config.set_config(
+            "ecmwf",
+            "ecfs_metacache_path",
+            os.path.join(self.tmpdir, "metacache.db"),
+        )
+        config.set_config(
+            "ecmwf", "coalescing_path", os.path.join(self.tmpdir, "locks")
+        )
+        ecfs_known_directories.clear()
+        self._oldpwd = sh.pwd()
+        sh.cd(self.tmpdir)
+
+    def tearDown(self):
+        for key in ("ecfs_command_wrapper", "ecfs_session_command"):
+            config.VORTEX_CONFIG.get("ecmwf", dict()).pop(key, None)
+        cmdsessions.close_all()
+        ecfs_known_directories.clear()
+        sh.cd(self._oldpwd)
+        shutil.rmtree(self.tmpdir)
+
+    def _roundtrip(self):
+        footprints.proxy.addon(kind="ecfs", shell=sh)
+        with open("f", "wb") as fhl:
+            fhl.write(b"emulated" * 1000)
+        cpipeline = CompressionPipeline(sh, "gzip")
+        self.assertTrue(sh.ecfsmkdir("ec:/u/d"))
+        self.assertTrue(sh.ecfsput("f", "ec:/u/d/f.gz", cpipeline=cpipeline))
+        self.assertTrue(sh.ecfstest("ec:/u/d/f.gz"))
+        self.assertEqual(sh.ecfsls("ec:/u/d", None), ["f.gz"])
+        self.assertTrue(sh.ecfsget("ec:/u/d/f.gz", "g", cpipeline=cpipeline))
+        with open("g", "rb") as fhl:
+            self.assertEqual(fhl.read(), b"emulated" * 1000)
+        with self.assertRaises(ExecutionError):
+            sh.ecfsget("ec:/u/d/missing", "h")
+
+    def test_wrapper(self):
+        config.set_config(
+            "ecmwf",
+            "ecfs_command_wrapper",
+            "{:s} {:s} --root {:s}".format(
+                sys.executable, ecfsemulator.__file__, self.root
+            ),
+        )
+        self._roundtrip()
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.root, "ec", "u", "d", "f.gz"))
+        )
+
+    def test_session(self):
+        config.set_config(
+            "ecmwf",
+            "ecfs_session_command",
+            [
+                sys.executable,
+                "-m",
+                "vortex_ecmwf.tools.ecfsemulator",
+                "--root",
+                self.root,
+                "--session",
+            ],
+        )
+        self._roundtrip()
+        # The command runs in the caller's current directory
+        sh.mkdir("sub")
+        sh.cd("sub")
+        self.assertTrue(sh.ecfsget("ec:/u/d/f.gz", "g"))
+        self.assertTrue(os.path.isfile(os.path.join(self.tmpdir, "sub", "g")))
+        self.assertEqual(len(cmdsessions.sessions_pool("ecfs").pids), 1)
+
+
+if __name__ == "__main__":
+    main(verbosity=2)
@@ -0,0 +1,609 @@
+import asyncio
+import gc
+import gzip
+import hashlib
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase, main, mock
+
+import footprints
+from vortex import config, ticket
+from vortex.tools.compression import CompressionPipeline
+
+import vortex_ecmwf  # noqa: F401
+from vortex_ecmwf.tools import checksums, ectrans, schedulers
+from vortex_ecmwf.tools.ectrans import (
+    ECtransEndpoint,
+    ECtransError,
+    ectrans_status,
+)
+
+sh = ticket().sh
+
+FAKE_ECTRANS = """#!{python:s}
+import os
+import shutil
+import sys
+
+args = sys.argv[1:]
+if "FAKE_ECTRANS_LOG" in os.environ:
+    with open(os.environ["FAKE_ECTRANS_LOG"], "a") as fhlog:
+        fhlog.write(" ".join(args) + "\\n")
+if "-ls" in args:
+    source = args[args.index("-source") + 1]
+    if source != "/remote/dir":
+        sys.exit(1)
+    print("file1")
+    print("/remote/dir/file2")
+elif "-list" in args:
+    if "FAKE_ECTRANS_LIST_FAIL" in os.environ:
+        # "1": always fail, otherwise: fail once (if the file exists)
+        fail = os.environ["FAKE_ECTRANS_LIST_FAIL"]
+        if fail == "1":
+            sys.exit(1)
+        if os.path.exists(fail):
+            os.remove(fail)
+            sys.exit(1)
+    print("Request  Status     Source")
+    print("1001     completed  a")
+    print("1002     failed     b")
+    print("1003     queued     c")
+elif "FAKE_ECTRANS_ROOT" in os.environ:
+    root = os.environ["FAKE_ECTRANS_ROOT"]
+    source = args[args.index("-source") + 1]
+    target = args[args.index("-target") + 1]
+    if "-get" in args:
+        source = os.path.join(root, source.lstrip("/"))
+    else:
+        target = os.path.join(root, target.lstrip("/"))
+    if not os.path.exists(source):
+        sys.exit(1)
+    with open(source, "rb") as fhin, open(target, "wb") as fhout:
+        shutil.copyfileobj(fhin, fhout)
+else:
+    source = args[args.index("-source") + 1]
+    print("ECtrans: request ID: " + dict(a="1001", b="1002", c="1003")[source])
+"""
+
+
+class _FakeEctransTestCase(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_ectrans_")
+        ectrans = os.path.join(self.tmpdir, "ectrans")
+        with open(ectrans, "w") as fhect:
+            fhect.write(FAKE_ECTRANS.format(python=sys.executable))
+        os.chmod(ectrans, 0o755)
+        self._environ = os.environ.copy()
+        os.environ["PATH"] = self.tmpdir + os.pathsep + os.environ["PATH"]
+        footprints.proxy.addon(kind="ectrans", shell=sh)
+        self._oldpwd = sh.pwd()
+        sh.cd(self.tmpdir)
+
+    def tearDown(self):
+        sh.cd(self._oldpwd)
+        os.environ.clear()
+        os.environ.update(self._environ)
+        shutil.rmtree(self.tmpdir)
+
+
+class TestEctransQueue(_FakeEctransTestCase):
+    def test_status(self):
+        self.assertEqual(
+            sh.ectransstatus(),
+            {
+                "1001": ectrans_status.done,
+                "1002": ectrans_status.failed,
+                "1003": ectrans_status.pending,
+            },
+        )
+        self.assertEqual(sh.ectranssubmit("b", "target"), (True, "1002"))
+
+    def test_queue(self):
+        async def disseminate():
+            queue = sh.ectransqueue(pollfreq=0.01)
+            transfers = [
+                queue.submit(s, "target", gateway="gw", remote="rm")
+                for s in ("a", "b")
+            ]
+            transfers.append(
+                queue.submit(
+                    "c", "target", gateway="gw", retryCnt=0, retryFrq=0
+                )
+            )
+            await queue.join()
+            return transfers
+
+        transfers = asyncio.run(disseminate())
+        self.assertEqual(
+            [t.request_id for t in transfers], ["1001", "1002", "1003"]
+        )
+        self.assertEqual(
+            [t.status for t in transfers],
+            [
+                ectrans_status.done,
+                ectrans_status.failed,
+                ectrans_status.unknown,
+            ],
+        )
+
+    def test_sync(self):
+        with self.assertRaises(ECtransError):
+            sh.ectransqueue().submit("a", "target")
+        transfers = sh.ectransbatchsubmit(
+            [("a", "target"), ("b", "target")],
+            pollfreq=0.01,
+            gateway="gw",
+            remote="rm",
+        )
+        self.assertEqual(
+            [t.status for t in transfers],
+            [ectrans_status.done, ectrans_status.failed],
+        )
+
+    def test_status_failure(self):
+        os.environ["FAKE_ECTRANS_LIST_FAIL"] = "1"
+        with self.assertRaises(ECtransError):
+            sh.ectransstatus()
+        # The transfer is not reported as failed (it may be in progress)
+        (transfer,) = sh.ectransbatchsubmit(
+            [("a", "target")],
+            pollfreq=0.01,
+            gateway="gw",
+            remote="rm",
+            retryCnt=0,
+            retryFrq=0,
+        )
+        self.assertEqual(transfer.status, ectrans_status.unknown)
+        # A transient failure is retried
+        fail = os.path.join(self.tmpdir, "fail_once")
+        open(fail, "w").close()
+        os.environ["FAKE_ECTRANS_LIST_FAIL"] = fail
+        (transfer,) = sh.ectransbatchsubmit(
+            [("a", "target")], pollfreq=0.01, gateway="gw", remote="rm"
+        )
+        self.assertFalse(os.path.exists(fail))
+        self.assertEqual(transfer.status, ectrans_status.done)
+
+
+class TestEctransListing(_FakeEctransTestCase):
+    def setUp(self):
+        super().setUp()
+        self.log = os.path.join(self.tmpdir, "calls.log")
+        os.environ["FAKE_ECTRANS_LOG"] = self.log
+        self._section = config.VORTEX_CONFIG.get("ectrans")
+        config.VORTEX_CONFIG["ectrans"] = dict(
+            gateway="gw", remote_myhost="rmyhost"
+        )
+        config.set_config("ecmwf", "ectrans_ls_option", "ls")
+
+    def tearDown(self):
+        if self._section is None:
+            del config.VORTEX_CONFIG["ectrans"]
+        else:
+            config.VORTEX_CONFIG["ectrans"] = self._section
+        config.VORTEX_CONFIG["ecmwf"].pop("ectrans_ls_option", None)
+        super().tearDown()
+
+    def _ncalls(self):
+        if not os.path.exists(self.log):
+            return 0
+        with open(self.log) as fhlog:
+            return len(fhlog.readlines())
+
+    def test_listing(self):
+        archive = footprints.proxy.archive(
+            kind="std", storage="myhost", tube="ectrans", entry="/remote"
+        )
+        with mock.patch.object(
+            ectrans.ECtransTools,
+            "ectrans_endpoint",
+            autospec=True,
+            side_effect=ectrans.ECtransTools.ectrans_endpoint,
+        ) as spy:
+            self.assertTrue(archive.check("dir/file1"))
+            self.assertTrue(archive.check("dir/file2"))
+        # The endpoint is resolved once per archive
+        self.assertEqual(spy.call_count, 1)
+        self.assertFalse(archive.check("dir/file3"))
+        self.assertEqual(archive.list("dir"), ["file1", "file2"])
+        # A unique listing answered everything
+        self.assertEqual(self._ncalls(), 1)
+        self.assertEqual(archive.list("dir/file1"), ["file1"])
+        # Failed listings are not cached
+        ncalls = self._ncalls()
+        self.assertIsNone(archive.list("missing"))
+        self.assertIsNone(archive.list("missing"))
+        self.assertEqual(self._ncalls(), ncalls + 4)
+        self.assertEqual(
+            archive.prestageinfo("dir/file1"),
+            dict(
+                storage="myhost",
+                location="/remote/dir/file1",
+                gateway="gw",
+                remote="rmyhost",
+            ),
+        )
+        # Putting a file invalidates the directory listing
+        ncalls = self._ncalls()
+        sh.raw_ectransput(
+            "a", "/remote/dir/a", gateway="gw", remote="rmyhost", sync=True
+        )
+        self.assertTrue(archive.check("dir/file1"))
+        self.assertEqual(self._ncalls(), ncalls + 2)
+
+    def test_probe(self):
+        config.set_config("ecmwf", "ectrans_ls_option", None)
+        root = os.path.join(self.tmpdir, "root")
+        os.makedirs(os.path.join(root, "remote", "dir"))
+        with open(os.path.join(root, "remote", "dir", "file1"), "w") as fhr:
+            fhr.write("probed")
+        os.environ["FAKE_ECTRANS_ROOT"] = root
+        self.assertIsNone(
+            sh.ectranstest("/remote/dir/file1", gateway="gw", remote="rm")
+        )
+        archive = footprints.proxy.archive(
+            kind="std", storage="myhost", tube="ectrans", entry="/remote"
+        )
+        # Without any listing, the files are retrieved
+        self.assertTrue(archive.check("dir/file1"))
+        self.assertFalse(archive.check("dir/file3"))
+        with open(self.log) as fhlog:
+            self.assertEqual(
+                [line.split()[-1] for line in fhlog], ["-get", "-get"]
+            )
+
+
+class TestEctransChecksums(_FakeEctransTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.tmpdir, "root")
+        os.makedirs(self.root)
+        os.environ["FAKE_ECTRANS_ROOT"] = self.root
+        config.set_config("ecmwf", "ectrans_checksum", "sha256")
+
+    def tearDown(self):
+        config.VORTEX_CONFIG["ecmwf"].pop("ectrans_checksum", None)
+        config.VORTEX_CONFIG["ecmwf"].pop("ectrans_streaming", None)
+        super().tearDown()
+
+    def test_checksums(self):
+        for streaming in (False, True):
+            with self.subTest(streaming=streaming):
+                config.set_config("ecmwf", "ectrans_streaming", streaming)
+                self._check_checksums()
+
+    def _check_checksums(self):
+        data = b"checked" * 10000
+        local = os.path.join(self.tmpdir, "f")
+        with open(local, "wb") as fhl:
+            fhl.write(data)
+        cpipeline = CompressionPipeline(sh, "gzip")
+        log = os.path.join(self.tmpdir, "calls.log")
+        os.environ["FAKE_ECTRANS_LOG"] = log
+        for sync in (True, False):
+            if os.path.exists(log):
+                os.remove(log)
+            # The checksum is computed while compressing (without reading
+            # the compressed file once more)
+            with mock.patch.object(
+                checksums, "update_from_file", side_effect=AssertionError
+            ):
+                self.assertTrue(
+                    sh.ectransput(
+                        local,
+                        "f.gz",
+                        gateway="gw",
+                        remote="rm",
+                        sync=sync,
+                        cpipeline=cpipeline,
+                    )
+                )
+            # The sidecar file is sent after the data (in the same way)
+            with open(log) as fhlog:
+                calls = [line.split() for line in fhlog]
+            self.assertEqual(
+                [c[c.index("-target") + 1] for c in calls],
+                ["f.gz", "f.gz.sha256"],
+            )
+            self.assertEqual(["-put" in c for c in calls], [sync, sync])
+            with open(os.path.join(self.root, "f.gz"), "rb") as fhr:
+                self.assertEqual(gzip.decompress(fhr.read()), data)
+                fhr.seek(0)
+                digest = hashlib.sha256(fhr.read()).hexdigest()
+            with open(os.path.join(self.root, "f.gz.sha256")) as fhsum:
+                self.assertEqual(fhsum.read(), digest + "  f.gz\n")
+        back = os.path.join(self.tmpdir, "back")
+        with mock.patch.object(
+            checksums, "update_from_file", side_effect=AssertionError
+        ):
+            self.assertTrue(
+                sh.ectransget(
+                    "f.gz",
+                    back,
+                    gateway="gw",
+                    remote="rm",
+                    cpipeline=cpipeline,
+                )
+            )
+        with open(back, "rb") as fhl:
+            self.assertEqual(fhl.read(), data)
+        # Corrupted data are detected
+        self.assertTrue(
+            sh.ectransput(local, "f", gateway="gw", remote="rm", sync=True)
+        )
+        with open(os.path.join(self.root, "f"), "r+b") as fhr:
+            fhr.write(b"C")
+        self.assertFalse(sh.ectransget("f", back, gateway="gw", remote="rm"))
+        self.assertFalse(os.path.exists(back))
+
+
+class TestEctransSMS(_FakeEctransTestCase):
+    def setUp(self):
+        super().setUp()
+        self.root = os.path.join(self.tmpdir, "root")
+        os.makedirs(os.path.join(self.root, "upd"))
+        self._section = config.VORTEX_CONFIG.get("ectrans")
+        config.VORTEX_CONFIG["ectrans"] = dict(
+            gateway="gw", remote_myhost="rmyhost"
+        )
+        sh.env.VORTEX_UPDSERVER_HOST = "myhost"
+        sh.env.VORTEX_UPDSERVER_PATH = "/upd"
+        sh.env.SMSNAME = "/suite/task"
+        sh.env.FAKE_ECTRANS_ROOT = self.root
+        # The child session clones the shell's environment
+        self._path = sh.env.PATH
+        sh.env.PATH = os.environ["PATH"]
+
+    def tearDown(self):
+        config.VORTEX_CONFIG.get("ecmwf", dict()).pop(
+            "sms_dispatch_window", None
+        )
+        config.VORTEX_CONFIG.get("ecmwf", dict()).pop(
+            "sms_update_interval", None
+        )
+        config.VORTEX_CONFIG.get("ecmwf", dict()).pop(
+            "ectrans_streaming", None
+        )
+        if self._section is None:
+            del config.VORTEX_CONFIG["ectrans"]
+        else:
+            config.VORTEX_CONFIG["ectrans"] = self._section
+        for var in (
+            "VORTEX_UPDSERVER_HOST",
+            "VORTEX_UPDSERVER_PATH",
+            "SMSNAME",
+            "FAKE_ECTRANS_ROOT",
+        ):
+            del sh.env[var]
+        sh.env.PATH = self._path
+        super().tearDown()
+
+    def _updates(self):
+        updates = list()
+        for filename in os.listdir(os.path.join(self.root, "upd")):
+            with open(os.path.join(self.root, "upd", filename)) as fhupd:
+                updates.append(fhupd.read().splitlines())
+        return updates
+
+    def test_unbatched(self):
+        sms = footprints.proxy.service(kind="sms")
+        self.assertTrue(sms.child("meter", "step", "1"))
+        self.assertEqual(
+            self._updates(), [["smsmeter step 1", "SMSNAME=/suite/task"]]
+        )
+        # The header is only rebuilt when the SMS variables change
+        header = sms._sms_header()
+        sh.env.OTHER_VARIABLE = "1"
+        self.assertIs(sms._sms_header(), header)
+        del sh.env.OTHER_VARIABLE
+        sh.env.SMSNAME = "/suite/other"
+        self.assertEqual(sms._sms_header(), b"SMSNAME=/suite/other\n")
+        # Even with streaming, updates are sent from a file (with retries)
+        log = os.path.join(self.tmpdir, "calls.log")
+        sh.env.FAKE_ECTRANS_LOG = log
+        config.set_config("ecmwf", "ectrans_streaming", True)
+        self.assertTrue(sms.child("meter", "step", "2"))
+        del sh.env.FAKE_ECTRANS_LOG
+        self.assertIn(
+            ["smsmeter step 2", "SMSNAME=/suite/other"], self._updates()
+        )
+        with open(log) as fhlog:
+            (call,) = [line.split() for line in fhlog]
+        self.assertTrue(
+            os.path.basename(call[call.index("-source") + 1]).startswith(
+                "smscmd_send."
+            )
+        )
+        self.assertEqual(call[call.index("-retryCnt") + 1], "15")
+
+    def test_batched(self):
+        config.set_config("ecmwf", "sms_dispatch_window", 60)
+        sms = footprints.proxy.service(kind="sms")
+        commands = [
+            ("label", "info", "starting"),
+            ("meter", "step", "1"),
+            ("msg", "hello"),
+        ]
+        for command in commands:
+            self.assertTrue(sms.child(*command))
+        self.assertEqual(self._updates(), [])
+        # complete waits for the queued commands
+        self.assertTrue(sms.child("complete"))
+        self.assertEqual(
+            self._updates(),
+            [
+                [
+                    "smslabel info starting",
+                    "smsmeter step 1",
+                    "smsmsg hello",
+                    "smscomplete",
+                    "SMSNAME=/suite/task",
+                ]
+            ],
+        )
+        # A batch never mixes different environments
+        sh.env.SMSNAME = "/suite/other"
+        self.assertTrue(sms.child("meter", "step", "2"))
+        sh.env.SMSNAME = "/suite/task"
+        sh.env.FAKE_ECTRANS_ROOT = self.root
+        self.assertTrue(sms.child("meter", "step", "3"))
+        self.assertTrue(sms.flush())
+        self.assertEqual(len(self._updates()), 3)
+        # Failures are reported by the next flush
+        shutil.rmtree(os.path.join(self.root, "upd"))
+        self.assertTrue(sms.child("meter", "step", "4"))
+        self.assertFalse(sms.child("abort"))
+        self.assertTrue(sms.flush())
+
+    def test_exit_flush(self):
+        config.set_config("ecmwf", "sms_dispatch_window", 60)
+        sms = footprints.proxy.service(kind="sms")
+        self.assertTrue(sms.child("meter", "step", "1"))
+        self.assertEqual(self._updates(), [])
+        # A unique hook flushes all the dispatchers when the script ends
+        schedulers._flush_dispatchers()
+        self.assertEqual(len(self._updates()), 1)
+        # Unused dispatchers are not kept alive
+        ndispatchers = len(schedulers._DISPATCHERS)
+        footprints.proxy.service(kind="sms")
+        gc.collect()
+        self.assertEqual(len(schedulers._DISPATCHERS), ndispatchers)
+
+    def _wait_updates(self, n):
+        for _ in range(500):
+            if len(self._updates()) >= n:
+                break
+            time.sleep(0.01)
+        return sorted(self._updates())
+
+    def test_coalescing(self):
+        config.set_config("ecmwf", "sms_dispatch_window", 60)
+        sms = footprints.proxy.service(kind="sms")
+        for step in range(5):
+            self.assertTrue(sms.child("meter", "step", str(step)))
+        self.assertTrue(sms.child("label", "info", "a"))
+        self.assertTrue(sms.child("label", "info", "b"))
+        # Events do not wait for the end of the batching window
+        self.assertTrue(sms.child("event", "ready"))
+        self.assertEqual(
+            self._wait_updates(1),
+            [
+                [
+                    "smsmeter step 4",
+                    "smslabel info b",
+                    "smsevent ready",
+                    "SMSNAME=/suite/task",
+                ]
+            ],
+        )
+        self.assertEqual(sms.dropped_updates, 5)
+
+    def _wait_commands(self, log, last):
+        """The commands sent so far, in order (wait for the **last** one)."""
+        for _ in range(500):
+            commands = list()
+            try:
+                with open(log) as fhlog:
+                    for line in fhlog:
+                        args = line.split()
+                        target = args[args.index("-target") + 1]
+                        with open(self.root + target) as fhupd:
+                            commands.extend(
+                                c
+                                for c in fhupd.read().splitlines()
+                                if c.startswith("sms")
+                            )
+            except FileNotFoundError:
+                pass
+            if last in commands:
+                break
+            time.sleep(0.01)
+        return commands
+
+    def test_rate_limit(self):
+        config.set_config("ecmwf", "sms_update_interval", 60)
+        log = os.path.join(self.tmpdir, "calls.log")
+        sh.env.FAKE_ECTRANS_LOG = log
+        sms = footprints.proxy.service(kind="sms")
+        self.assertTrue(sms.child("meter", "step", "1"))
+        self.assertEqual(
+            self._wait_commands(log, "smsmeter step 1"), ["smsmeter step 1"]
+        )
+        self.assertTrue(sms.child("meter", "step", "2"))
+        self.assertTrue(sms.child("meter", "step", "3"))
+        self.assertTrue(sms.child("meter", "other", "1"))
+        self.assertTrue(sms.child("msg", "hello"))
+        # The step meter is held back, the other commands are not
+        self.assertEqual(
+            self._wait_commands(log, "smsmsg hello"),
+            ["smsmeter step 1", "smsmeter other 1", "smsmsg hello"],
+        )
+        # Urgent commands never overtake the held back updates
+        self.assertTrue(sms.child("event", "ready"))
+        self.assertEqual(
+            self._wait_commands(log, "smsevent ready")[3:],
+            ["smsmeter step 3", "smsevent ready"],
+        )
+        self.assertTrue(sms.child("meter", "step", "4"))
+        self.assertTrue(sms.child("complete"))
+        self.assertEqual(
+            self._wait_commands(log, "smscomplete")[5:],
+            ["smsmeter step 4", "smscomplete"],
+        )
+        del sh.env.FAKE_ECTRANS_LOG
+        self.assertEqual(sms.dropped_updates, 1)
+
+
+class TestEctransEndpoint(TestCase):
+    def setUp(self):
+        self.addon = footprints.proxy.addon(kind="ectrans", shell=sh)
+        self._section = config.VORTEX_CONFIG.get("ectrans")
+        config.VORTEX_CONFIG["ectrans"] = dict(
+            gateway="TEST_ECTRANS_GATEWAY",
+            remote_default="rdefault",
+            remote_myhost="rmyhost",
+        )
+        sh.env.TEST_ECTRANS_GATEWAY = "gw1"
+
+    def tearDown(self):
+        if self._section is None:
+            del config.VORTEX_CONFIG["ectrans"]
+        else:
+            config.VORTEX_CONFIG["ectrans"] = self._section
+        del sh.env.TEST_ECTRANS_GATEWAY
+
+    def test_endpoint(self):
+        with mock.patch.object(
+            ectrans, "from_config", wraps=ectrans.from_config
+        ) as spy:
+            for _ in range(3):
+                self.assertEqual(
+                    sh.ectrans_endpoint(storage="myhost"),
+                    ECtransEndpoint(gateway="gw1", remote="rmyhost"),
+                )
+            # Each key is looked up once
+            self.assertEqual(
+                len([c for c in spy.call_args_list if len(c.args) == 2]), 2
+            )
+        self.assertEqual(
+            sh.ectrans_endpoint(gateway="gw0", remote="r0"),
+            ECtransEndpoint(gateway="gw0", remote="r0"),
+        )
+        self.assertEqual(sh.ectrans_remote_init(), "rdefault")
+        # In-place modifications require a reset
+        sh.env.TEST_ECTRANS_GATEWAY = "gw2"
+        config.set_config("ectrans", "remote_myhost", "rmyhost2")
+        self.assertEqual(sh.ectrans_gateway_init(), "gw1")
+        sh.ectrans_reset()
+        self.assertEqual(sh.ectrans_gateway_init(), "gw2")
+        self.assertEqual(sh.ectrans_remote_init("myhost"), "rmyhost2")
+        # A new configuration section is noticed
+        config.VORTEX_CONFIG["ectrans"] = dict(remote_myhost="rmyhost3")
+        self.assertEqual(sh.ectrans_remote_init("myhost"), "rmyhost3")
+
+
+if __name__ == "__main__":
+    main(verbosity=2)
@@ -0,0 +1,240 @@
+import asyncio
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+from unittest import TestCase, main, mock
+
+import footprints
+from vortex import config, ticket
+
+import vortex_ecmwf  # noqa: F401
+from vortex_ecmwf.tools import cmdsessions, ectransemulator
+from vortex_ecmwf.tools.ectrans import ectrans_status
+from vortex_ecmwf.tools.ectransemulator import ECtransEmulator
+
+sh = ticket().sh
+
+
+class TestECtransEmulator(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_ectransemulator_")
+        self.root = os.path.join(self.tmpdir, "root")
+        self.emulator = ECtransEmulator(self.root, time_scale=0.001)
+        self.local = os.path.join(self.tmpdir, "local")
+        with open(self.local, "w") as fhl:
+            fhl.write("data" * 500)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _run(self, *argv):
+        out = io.StringIO()
+        rc = self.emulator.run(
+            ["ectrans"] + list(argv), stdout=out, stderr=io.StringIO()
+        )
+        return rc, out.getvalue().splitlines()
+
+    def _put(self, target, *options):
+        return self._run(
+            "-gateway",
+            "gw",
+            "-remote",
+            "rm",
+            "-source",
+            self.local,
+            "-target",
+            target,
+            *options,
+        )
+
+    def test_sync(self):
+        rc, lines = self._put("/d/f", "-put", "-overwrite")
+        self.assertEqual((rc, lines), (0, ["ECtrans: request ID: 1001"]))
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.root, "gw", "rm", "d", "f"))
+        )
+        # No overwrite without -overwrite
+        self.assertEqual(self._put("/d/f", "-put")[0], 1)
+        back = os.path.join(self.tmpdir, "back")
+        rc, _ = self._run(
+            "-gateway",
+            "gw",
+            "-remote",
+            "rm",
+            "-source",
+            "/d/f",
+            "-target",
+            back,
+            "-get",
+        )
+        self.assertEqual(rc, 0)
+        with open(back) as fhb:
+            self.assertEqual(fhb.read(), "data" * 500)
+        self.assertEqual(
+            self._run(
+                "-gateway", "gw", "-remote", "rm", "-source", "/d", "-ls"
+            ),
+            (0, ["f"]),
+        )
+        self.assertEqual(
+            self._run("-remote", "rm", "-source", "/d", "-ls")[0], 1
+        )
+        rc, lines = self._run("-list")
+        self.assertEqual(
+            [line.split()[:2] for line in lines[1:]],
+            [["1001", "completed"], ["1002", "failed"], ["1003", "completed"]],
+        )
+        self.assertEqual(self.emulator.run(["ecp"], stderr=io.StringIO()), 127)
+
+    def test_async(self):
+        self.emulator = ECtransEmulator(self.root, bandwidth=20000)
+        with mock.patch.object(self.emulator, "start_worker") as worker:
+            for prio in (10, 90, 50):
+                self._put("/f{:d}".format(prio), "-priority", str(prio))
+        self.assertEqual(worker.call_count, 3)
+        self.assertEqual(
+            [r["status"] for r in self.emulator.requests()], ["queued"] * 3
+        )
+        # The source may be removed: the data are spooled
+        os.remove(self.local)
+        t0 = time.monotonic()
+        self.emulator.process()
+        # 3 * 2000 bytes at 20000 bytes/s
+        self.assertGreaterEqual(time.monotonic() - t0, 0.3)
+        requests = self.emulator.requests()
+        self.assertEqual([r["status"] for r in requests], ["completed"] * 3)
+        self.assertEqual(
+            [
+                r["priority"]
+                for r in sorted(requests, key=lambda r: r["finished"])
+            ],
+            [90, 50, 10],
+        )
+        self.assertEqual(os.listdir(os.path.join(self.root, "spool")), [])
+
+    def test_retries(self):
+        self.emulator = ECtransEmulator(
+            self.root, failure_rate=1, time_scale=0.001
+        )
+        self.assertEqual(
+            self._put("/f", "-put", "-retryCnt", "2", "-retryFrq", "100")[0], 1
+        )
+        with mock.patch.object(self.emulator, "start_worker"):
+            self._put("/g", "-retryCnt", "1", "-retryFrq", "100")
+        self.emulator.process()
+        self.assertEqual(
+            [(r["status"], r["attempts"]) for r in self.emulator.requests()],
+            [("failed", 3), ("failed", 2)],
+        )
+
+    def test_worker(self):
+        # The worker process is started in the background
+        self.assertEqual(self._put("/f", "-retryFrq", "1")[0], 0)
+        for _ in range(100):
+            if self.emulator.requests()[0]["status"] == "completed":
+                break
+            time.sleep(0.05)
+        self.assertEqual(self.emulator.requests()[0]["status"], "completed")
+
+    def test_session(self):
+        requests = [
+            dict(argv=["ectrans", "-list"]),
+            dict(argv=["ectrans", "-gateway", "gw", "-remote", "rm", "-ls"]),
+            # A relative source is found in the request's directory
+            dict(
+                argv=[
+                    "ectrans",
+                    "-gateway",
+                    "gw",
+                    "-remote",
+                    "rm",
+                    "-source",
+                    os.path.basename(self.local),
+                    "-target",
+                    "/f",
+                    "-put",
+                ],
+                cwd=os.path.dirname(self.local),
+                env=dict(os.environ),
+            ),
+        ]
+        stdin = io.StringIO(
+            "".join([json.dumps(r) + "\n" for r in requests]) + "garbage\n"
+        )
+        stdout = io.StringIO()
+        cwd = os.getcwd()
+        self.emulator.serve(stdin=stdin, stdout=stdout)
+        answers = [json.loads(line) for line in stdout.getvalue().splitlines()]
+        self.assertEqual([a["rc"] for a in answers], [0, 1, 0, 127])
+        self.assertTrue(
+            os.path.isfile(os.path.join(self.root, "gw", "rm", "f"))
+        )
+        self.assertEqual(os.getcwd(), cwd)
+
+
+class TestECtransToolsEmulated(TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="test_ecmwf_ectransemulator_")
+        self.root = os.path.join(self.tmpdir, "root")
+        config.set_config(
+            "ecmwf",
+            "ectrans_command_wrapper",
+            "{:s} {:s} --root {:s} --time-scale 0.001".format(
+                sys.executable, ectransemulator.__file__, self.root
+            ),
+        )
+        config.set_config("ecmwf", "ectrans_ls_option", "ls")
+        self._oldpwd = sh.pwd()
+        sh.cd(self.tmpdir)
+        footprints.proxy.addon(kind="ectrans", shell=sh)
+        with open("f", "wb") as fhl:
+            fhl.write(b"emulated" * 1000)
+
+    def tearDown(self):
+        for key in ("ectrans_command_wrapper", "ectrans_ls_option"):
+            config.VORTEX_CONFIG.get("ecmwf", dict()).pop(key, None)
+        cmdsessions.close_all()
+        sh.cd(self._oldpwd)
+        shutil.rmtree(self.tmpdir)
+
+    def test_roundtrip(self):
+        self.assertTrue(
+            sh.raw_ectransput(
+                "f", "/d/f", gateway="gw", remote="rm", sync=True
+            )
+        )
+        self.assertTrue(sh.ectranstest("/d/f", gateway="gw", remote="rm"))
+        self.assertTrue(
+            sh.raw_ectransget("/d/f", "g", gateway="gw", remote="rm")
+        )
+        with open("g", "rb") as fhl:
+            self.assertEqual(fhl.read(), b"emulated" * 1000)
+
+    def test_queue(self):
+        async def disseminate():
+            queue = sh.ectransqueue(pollfreq=0.05)
+            transfers = [
+                queue.submit(
+                    "f", "/d/f{:d}".format(i), gateway="gw", remote="rm"
+                )
+                for i in range(4)
+            ]
+            await queue.join()
+            return transfers
+
+        transfers = asyncio.run(disseminate())
+        self.assertEqual(
+            [t.status for t in transfers], [ectrans_status.done] * 4
+        )
+        self.assertEqual(
+            sorted(os.listdir(os.path.join(self.root, "gw", "rm", "d"))),
+            ["f0", "f1", "f2", "f3"],
+        )
+
+
+if __name__ == "__main__":
+    main(verbosity=2)
@@ -1,6 +1,6 @@
 from unittest import TestCase, main
 
-from vortex import ticket
+from vortex import config, ticket
 from vortex_ecmwf.tools.interfaces import ECMWFInterface
 
 sh = ticket().sh
@@ -143,6 +143,12 @@ class TestPrepareArguments(TestCase):
 
 
 class TestBuildCommandLine(TestCase):
+    def setUp(self):
+        self._config = dict(config.VORTEX_CONFIG.get("ecmwf", dict()))
+
+    def tearDown(self):
+        config.VORTEX_CONFIG["ecmwf"] = self._config
+
     def test_build_commandline(self):
         interface = ECMWFInterface(
             system=sh, command="ecmwf", command_interface=True
@@ -176,6 +182,46 @@ class TestBuildCommandLine(TestCase):
         self.assertEqual(interface.actual_command("toto"), "toto")
         self.assertEqual(interface.actual_command(), "ecmwf")
 
+    def test_build_command_argv(self):
+        argv = ECMWFInterface.build_command_argv(
+            ("ecmwf", "-x"),
+            ["toto 1.txt", "titi.txt"],
+            {"value": ["titi1", "titi 2"], "retry": 0},
+            ["u"],
+        )
+        self.assertEqual(
+            argv,
+            [
+                "ecmwf",
+                "-x",
+                "-value",
+                "titi1",
+                "titi 2",
+                "-retry",
+                "0",
+                "-u",
+                "toto 1.txt",
+                "titi.txt",
+            ],
+        )
+        paths = ["file{:d}".format(i) for i in range(10000)]
+        argv = ECMWFInterface.build_command_argv(("ecp",), paths, dict(), [])
+        self.assertEqual(len(argv), 10001)
+
+    def test_command_header(self):
+        interface = ECMWFInterface(
+            system=sh, command="ecmwf", command_interface=True
+        )
+        config.set_config("ecmwf", "ecmwf_command", "'/my path/ecmwf' -q")
+        self.assertEqual(interface.command_header(), ("/my path/ecmwf", "-q"))
+        self.assertEqual(interface.command_header("ecp"), ("ecp",))
+        # The header is cached...
+        config.set_config("ecmwf", "ecmwf_command", "other")
+        self.assertEqual(interface.command_header(), ("/my path/ecmwf", "-q"))
+        # ... until the interface is reset
+        interface.reset()
+        self.assertEqual(interface.command_header(), ("other",))
+
 
 if __name__ == "main":
     main(verbosity=2)